@@ -0,0 +1,160 @@
+import logging
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Fixed-rate acquisition loop.
+#
+# Ticks are scheduled against absolute deadlines (start + n * period) rather
+# than by sleeping a fixed amount after each read, so the time spent reading
+# the sensor does not accumulate as drift. Only read_fn runs on the
+# acquisition thread; every sample is handed to a separate worker thread that
+# runs handler(timestamp, sample) for display, printing and persistence.
+class AcquisitionLoop(object):
+    def __init__(self, read_fn, handler, rate_hz=1.0, queue_size=1024, name='acquisition', phase=0.0):
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be positive")
+        self._read_fn = read_fn
+        self._handler = handler
+        self._period = 1.0 / rate_hz
+        self._name = name
+        # Offset of the first tick, used to stagger loops sharing a bus
+        self._phase = phase
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        # Set to cut the current wait short (stop, or a boost starting)
+        self._wake = threading.Event()
+        self._boost_period = None
+        self._boost_until = 0.0
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stats = {
+            'rate_hz': rate_hz,
+            'ticks': 0,
+            'samples': 0,
+            'read_failures': 0,
+            'overruns': 0,
+            'skipped_ticks': 0,
+            'handler_drops': 0,
+            'handler_errors': 0,
+            'boosts': 0,
+            'last_jitter_ms': 0.0,
+            'max_jitter_ms': 0.0,
+            'total_jitter_ms': 0.0,
+            'last_read_ms': 0.0,
+            'max_read_ms': 0.0,
+        }
+
+    @property
+    def period(self):
+        return self._period
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._acquire, name=self._name, daemon=True),
+            threading.Thread(target=self._consume, name=self._name + '-handler', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    # Sample at rate_hz for the next `seconds`, starting with an immediate
+    # tick, then fall back to the normal rate. Used for event bursts; calling
+    # it again while boosted extends the burst.
+    def boost(self, rate_hz, seconds):
+        if rate_hz <= 0:
+            raise ValueError("rate_hz must be positive")
+        with self._lock:
+            self._boost_period = 1.0 / rate_hz
+            self._boost_until = time.monotonic() + seconds
+            self._stats['boosts'] += 1
+        self._wake.set()
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+        total = result.pop('total_jitter_ms')
+        result['avg_jitter_ms'] = total / result['ticks'] if result['ticks'] else 0.0
+        result['handler_queue_depth'] = self._queue.qsize()
+        return result
+
+    def _acquire(self):
+        deadline = time.monotonic() + self._phase
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now < deadline:
+                if self._wake.wait(deadline - now):
+                    self._wake.clear()
+                    if self._stop.is_set():
+                        break
+                    # A boost started: take the first burst sample right away
+                    deadline = time.monotonic()
+                now = time.monotonic()
+            period = min(self._boost_period, self._period) if now < self._boost_until else self._period
+
+            jitter = (now - deadline) * 1000.0
+            timestamp = time.time()
+            try:
+                sample = self._read_fn()
+            except Exception as e:
+                logger.error("Acquisition read failed: %s", e)
+                sample = None
+            read_ms = (time.monotonic() - now) * 1000.0
+
+            # Advance to the next deadline; if the read overran one or more
+            # periods, skip the missed slots instead of bursting to catch up.
+            deadline += period
+            skipped = 0
+            after = time.monotonic()
+            if after > deadline:
+                skipped = int((after - deadline) // period) + 1
+                deadline += skipped * period
+
+            with self._lock:
+                stats = self._stats
+                stats['ticks'] += 1
+                stats['last_jitter_ms'] = jitter
+                stats['max_jitter_ms'] = max(stats['max_jitter_ms'], jitter)
+                stats['total_jitter_ms'] += jitter
+                stats['last_read_ms'] = read_ms
+                stats['max_read_ms'] = max(stats['max_read_ms'], read_ms)
+                if skipped:
+                    stats['overruns'] += 1
+                    stats['skipped_ticks'] += skipped
+                if sample is None:
+                    stats['read_failures'] += 1
+                else:
+                    stats['samples'] += 1
+
+            if sample is not None:
+                try:
+                    self._queue.put_nowait((timestamp, sample))
+                except queue.Full:
+                    with self._lock:
+                        self._stats['handler_drops'] += 1
+
+    def _consume(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            try:
+                timestamp, sample = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                self._handler(timestamp, sample)
+            except Exception as e:
+                logger.exception("Acquisition handler failed: %s", e)
+                with self._lock:
+                    self._stats['handler_errors'] += 1
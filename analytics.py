@@ -0,0 +1,207 @@
+import shelve
+import threading
+from datetime import datetime, time as dtime, timedelta
+
+import numpy as np
+
+
+# Power factor histogram bin edges (|PF| in steps of 0.05)
+PF_BINS = np.linspace(0.0, 1.0, 21)
+DEMAND_MINUTES = 15
+# Points of the load-duration curve, in percent of time
+LOAD_DURATION_PERCENTS = (0, 1, 2, 5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 98, 99, 100)
+QUADRANTS = 5
+# A sample stands for the time until the next one, unless the gap is longer
+MAX_GAP_S = 60.0
+# A day is cached once it ended this long ago, leaving time for the write
+# pipeline to flush (or replay its spool)
+SETTLE_MS = 15 * 60 * 1000
+
+
+def day_bounds(day):
+    # Local midnight to local midnight, matching the nightly accumulator reset
+    start = datetime.combine(day, dtime.min).astimezone()
+    stop = datetime.combine(day + timedelta(days=1), dtime.min).astimezone()
+    return int(start.timestamp() * 1000), int(stop.timestamp() * 1000)
+
+
+def parse_series(rows):
+    # Rows of QueryBuilder.day_series from QueryApi.query_csv without annotations:
+    # ['', result, table, t, p, pf, e, q], with a header row per table
+    columns = []
+    for row in rows:
+        if len(row) < 8 or row[3] in ('', 't'):
+            continue
+        columns.append([field if field != '' else 'nan' for field in row[3:8]])
+    if not columns:
+        return np.empty((0, 5))
+    return np.array(columns, dtype=np.float64)
+
+
+# Per-day building blocks of a report, small enough to keep for months:
+# energy per hour, mean power per minute, power factor and quadrant time.
+class DaySummary(object):
+    __slots__ = ('day', 'start_ms', 'hourly_wh', 'minute_w', 'pf_seconds', 'quadrant_seconds',
+                 'covered_seconds', 'samples', 'wh_from_power', 'resets')
+
+    def __init__(self, day, start_ms, stop_ms):
+        minutes = (stop_ms - start_ms) // 60000
+        self.day = day
+        self.start_ms = start_ms
+        self.hourly_wh = np.zeros(-(-minutes // 60))
+        self.minute_w = np.full(minutes, np.nan)
+        self.pf_seconds = np.zeros(len(PF_BINS) - 1)
+        self.quadrant_seconds = np.zeros(QUADRANTS)
+        self.covered_seconds = 0.0
+        self.samples = 0
+        self.wh_from_power = 0.0
+        self.resets = 0
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+def summarize_day(day, start_ms, stop_ms, series):
+    summary = DaySummary(day, start_ms, stop_ms)
+    if len(series) == 0:
+        return summary
+    t, power, pf, energy, quadrant = (series[:, i] for i in range(5))
+    t = t / 1000000.0
+
+    # Energy: accumulator deltas, where a drop means the chip was reset and
+    # the new reading is what accumulated since.
+    delta = np.diff(energy)
+    reset = delta < 0
+    delta = np.nan_to_num(np.where(reset, energy[1:], delta))
+    ends = t[1:]
+    in_day = (ends >= start_ms) & (ends < stop_ms)
+    hours = ((ends[in_day] - start_ms) // 3600000).astype(np.int64)
+    summary.hourly_wh = np.bincount(hours, weights=delta[in_day], minlength=len(summary.hourly_wh))
+    summary.resets = int(np.count_nonzero(reset & in_day))
+
+    # Everything else is weighted by how long each sample stood for
+    mask = (t >= start_ms) & (t < stop_ms)
+    t, power, pf, quadrant = t[mask], power[mask], pf[mask], quadrant[mask]
+    if len(t) == 0:
+        return summary
+    durations = np.append(np.diff(t) / 1000.0, 0.0)
+    durations[durations > MAX_GAP_S] = 0.0
+    power = np.nan_to_num(power)
+    summary.samples = int(len(t))
+    summary.covered_seconds = float(durations.sum())
+    summary.wh_from_power = float(np.dot(power, durations) / 3600.0)
+
+    minutes = ((t - start_ms) // 60000).astype(np.int64)
+    weighted = np.bincount(minutes, weights=power * durations, minlength=len(summary.minute_w))
+    seconds = np.bincount(minutes, weights=durations, minlength=len(summary.minute_w))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary.minute_w = np.where(seconds > 0, weighted / seconds, np.nan)
+
+    summary.pf_seconds = np.histogram(np.clip(np.abs(np.nan_to_num(pf)), 0.0, 1.0), bins=PF_BINS,
+                                      weights=durations)[0]
+    summary.quadrant_seconds = np.bincount(np.clip(np.nan_to_num(quadrant), 0, QUADRANTS - 1).astype(np.int64),
+                                           weights=durations, minlength=QUADRANTS)
+    return summary
+
+
+def _round(value, digits=4):
+    return None if value is None or np.isnan(value) else round(float(value), digits)
+
+
+def build_report(device_id, summaries):
+    days = []
+    hours = []
+    blocks = []
+    block_starts = []
+    for summary in summaries:
+        days.append({
+            'date': summary.day.isoformat(),
+            'kwh': _round(summary.hourly_wh.sum() / 1000.0),
+            'kwhFromPower': _round(summary.wh_from_power / 1000.0),
+            'resets': summary.resets,
+            'coverage': _round(summary.covered_seconds / (len(summary.minute_w) * 60.0)),
+        })
+        hours.extend({'time': summary.start_ms + i * 3600000, 'kwh': _round(wh / 1000.0)}
+                     for i, wh in enumerate(summary.hourly_wh))
+        blocks.append(summary.minute_w.reshape(-1, DEMAND_MINUTES))
+        block_starts.append(summary.start_ms + np.arange(len(blocks[-1])) * DEMAND_MINUTES * 60000)
+
+    report = {'deviceId': device_id, 'days': days, 'hours': hours,
+              'peakDemand': None, 'loadDuration': [], 'powerFactor': {}, 'quadrantSeconds': {}}
+    if not summaries:
+        return report
+
+    # Peak demand: the highest mean power over an aligned 15 minute interval
+    blocks = np.concatenate(blocks)
+    block_starts = np.concatenate(block_starts)
+    with np.errstate(invalid='ignore'):
+        counts = np.sum(~np.isnan(blocks), axis=1)
+        demand = np.where(counts > 0, np.nansum(blocks, axis=1) / np.maximum(counts, 1), np.nan)
+    if np.any(~np.isnan(demand)):
+        peak = int(np.nanargmax(demand))
+        report['peakDemand'] = {'kw': _round(demand[peak] / 1000.0), 'start': int(block_starts[peak]),
+                                'minutes': DEMAND_MINUTES}
+
+    # Load-duration curve from the per-minute means
+    minutes = np.concatenate([summary.minute_w for summary in summaries])
+    minutes = minutes[~np.isnan(minutes)]
+    if len(minutes):
+        levels = np.percentile(minutes, [100 - percent for percent in LOAD_DURATION_PERCENTS])
+        report['loadDuration'] = [{'percent': percent, 'kw': _round(level / 1000.0)}
+                                  for percent, level in zip(LOAD_DURATION_PERCENTS, levels)]
+
+    pf_seconds = np.sum([summary.pf_seconds for summary in summaries], axis=0)
+    report['powerFactor'] = {'bins': [round(float(edge), 2) for edge in PF_BINS],
+                             'seconds': [round(float(value), 1) for value in pf_seconds]}
+    quadrant_seconds = np.sum([summary.quadrant_seconds for summary in summaries], axis=0)
+    report['quadrantSeconds'] = {str(q): round(float(value), 1) for q, value in enumerate(quadrant_seconds)}
+    return report
+
+
+# Day summaries of completed days, in memory and in a shelve file so they
+# survive restarts. The current day is always recomputed.
+class DayCache(object):
+    def __init__(self, path='analytics_db'):
+        self._path = path
+        self._memory = {}
+        self._lock = threading.Lock()
+
+    def get(self, device_id, day):
+        key = f'{device_id}/{day.isoformat()}'
+        with self._lock:
+            summary = self._memory.get(key)
+            if summary is None:
+                with shelve.open(self._path) as db:
+                    summary = db.get(key)
+                if summary is not None:
+                    self._memory[key] = summary
+            return summary
+
+    def put(self, device_id, summary):
+        key = f'{device_id}/{summary.day.isoformat()}'
+        with self._lock:
+            self._memory[key] = summary
+            with shelve.open(self._path) as db:
+                db[key] = summary
+
+
+def report(device_id, first_day, last_day, fetch, cache, now_ms):
+    # fetch(start_ms, stop_ms) returns the series parsed by parse_series
+    summaries = []
+    day = first_day
+    while day <= last_day:
+        start_ms, stop_ms = day_bounds(day)
+        if start_ms > now_ms:
+            break
+        summary = cache.get(device_id, day)
+        if summary is None:
+            summary = summarize_day(day, start_ms, stop_ms, fetch(start_ms, min(stop_ms, now_ms)))
+            if stop_ms + SETTLE_MS <= now_ms:
+                cache.put(device_id, summary)
+        summaries.append(summary)
+        day += timedelta(days=1)
+    return build_report(device_id, summaries)
@@ -1,60 +1,160 @@
-from flask import Flask, render_template, jsonify, Response, request
+from flask import Flask, render_template, jsonify, Response, request, g
 import json
-from json import JSONEncoder
-import jsonpickle
+import logging
 import random
 import time
-from datetime import date
+from datetime import date, datetime, timedelta, timezone
 import shelve
 import schedule
 import wattson
+import metrics
+from acquisition import AcquisitionLoop
+from broadcaster import SampleBroadcaster
+from devices import Snapshot
+from flux_queries import QueryError
+from query_executor import QueryRejected, QueryTimeout
+from query_cache import QueryCache
+from ring_buffer import parse_duration_ms
+from sample_archive import parse_time
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
 import signal 
 import threading 
 import UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521 as UpbeatLabs_MCP39F521
 
-energyData = UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_Data()
-energyAccumData = UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_AccumData()
-powerQuadrant = 0
-now = 0
-events = []
-
-data_lock = threading.Lock()
+registry = wattson.registry
+logger = logging.getLogger('app')
 
 app = Flask(__name__)
 scheduler = BackgroundScheduler()
-
-# subclass JSONEncoder
-class CustomEncoder(JSONEncoder):
-        def default(self, o):
-            return o.__dict__
+broadcasters = {device.device_id: SampleBroadcaster() for device in registry}
+query_cache = QueryCache(wattson.config.getint('CACHE', 'MAX_BYTES', fallback=8 * 1024 * 1024))
 
 def resetEnergyAccumulation():
     today = date.today()
     with shelve.open('my_db') as db:
         if 'last_run' not in db or db['last_run'] != today:
-            print("Resetting Energy Accumulation for the day")
-            wattson.energyAccumulationInitialize()
+            logger.info("Resetting Energy Accumulation for the day")
+            wattson.energyAccumulationReset([device.sensor for device in registry])
             db['last_run'] = today
         else:
-            print("Energy Accumulation has already been reset today.")
+            logger.info("Energy Accumulation has already been reset today.")
 
 def scheduled_task():
-    global energyData
-    global energyAccumData
-    global powerQuadrant
-    global now
-    global events
-
     schedule.run_pending()
-    result = wattson.write_measurements("wattson01")
-    if result is not None:
-        with data_lock:
-            energyData = result[0]
-            energyAccumData = result[1]
-            powerQuadrant = result[2]
-            events = result[3]
-            now = result[4]
+
+scheduler_skipped = metrics.counter('wattson_scheduler_skipped_runs_total', 'APScheduler runs that were missed or skipped', ('reason',))
+scheduler_errors = metrics.counter('wattson_scheduler_job_errors_total', 'APScheduler jobs that raised')
+
+def scheduler_listener(event):
+    if event.code == EVENT_JOB_MISSED:
+        scheduler_skipped.labels('missed').inc()
+    elif event.code == EVENT_JOB_MAX_INSTANCES:
+        scheduler_skipped.labels('max_instances').inc()
+    else:
+        scheduler_errors.inc()
+
+scheduler.add_listener(scheduler_listener, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES | EVENT_JOB_ERROR)
+
+def make_sample_handler(device):
+    broadcaster = broadcasters[device.device_id]
+
+    def handle_sample(timestamp, sample):
+        result = wattson.process_measurements(device.device_id, sample[0], sample[1],
+                                              datetime.fromtimestamp(timestamp, timezone.utc),
+                                              display=device.display)
+        if result is not None:
+            # Serialized once per tick for /wattson-data, the API workers
+            # and all live stream clients
+            payload = wattson.sample_payload(device.device_id, result)
+            snapshot = device.publish(result, payload.encode())
+            wattson.publish_sample(device.device_id, snapshot.body, snapshot.timestamp)
+            if broadcaster.subscriber_count():
+                broadcaster.publish(payload)
+
+    return handle_sample
+
+# One sampler per board. Their ticks are staggered across the period so the
+# boards take turns on the shared I2C bus instead of queueing on bus_lock.
+def create_acquisitions():
+    rate = wattson.acquisition_rate()
+    wattson.check_bus_budget(len(registry), rate)
+    loops = {}
+    for index, device in enumerate(registry):
+        loops[device.device_id] = AcquisitionLoop(
+            lambda device=device: wattson.read_measurements(device.sensor),
+            make_sample_handler(device), rate_hz=rate,
+            name='acquisition-' + device.device_id, phase=index / (rate * len(registry)))
+    return loops
+
+# API workers leave sampling to the process that owns the boards
+acquisitions = create_acquisitions() if wattson.owns_hardware else {}
+
+# In an API worker, live stream clients are fed from the sampler's shared
+# memory by one watcher thread per worker process.
+def follow_sampler():
+    def publish(device_id, payload):
+        broadcaster = broadcasters.get(device_id)
+        if broadcaster is not None and broadcaster.subscriber_count():
+            broadcaster.publish(payload.decode())
+    interval = min(0.25, max(0.02, 1.0 / (4 * wattson.acquisition_rate())))
+    wattson.sampler_link.watch(publish, interval)
+
+# An edge on a board's event pin switches its sampler to the burst rate so
+# the event capture is recorded at high resolution.
+def boost_on_event(pin, state):
+    rate, seconds = wattson.capture_burst()
+    for device in registry:
+        if device.event_pin == pin:
+            acquisitions[device.device_id].boost(rate, seconds)
+
+wattson.event_listeners.append(boost_on_event)
+
+request_seconds = metrics.histogram('wattson_http_request_seconds', 'Time to produce a response, per route',
+                                    ('route', 'method', 'status'))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    start = g.get('request_start')
+    if start is not None:
+        # Streamed responses are timed up to the first byte only
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        request_seconds.labels(route, request.method, str(response.status_code)).observe(time.perf_counter() - start)
+    return response
+
+def collect_app_metrics():
+    families = []
+    loops = {device_id: loop.stats() for device_id, loop in acquisitions.items()}
+    for key, kind, documentation in (
+            ('ticks', 'counter', 'Acquisition ticks'),
+            ('read_failures', 'counter', 'Acquisition ticks whose sensor read failed'),
+            ('overruns', 'counter', 'Acquisition ticks that ran past the next deadline'),
+            ('skipped_ticks', 'counter', 'Acquisition ticks skipped after an overrun'),
+            ('handler_drops', 'counter', 'Samples dropped because the handler queue was full'),
+            ('handler_queue_depth', 'gauge', 'Samples waiting for the handler thread'),
+            ('max_jitter_ms', 'gauge', 'Largest tick start delay in milliseconds')):
+        families.append(('wattson_acquisition_' + key + ('_total' if kind == 'counter' else ''), kind, documentation,
+                         [({'device': device_id}, stats[key]) for device_id, stats in loops.items()]))
+    cache = query_cache.stats()
+    families.append(('wattson_query_cache_lookups_total', 'counter', 'Query cache lookups by result',
+                     [({'result': result}, cache[result]) for result in ('hits', 'misses', 'coalesced')]))
+    families.append(('wattson_query_cache_evictions_total', 'counter', 'Query cache LRU evictions', [({}, cache['evictions'])]))
+    families.append(('wattson_query_cache_bytes', 'gauge', 'Bytes held by the query cache', [({}, cache['bytes'])]))
+    families.append(('wattson_stream_subscribers', 'gauge', 'Connected live stream clients',
+                     [({'device': device_id}, broadcaster.subscriber_count()) for device_id, broadcaster in broadcasters.items()]))
+    return families
+
+metrics.register_collector(collect_app_metrics)
+
+def lookup_device():
+    device = registry.get(request.args.get('device_id'))
+    if device is None:
+        return None, (jsonify({"error": "Unknown device_id"}), 404)
+    return device, None
 
 @app.route('/')
 def index():
@@ -68,82 +168,331 @@ def metric():
 def help():
     return render_template('help.html')
 
+# Served until a board's first sample arrives
+empty_snapshots = {device.device_id: Snapshot(wattson.sample_payload(device.device_id, (
+                       UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_Data(),
+                       UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_AccumData(), 0, [], 0)).encode(), 0)
+                   for device in registry}
+
+# An API worker's copy of the sampler's latest snapshot per board, rebuilt
+# only when the sampler has published a newer one
+shared_snapshots = {}
+
+def shared_snapshot(device_id):
+    buffer = wattson.sampler_link.buffer(device_id)
+    if buffer is None:
+        return None
+    cached = shared_snapshots.get(device_id)
+    if cached is not None and cached[0] == (buffer.instance, buffer.version()):
+        return cached[1]
+    latest = buffer.latest()
+    if latest is None:
+        return None
+    snapshot = Snapshot(latest[2], latest[1])
+    shared_snapshots[device_id] = ((buffer.instance, latest[0]), snapshot)
+    return snapshot
+
 @app.route('/wattson-data')
 def wattson_data():
-    global energyData
-    global energyAccumData
-    global powerQuadrant
-    global now
-    global events
-
-    localED = None
-    localEAD = None
-    localPQ = 0
-    localNow = 0
-    localEvents = []
-
-    with data_lock:
-       localED = UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_Data(energyData.systemStatus, energyData.systemVersion, 
-                    energyData.voltageRMS, energyData.lineFrequency, energyData.analogInputVoltage, 
-                    energyData.powerFactor, energyData.currentRMS, energyData.activePower, energyData.reactivePower,
-                    energyData.apparentPower)
-       localEAD = UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_AccumData(energyAccumData.activeEnergyImport, 
-                    energyAccumData.activeEnergyExport, energyAccumData.reactiveEnergyImport, 
-                    energyAccumData.reactiveEnergyExport)
-       localPQ = powerQuadrant
-       localEvents = events
-       localNow = now
-
-    result = { 'energyData': localED, 'energyAccumData': localEAD, 'powerQuadrant': localPQ, 'events': localEvents, 'timestamp':localNow } 
-    print(result)
-    response = Response(
-        response=json.dumps(result, cls=CustomEncoder),
-        status=200,
-        mimetype='application/json'
-    )
+    device, error = lookup_device()
+    if error:
+        return error
+
+    if wattson.sampler_link is not None:
+        snapshot = shared_snapshot(device.device_id)
+    else:
+        snapshot = device.snapshot
+    if snapshot is None:
+        snapshot = empty_snapshots[device.device_id]
+
+    # Dashboards polling faster than the sample rate get a bodiless 304
+    if request.if_none_match.contains_weak(snapshot.etag):
+        response = Response(status=304)
+    else:
+        response = Response(response=snapshot.body, status=200, mimetype='application/json')
+    response.set_etag(snapshot.etag)
+    response.headers['Cache-Control'] = 'no-cache'
     return response
-    #return jsonify({'energyData': localEDJSON, 'energyAccumData': localEADJSON})
+
+@app.route('/devices')
+def devices():
+    return jsonify([{'deviceId': device.device_id, 'address': device.address, 'display': device.display}
+                    for device in registry])
+
+@app.route('/wattson-stream')
+def wattson_stream():
+    # Server-Sent Events: one frame per sample, pushed as it is taken
+    device, error = lookup_device()
+    if error:
+        return error
+    if wattson.sampler_link is not None:
+        follow_sampler()
+    broadcaster = broadcasters[device.device_id]
+    subscription = broadcaster.subscribe()
+    return Response(broadcaster.stream(subscription),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Dashboards refresh a view every half aggregation window, so a cached
+# response stays valid for that long.
+def cache_ttl(aggregateWindow):
+    every_ms = parse_duration_ms(aggregateWindow)
+    if every_ms is None:
+        return 1.0
+    return max(1.0, every_ms / 2000.0)
+
+def query_failed(e):
+    # Saturated: fail fast so the client retries; past the deadline: 504
+    if isinstance(e, QueryError):
+        return jsonify({"error": str(e)}), 400
+    if isinstance(e, QueryRejected):
+        return jsonify({"error": str(e)}), 503, {'Retry-After': '1'}
+    if isinstance(e, QueryTimeout):
+        return jsonify({"error": str(e)}), 504
+    return jsonify({"error": str(e)}), 500
 
 @app.route('/query-data', methods=['GET'])
 def query_data():
-    device_id = request.args.get('device_id', default='wattson01')
+    device_id = request.args.get('device_id', default=registry.default.device_id)
     metric = request.args.get('metric', default='CurrentRMS')
     try:
-        result = wattson.query_data(device_id, metric)
-        return jsonify(result)
+        metric = wattson.query_builder.field(metric)
+    except QueryError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        # query_data always aggregates over 10s windows
+        body = query_cache.get_or_compute(('query-data', device_id, metric, '10s'), cache_ttl('10s'),
+                                          lambda: json.dumps(wattson.query_data(device_id, metric)).encode())
+        return Response(response=body, status=200, mimetype='application/json')
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return query_failed(e)
     
 @app.route('/query-all-data', methods=['GET'])
 def query_all_data():
-    device_id = request.args.get('device_id', default='wattson01')
+    device_id = request.args.get('device_id', default=registry.default.device_id)
     duration = request.args.get('duration', default='-5m')
     aggregateWindow = request.args.get('aggregateWindow', default='10s')
 
-    print(f"query_all_data:: device_id: {device_id}, duration: {duration}, aggregateWindow: {aggregateWindow}")
+    logger.debug("query_all_data:: device_id: %s, duration: %s, aggregateWindow: %s", device_id, duration, aggregateWindow)
+
+    # Rejected before anything is cached or sent to InfluxDB. ?fields= limits
+    # the response to the listed fields.
+    try:
+        wattson.query_builder.device(device_id)
+        duration, aggregateWindow, fields = wattson.query_builder.validate(
+            duration, aggregateWindow, request.args.get('fields'), wattson.QUERY_ALL_FIELDS)
+    except QueryError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if request.args.get('format') == 'columnar':
+        return query_all_data_columnar(device_id, duration, aggregateWindow, fields)
 
     try:
-        result = wattson.query_all_data(device_id, duration, aggregateWindow)
-        return jsonify(result)
+        body = query_cache.get_or_compute(('query-all-data', device_id, duration, aggregateWindow, fields), cache_ttl(aggregateWindow),
+                                          lambda: json.dumps(wattson.query_all_data(device_id, duration, aggregateWindow, fields)).encode())
+        return Response(response=body, status=200, mimetype='application/json')
     except Exception as e:
-        return jsonify({"error": str(e)}), 500    
+        return query_failed(e)    
+
+# Streamed columnar variant of /query-all-data. The body is sent as it is
+# produced and cached once complete.
+def query_all_data_columnar(device_id, duration, aggregateWindow, fields):
+    key = ('query-all-data-columnar', device_id, duration, aggregateWindow, fields)
+    body = query_cache.get(key)
+    if body is not None:
+        return Response(response=body, status=200, mimetype='application/json')
+
+    chunks = wattson.query_all_data_columnar(device_id, duration, aggregateWindow, fields)
+    try:
+        # Pull the first chunk here so query errors still produce a 500
+        first = next(chunks)
+    except Exception as e:
+        return query_failed(e)
+
+    def generate():
+        parts = [first.encode()]
+        yield parts[0]
+        for chunk in chunks:
+            part = chunk.encode()
+            parts.append(part)
+            yield part
+        query_cache.put(key, cache_ttl(aggregateWindow), b''.join(parts))
+
+    return Response(generate(), status=200, mimetype='application/json')
+
+@app.route('/analytics', methods=['GET'])
+def analytics():
+    # Billing-style report for whole local days: ?days=7 (ending today) or
+    # ?start=2024-05-01&stop=2024-05-31
+    device, error = lookup_device()
+    if error:
+        return error
+    device_id = device.device_id
+    try:
+        if request.args.get('start'):
+            first_day = date.fromisoformat(request.args['start'])
+            last_day = date.fromisoformat(request.args.get('stop', date.today().isoformat()))
+        else:
+            last_day = date.today()
+            first_day = last_day - timedelta(days=int(request.args.get('days', 1)) - 1)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if first_day > last_day or (last_day - first_day).days > 366:
+        return jsonify({"error": "Range must be 1 to 367 days"}), 400
+    try:
+        # Completed days come from the day cache; today's numbers move, so
+        # the whole report is only cached briefly
+        body = query_cache.get_or_compute(('analytics', device_id, first_day, last_day), 60.0,
+                                          lambda: json.dumps(wattson.analytics_report(device_id, first_day, last_day)).encode())
+        return Response(response=body, status=200, mimetype='application/json')
+    except Exception as e:
+        return query_failed(e)
+
+@app.route('/energy-totals', methods=['GET'])
+def energy_totals():
+    # Monotonic totals from the energy ledger, unaffected by accumulator resets
+    device, error = lookup_device()
+    if error:
+        return error
+    return jsonify(wattson.energy_totals(device.device_id) or {})
+
+@app.route('/captures', methods=['GET'])
+def captures():
+    # Recent captures from memory, or from InfluxDB with ?duration=-7d
+    device, error = lookup_device()
+    if error:
+        return error
+    try:
+        return jsonify(wattson.query_captures(device.device_id, request.args.get('duration')))
+    except Exception as e:
+        return query_failed(e)
+
+@app.route('/capture', methods=['GET'])
+def capture():
+    device, error = lookup_device()
+    if error:
+        return error
+    capture_id = request.args.get('id', '')
+    if not capture_id.isdigit():
+        return jsonify({"error": "id must be a capture id"}), 400
+    try:
+        result = wattson.query_capture(device.device_id, capture_id)
+    except Exception as e:
+        return query_failed(e)
+    if result is None:
+        return jsonify({"error": "Unknown capture"}), 404
+    return jsonify(result)
+
+@app.route('/archive-export', methods=['GET'])
+def archive_export():
+    # Bulk export from the local sample archive, streamed:
+    # ?start=-7d&stop=now&format=csv|lp (start and stop also take ISO times
+    # or epoch milliseconds)
+    device, error = lookup_device()
+    if error:
+        return error
+    archive = wattson.open_archive()
+    if archive is None:
+        return jsonify({"error": "The sample archive is not enabled"}), 404
+    try:
+        start = parse_time(request.args.get('start', '-1d'))
+        stop = parse_time(request.args.get('stop', 'now'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    export_format = request.args.get('format', 'csv')
+    if export_format == 'csv':
+        return Response(archive.csv_chunks(device.device_id, start, stop), status=200, mimetype='text/csv')
+    if export_format == 'lp':
+        chunks = archive.line_protocol_chunks(device.device_id, start, stop)
+        return Response(('\n'.join(lines) + '\n' for lines in chunks), status=200, mimetype='text/plain')
+    return jsonify({"error": "format must be csv or lp"}), 400
+
+@app.route('/archive-stats', methods=['GET'])
+def archive_stats():
+    return jsonify(wattson.archive_stats())
+
+@app.route('/influx-stats', methods=['GET'])
+def influx_stats():
+    return jsonify(wattson.influx_stats())
+
+@app.route('/write-stats', methods=['GET'])
+def write_stats():
+    return jsonify(wattson.write_stats())
+
+@app.route('/compression-stats', methods=['GET'])
+def compression_stats():
+    return jsonify(wattson.compression_stats())
+
+@app.route('/read-stats', methods=['GET'])
+def read_stats():
+    return jsonify(wattson.read_stats())
+
+@app.route('/query-stats', methods=['GET'])
+def query_stats():
+    return jsonify(wattson.query_executor.stats())
+
+@app.route('/acquisition-stats', methods=['GET'])
+def acquisition_stats():
+    if wattson.sampler_link is not None:
+        return jsonify(wattson.published_status('acquisition', {}))
+    return jsonify({device_id: loop.stats() for device_id, loop in acquisitions.items()})
+
+@app.route('/startup-stats', methods=['GET'])
+def startup_stats():
+    return jsonify(wattson.startup_stats())
+
+@app.route('/stream-stats', methods=['GET'])
+def stream_stats():
+    return jsonify({device_id: broadcaster.stats() for device_id, broadcaster in broadcasters.items()})
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(query_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # An API worker adds the sampler's metrics, which take precedence over
+    # its own idle copies of the sampling and write families
+    sampler = wattson.published_status('metrics', '') if wattson.sampler_link is not None else ''
+    body = metrics.REGISTRY.render(skip=metrics.family_names(sampler)) + sampler
+    return Response(body, status=200, content_type=metrics.CONTENT_TYPE)
 
 
 # gracefully exit without a big exception message if possible
 def ctrl_c_handler(signal, frame):
-    print('Goodbye!')
+    logger.info('Goodbye!')
+    for loop in acquisitions.values():
+        loop.stop()
     wattson.cleanup()
     exit(0)
 
-signal.signal(signal.SIGINT, ctrl_c_handler)
+# A WSGI server installs its own handlers in API workers
+if wattson.owns_hardware:
+    signal.signal(signal.SIGINT, ctrl_c_handler)
+
+def publish_status():
+    wattson.publish_status({device_id: loop.stats() for device_id, loop in acquisitions.items()})
+
+startup = wattson.startup
+startup.mark('app_imported')
 
 if __name__ == '__main__':
+    # Sampling starts as soon as the boards are open; the event limits,
+    # the scheduler and the web server are set up while the first samples
+    # are taken
     wattson.initialize()
-    wattson.setSystemConfig()
+    for loop in acquisitions.values():
+        loop.start()
+    with startup.phase('event_config'):
+        for device in registry:
+            wattson.setSystemConfig(sensor=device.sensor)
     resetEnergyAccumulation()
     schedule.every().day.at("00:00").do(resetEnergyAccumulation)
     scheduler.add_job(scheduled_task, 'interval', seconds=1)
+    if wattson.share_samples:
+        scheduler.add_job(publish_status, 'interval', seconds=1)
     scheduler.start()
+    startup.mark('web_server')
     app.run(host='0.0.0.0', debug=True, use_reloader=False)
 
 
@@ -0,0 +1,413 @@
+import math
+import random
+import threading
+import time
+
+import UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521 as UpbeatLabs_MCP39F521
+
+from register_reader import REGISTER_START, encode, frame
+
+
+# Hardware abstraction for the sensor, the GPIO pins and the OLED.
+#
+# The "real" backend talks to the Raspberry Pi (RPi.GPIO, Blinka SPI, the
+# SSD1306 driver and the MCP39F521 over I2C); its imports happen only when it
+# is selected, so the rest of the code can be imported on any Linux box.
+# The "simulated" backend provides stand-ins with the same interface, driven
+# by configurable load profiles and power-quality events.
+#
+#   [HARDWARE]
+#   BACKEND = real | simulated
+
+MCP = UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521
+SUCCESS = MCP.Error_code.SUCCESS.value
+
+
+class RealBackend(object):
+    name = 'real'
+
+    def __init__(self, config):
+        import RPi.GPIO as GPIO
+        self.gpio = GPIO
+
+    def create_display(self, width, height):
+        import board
+        import busio
+        import digitalio
+        import adafruit_ssd1306
+
+        # Raspberry Pi pin configuration:
+        rst = digitalio.DigitalInOut(board.D12)
+        # Note the following are only used with SPI:
+        dc = digitalio.DigitalInOut(board.D18)
+        cs = digitalio.DigitalInOut(board.D8)
+
+        spi = busio.SPI(board.SCK, MOSI=board.MOSI)
+        return adafruit_ssd1306.SSD1306_SPI(width, height, spi, dc, rst, cs)
+
+    def create_sensor(self, address, busnum=1, event_pin=None):
+        return MCP(address, busnum)
+
+
+class SimulatedGPIO(object):
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self._levels = {}
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction):
+        with self._lock:
+            self._levels.setdefault(pin, 0)
+
+    def output(self, pin, value):
+        with self._lock:
+            self._levels[pin] = 1 if value else 0
+
+    def input(self, pin):
+        with self._lock:
+            return self._levels.get(pin, 0)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self._lock:
+            self._callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._callbacks.pop(pin, None)
+
+    def cleanup(self):
+        with self._lock:
+            self._levels.clear()
+            self._callbacks.clear()
+
+    def drive(self, pin, level):
+        # Simulate an external signal on an input pin. Like RPi.GPIO, edge
+        # callbacks run on their own thread.
+        level = 1 if level else 0
+        with self._lock:
+            previous = self._levels.get(pin, 0)
+            self._levels[pin] = level
+            edge, callback = self._callbacks.get(pin, (None, None))
+        if callback is None or previous == level:
+            return
+        if edge == self.BOTH or (edge == self.RISING and level) or (edge == self.FALLING and not level):
+            threading.Thread(target=callback, args=(pin,), daemon=True).start()
+
+
+# Stand-in SSD1306 with the subset of the adafruit_ssd1306 API in use: a
+# frame buffer in the controller's page layout and a count of frames pushed
+# with show().
+class SimulatedDisplay(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.pages = height // 8
+        self.frames = 0
+        self.rotated = False
+        self.buffer = bytearray(width * self.pages)
+        self.last_image = None
+
+    def rotate(self, rotate):
+        self.rotated = not rotate
+
+    def fill(self, color):
+        self.buffer[:] = bytes([0xff if color else 0]) * len(self.buffer)
+
+    def pixel(self, x, y, color):
+        index = (y // 8) * self.width + x
+        if color:
+            self.buffer[index] |= 1 << (y % 8)
+        else:
+            self.buffer[index] &= ~(1 << (y % 8)) & 0xff
+
+    def image(self, image):
+        self.last_image = image
+
+    def show(self):
+        self.frames += 1
+
+
+# Stand-in MCP39F521 producing plausible metering data.
+#
+# Load profiles (active power over time):
+#   constant - BASE_POWER with a little noise
+#   sine     - swings between BASE_POWER and PEAK_POWER over PERIOD_S
+#   cycling  - a motor load: PEAK_POWER for a third of PERIOD_S, BASE_POWER
+#              otherwise, with an optional INRUSH times current surge for
+#              the first half second of each start
+#
+# With the default powers the load stays under the default event flag
+# limits. An INRUSH above them (5 is a realistic motor) trips over-current
+# and over-power at every start, in addition to the random power-quality
+# events (voltage sag, voltage surge, over-current) that start at random
+# with EVENT_RATE per minute, last 0.2-2 s, and set the matching
+# System_status bits against the event flag limits, exactly like the chip.
+# When wired to a SimulatedGPIO the event pin is driven as well.
+class SimulatedSensor(object):
+    EVENTS = ('sag', 'surge', 'overcurrent')
+
+    def __init__(self, address=0x74, busnum=1, profile='cycling', voltage=120.0, frequency=60.0,
+                 base_power=5.0, peak_power=12.0, period=30.0, power_factor=0.9, inrush=1.0,
+                 event_rate=0.0, error_rate=0.0, read_delay=0.0, seed=None,
+                 gpio=None, event_pin=None):
+        self._address = address
+        self._profile = profile
+        self._voltage = voltage
+        self._frequency = frequency
+        self._base_power = base_power
+        self._peak_power = peak_power
+        self._period = period
+        self._power_factor = power_factor
+        self._inrush = inrush
+        self._event_rate = event_rate
+        self._error_rate = error_rate
+        self._read_delay = read_delay
+        self._random = random.Random(seed if seed is not None else address)
+        self._gpio = gpio
+        self._event_pin = event_pin
+
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last = self._start
+        self._event = None
+        self._event_until = 0.0
+        self._pin_level = 0
+        self._event_config = 0
+        self._limits = UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_EventFlagLimits(800, 1300, 1800, 1600)
+        self._accumulating = True
+        self._active_import = 0.0
+        self._active_export = 0.0
+        self._reactive_import = 0.0
+        self._reactive_export = 0.0
+        self._power = base_power
+        self._reactive = 0.0
+        # Measurement returned by the last energy register read
+        self._latest = None
+
+    # Load model ---
+
+    def _load(self, t):
+        if self._profile == 'constant':
+            power = self._base_power
+        elif self._profile == 'sine':
+            swing = 0.5 + 0.5 * math.sin(2.0 * math.pi * t / self._period)
+            power = self._base_power + (self._peak_power - self._base_power) * swing
+        else:
+            phase = t % self._period
+            on = phase < self._period / 3.0
+            power = self._peak_power if on else self._base_power
+            if on and phase < 0.5:
+                power *= self._inrush
+        return max(0.0, power * (1.0 + self._random.gauss(0.0, 0.01)))
+
+    def _step_event(self, now):
+        if self._event is not None and now >= self._event_until:
+            self._event = None
+        if self._event is None and self._event_rate > 0:
+            elapsed = now - self._last
+            if self._random.random() < self._event_rate / 60.0 * elapsed:
+                self._event = self._random.choice(self.EVENTS)
+                self._event_until = now + self._random.uniform(0.2, 2.0)
+
+    def _status(self, voltage, current, power):
+        status = 0
+        limits = self._limits
+        if voltage * 10 < limits.voltageSagLimit:
+            status |= 1 << MCP.System_status.SYSTEM_VSAG.value
+        if voltage * 10 > limits.voltageSurgeLimit:
+            status |= 1 << MCP.System_status.SYSTEM_VSURGE.value
+        if current * 10000 > limits.overCurrentLimit:
+            status |= 1 << MCP.System_status.SYSTEM_OVERCUR.value
+        if power * 100 > limits.overPowerLimit:
+            status |= 1 << MCP.System_status.SYSTEM_OVERPOW.value
+
+        # The event bit (and pin) follows the conditions mapped to the pin
+        mapped = 0
+        for condition, pin_bit in ((MCP.System_status.SYSTEM_VSAG, MCP.Event_config.EVENT_VSAG_PIN),
+                                   (MCP.System_status.SYSTEM_VSURGE, MCP.Event_config.EVENT_VSURGE_PIN),
+                                   (MCP.System_status.SYSTEM_OVERCUR, MCP.Event_config.EVENT_OVERCUR_PIN),
+                                   (MCP.System_status.SYSTEM_OVERPOW, MCP.Event_config.EVENT_OVERPOW_PIN)):
+            if (status >> condition.value) & 1 and (self._event_config >> pin_bit.value) & 1:
+                mapped = 1
+        if mapped:
+            status |= 1 << MCP.System_status.SYSTEM_EVENT.value
+
+        status |= 1 << MCP.System_status.SYSTEM_SIGN_PA.value
+        status |= 1 << MCP.System_status.SYSTEM_SIGN_PR.value
+        return status, mapped
+
+    def _read_error(self):
+        if self._read_delay:
+            time.sleep(self._read_delay)
+        if self._error_rate and self._random.random() < self._error_rate:
+            return MCP.Error_code.ERROR_CHECKSUM_MISMATCH.value
+        return SUCCESS
+
+    # MCP39F521 interface ---
+
+    def readEnergyData(self):
+        error = self._read_error()
+        if error != SUCCESS:
+            return (error, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_Data())
+        return (SUCCESS, self._measure())
+
+    def readEnergyAccumData(self):
+        error = self._read_error()
+        if error != SUCCESS:
+            return (error, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_AccumData())
+        return (SUCCESS, self._accumulators())
+
+    # One Register Read N Bytes response frame, for the coalesced reader. A
+    # read starting at the energy registers takes a new measurement; a
+    # failed read comes back with a bad checksum.
+    def readRegisterFrame(self, address, count):
+        error = self._read_error()
+        if address == REGISTER_START or self._latest is None:
+            self._latest = self._measure()
+        image = encode(self._latest, self._accumulators())
+        start = address - REGISTER_START
+        response = frame(image[start:start + count])
+        if error != SUCCESS:
+            response = response[:-1] + bytes(((response[-1] + 1) % 256,))
+        return response
+
+    def _measure(self):
+        data = UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_Data()
+        with self._lock:
+            now = time.monotonic()
+            self._step_event(now)
+            t = now - self._start
+
+            voltage = self._voltage * (1.0 + self._random.gauss(0.0, 0.002))
+            power = self._load(t)
+            pf = self._power_factor
+            if self._event == 'sag':
+                voltage *= 0.6
+            elif self._event == 'surge':
+                voltage *= 1.15
+            current = power / (voltage * pf) if voltage > 0 else 0.0
+            if self._event == 'overcurrent':
+                current *= 4.0
+                power *= 4.0
+            apparent = voltage * current
+            reactive = math.sqrt(max(0.0, apparent * apparent - power * power))
+
+            # Integrate energy since the last read (Wh / VARh)
+            elapsed = now - self._last
+            self._last = now
+            if self._accumulating:
+                self._active_import += self._power * elapsed / 3600.0
+                self._reactive_import += self._reactive * elapsed / 3600.0
+            self._power = power
+            self._reactive = reactive
+
+            status, mapped = self._status(voltage, current, power)
+            pin_changed = mapped != self._pin_level
+            self._pin_level = mapped
+
+        data.systemStatus = status
+        data.systemVersion = 0x0104
+        data.voltageRMS = round(voltage, 1)
+        data.lineFrequency = round(self._frequency + self._random.gauss(0.0, 0.01), 3)
+        data.analogInputVoltage = 0.0
+        data.powerFactor = round(pf, 4)
+        data.currentRMS = round(current, 4)
+        data.activePower = round(power, 2)
+        data.reactivePower = round(reactive, 2)
+        data.apparentPower = round(apparent, 2)
+
+        if pin_changed and self._gpio is not None and self._event_pin is not None:
+            self._gpio.drive(self._event_pin, mapped)
+        return data
+
+    def _accumulators(self):
+        data = UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_AccumData()
+        with self._lock:
+            data.activeEnergyImport = round(self._active_import, 3)
+            data.activeEnergyExport = round(self._active_export, 3)
+            data.reactiveEnergyImport = round(self._reactive_import, 3)
+            data.reactiveEnergyExport = round(self._reactive_export, 3)
+        return data
+
+    def readEventConfigRegister(self):
+        return (SUCCESS, self._event_config)
+
+    def setEventConfigurationRegister(self, value):
+        self._event_config = value
+        return SUCCESS
+
+    def readEventFlagLimitRegisters(self):
+        limits = self._limits
+        return (SUCCESS, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521_EventFlagLimits(
+            limits.voltageSagLimit, limits.voltageSurgeLimit, limits.overCurrentLimit, limits.overPowerLimit))
+
+    def writeEventFlagLimitRegisters(self, limits):
+        self._limits = limits
+        return SUCCESS
+
+    def readAccumulationIntervalRegister(self):
+        return (SUCCESS, 5)
+
+    def isEnergyAccumulationEnabled(self):
+        return (SUCCESS, self._accumulating)
+
+    def enableEnergyAccumulation(self, enable):
+        with self._lock:
+            if not enable:
+                self._active_import = self._active_export = 0.0
+                self._reactive_import = self._reactive_export = 0.0
+            self._accumulating = bool(enable)
+        return SUCCESS
+
+
+class SimulatedBackend(object):
+    name = 'simulated'
+
+    def __init__(self, config, section='SIMULATION'):
+        self.gpio = SimulatedGPIO()
+        self._config = config
+        self._section = section
+
+    def create_display(self, width, height):
+        return SimulatedDisplay(width, height)
+
+    def create_sensor(self, address, busnum=1, event_pin=None):
+        config, section = self._config, self._section
+        seed = config.get(section, 'SEED', fallback=None)
+        return SimulatedSensor(address, busnum,
+                               profile=config.get(section, 'PROFILE', fallback='cycling'),
+                               voltage=config.getfloat(section, 'VOLTAGE', fallback=120.0),
+                               frequency=config.getfloat(section, 'FREQUENCY', fallback=60.0),
+                               base_power=config.getfloat(section, 'BASE_POWER', fallback=5.0),
+                               peak_power=config.getfloat(section, 'PEAK_POWER', fallback=12.0),
+                               period=config.getfloat(section, 'PERIOD_S', fallback=30.0),
+                               power_factor=config.getfloat(section, 'POWER_FACTOR', fallback=0.9),
+                               inrush=config.getfloat(section, 'INRUSH', fallback=1.0),
+                               event_rate=config.getfloat(section, 'EVENT_RATE', fallback=0.0),
+                               error_rate=config.getfloat(section, 'ERROR_RATE', fallback=0.0),
+                               read_delay=config.getfloat(section, 'READ_DELAY_S', fallback=0.0),
+                               seed=int(seed) + address if seed is not None else None,
+                               gpio=self.gpio, event_pin=event_pin)
+
+
+def load_backend(config, section='HARDWARE'):
+    name = config.get(section, 'BACKEND', fallback='real').strip().lower()
+    if name == 'simulated':
+        return SimulatedBackend(config)
+    if name == 'real':
+        return RealBackend(config)
+    raise ValueError(f"Unknown hardware backend: {name}")
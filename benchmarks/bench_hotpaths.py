@@ -0,0 +1,285 @@
+"""Benchmark the sampling, write and query hot paths.
+
+Runs wattson against the simulated hardware backend and a local stand-in
+InfluxDB HTTP endpoint, so it needs neither a Pi nor a database:
+
+    python benchmarks/bench_hotpaths.py --seconds 10 --output bench_results.json
+    python benchmarks/bench_hotpaths.py --compare bench_results.json
+
+Reports per-stage latency percentiles for one sampling cycle, end-to-end
+samples per second, InfluxDB write latency per batch size, and latency and
+peak Python memory of query_all_data for several ranges and windows. Results
+are written as JSON so runs from different releases can be compared.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import influx_stand_in
+
+QUERY_CASES = (
+    ('-5m', '10s'),
+    ('-1h', '20s'),
+    ('-24h', '2m'),
+    ('-7d', '10s'),
+)
+WRITE_BATCHES = (1, 50, 500)
+
+
+def percentiles(samples_ns):
+    ordered = sorted(samples_ns)
+    if not ordered:
+        return {'count': 0}
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] / 1000.0
+
+    return {
+        'count': len(ordered),
+        'mean_us': sum(ordered) / len(ordered) / 1000.0,
+        'p50_us': pick(0.50),
+        'p90_us': pick(0.90),
+        'p99_us': pick(0.99),
+        'max_us': ordered[-1] / 1000.0,
+    }
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.samples = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(name, []).append(time.perf_counter_ns() - start)
+
+    def report(self):
+        return {name: percentiles(values) for name, values in self.samples.items()}
+
+
+def write_config(directory, url):
+    with open(os.path.join(directory, 'config.ini'), 'w') as f:
+        f.write(f"""[APP]
+INFLUX_URL = {url}
+INFLUX_TOKEN = bench
+INFLUX_ORG = bench
+INFLUX_BUCKET = bench
+INFLUX_BUCKET_AUTH = bench_auth
+
+[HARDWARE]
+BACKEND = simulated
+
+[SIMULATION]
+EVENT_RATE = 6
+
+[WRITE]
+SPOOL_PATH = {os.path.join(directory, 'spool', 'wattson.lp')}
+
+[LOGGING]
+# Keeps the INFO and WARNING records of sampling and events off the terminal
+LEVEL = ERROR
+""")
+
+
+def bench_sampling(wattson, seconds):
+    from influxdb_client import Point
+    from ring_buffer import FIELDS
+
+    timer = StageTimer()
+    sensor = wattson.wattson
+    device_id = wattson.registry.default.device_id
+    deadline = time.monotonic() + seconds
+    cycles = 0
+    while time.monotonic() < deadline:
+        with timer.stage('read_energy'):
+            (ret, energyData) = sensor.readEnergyData()
+        with timer.stage('read_accum'):
+            (retA, energyAccumData) = sensor.readEnergyAccumData()
+        if ret != 0 or retA != 0:
+            continue
+        with timer.stage('read_coalesced'):
+            wattson.register_reader(sensor).read()
+        with timer.stage('power_quadrant'):
+            pq = wattson.powerQuadrant(energyData)
+        with timer.stage('build_point'):
+            point = Point("wattson_measurement").tag("device", device_id)
+            for field in FIELDS:
+                point.field(field, 1.0)
+        with timer.stage('line_protocol'):
+            point.to_line_protocol()
+        with timer.stage('submit'):
+            wattson.writer.submit(point)
+        with timer.stage('display'):
+            wattson.write_display(energyData)
+        with timer.stage('display_render'):
+            wattson.renderer.render(energyData)
+        with timer.stage('check_status'):
+            wattson.checkSystemStatus(energyData.systemStatus)
+        with timer.stage('events'):
+            wattson.events(energyData)
+        with timer.stage('cycle_total'):
+            result = wattson.read_measurements()
+            if result is not None:
+                wattson.process_measurements(device_id, result[0], result[1])
+        cycles += 1
+    report = timer.report()
+    total = timer.samples.get('cycle_total', [])
+    throughput = {
+        'cycles': cycles,
+        'samples_per_second': len(total) / (sum(total) / 1e9) if total else 0.0,
+    }
+    return report, throughput
+
+
+def bench_writes(wattson, repeat):
+    results = {}
+    line = 'wattson_measurement,device=bench ' + ','.join(f'F{i}=1.5' for i in range(13))
+    write_api = wattson.influx.write_api()
+    bucket = wattson.config.get('APP', 'INFLUX_BUCKET')
+    for size in WRITE_BATCHES:
+        lines = [line] * size
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter_ns()
+            write_api.write(bucket=bucket, record=lines)
+            samples.append(time.perf_counter_ns() - start)
+        results[str(size)] = percentiles(samples)
+    return results
+
+
+def bench_queries(wattson, repeat):
+    results = []
+    # A device with no ring buffer, so every query goes to the stand-in server
+    device_id = 'bench-remote'
+    for duration, window in QUERY_CASES:
+        for mode in ('rows', 'columnar'):
+            samples = []
+            peak = 0
+            for _ in range(repeat):
+                tracemalloc.start()
+                start = time.perf_counter_ns()
+                if mode == 'rows':
+                    body = json.dumps(wattson.query_all_data(device_id, duration, window))
+                else:
+                    body = ''.join(wattson.query_all_data_columnar(device_id, duration, window))
+                samples.append(time.perf_counter_ns() - start)
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            results.append({
+                'duration': duration,
+                'aggregateWindow': window,
+                'mode': mode,
+                'response_bytes': len(body),
+                'peak_memory_bytes': peak,
+                'latency': percentiles(samples),
+            })
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"Compared with {previous_path} ({previous['meta'].get('revision')})")
+    for name, stats in sorted(current['stages'].items()):
+        before = previous.get('stages', {}).get(name)
+        if before and before.get('p50_us'):
+            print(f"  stage {name:16s} p50 {before['p50_us']:10.1f} -> {stats['p50_us']:10.1f} us "
+                  f"({stats['p50_us'] / before['p50_us']:.2f}x)")
+    before_queries = {(q['duration'], q['aggregateWindow'], q['mode']): q for q in previous.get('queries', [])}
+    for query in current['queries']:
+        before = before_queries.get((query['duration'], query['aggregateWindow'], query['mode']))
+        if before:
+            print(f"  query {query['duration']:>5s}/{query['aggregateWindow']:<4s} {query['mode']:8s} "
+                  f"p50 {before['latency']['p50_us'] / 1000:8.1f} -> {query['latency']['p50_us'] / 1000:8.1f} ms, "
+                  f"peak {before['peak_memory_bytes'] / 1e6:7.1f} -> {query['peak_memory_bytes'] / 1e6:7.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=5.0, help='duration of the sampling benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per write and query case')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the JSON results')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    previous = os.path.abspath(args.compare) if args.compare else None
+
+    server, url = influx_stand_in.start()
+    workdir = tempfile.mkdtemp(prefix='wattson-bench-')
+    write_config(workdir, url)
+    os.chdir(workdir)
+
+    import_start = time.perf_counter()
+    import wattson
+    import_seconds = time.perf_counter() - import_start
+    init_start = time.perf_counter()
+    wattson.initialize()
+    init_seconds = time.perf_counter() - init_start
+    wattson.setSystemConfig()
+    startup = wattson.startup.stats()
+    # display_render drives the renderer directly, so keep its thread out of the way
+    wattson.renderer.stop()
+    stages, throughput = bench_sampling(wattson, args.seconds)
+    writes = bench_writes(wattson, args.repeat * 10)
+    queries = bench_queries(wattson, args.repeat)
+    wattson.cleanup()
+    server.terminate()
+
+    results = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'seconds': args.seconds,
+            'import_seconds': import_seconds,
+            'initialize_seconds': init_seconds,
+            'startup': startup,
+        },
+        'stages': stages,
+        'throughput': throughput,
+        'writes': writes,
+        'queries': queries,
+    }
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(f"Samples per second: {throughput['samples_per_second']:.1f}")
+    for name, stats in sorted(stages.items()):
+        print(f"  {name:16s} p50 {stats['p50_us']:10.1f} us  p99 {stats['p99_us']:10.1f} us")
+    for size, stats in writes.items():
+        print(f"  write x{size:<4s}      p50 {stats['p50_us']:10.1f} us  p99 {stats['p99_us']:10.1f} us")
+    for query in queries:
+        print(f"  query {query['duration']:>5s}/{query['aggregateWindow']:<4s} {query['mode']:8s} "
+              f"p50 {query['latency']['p50_us'] / 1000:8.1f} ms  peak {query['peak_memory_bytes'] / 1e6:7.1f} MB")
+    print(f"Results written to {output}")
+    if previous:
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
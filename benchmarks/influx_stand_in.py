@@ -0,0 +1,166 @@
+import json
+import multiprocessing
+import re
+import socket
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Minimal stand-in for the InfluxDB 2.x HTTP API, enough for the benchmark:
+#
+#   POST /api/v2/write  accepts line protocol and answers 204
+#   POST /api/v2/query  answers a wattson_measurement result in annotated
+#                       CSV, one row per aggregateWindow over the requested
+#                       range, like the real server would. The range,
+#                       window and fields come from the query params
+#                       (extern variables) or the query text; the result is
+#                       pivoted if the query pivots
+#
+# It runs in its own process so its allocations do not show up in the
+# benchmark's memory measurements.
+
+FIELDS = ("CurrentRMS", "VoltageRMS", "LineFrequency", "PowerFactor",
+          "ActivePower", "ReactivePower", "ApparentPower",
+          "ActiveEnergyImport", "ActiveEnergyExport",
+          "ReactiveEnergyImport", "ReactiveEnergyExport")
+
+_UNITS = {'us': 0.001, 'ms': 1, 's': 1000, 'm': 60000, 'h': 3600000, 'd': 86400000, 'w': 604800000}
+
+
+def _duration_ms(text):
+    total = 0
+    for value, unit in re.findall(r'(\d+)(ms|s|m|h|d|w)', text):
+        total += int(value) * _UNITS[unit]
+    return total
+
+
+def _extern_value(node):
+    kind = node.get('type')
+    if kind == 'UnaryExpression':
+        value = _extern_value(node['argument'])
+        return -value if node.get('operator') == '-' and value is not None else value
+    if kind == 'DurationLiteral':
+        # The Python client sends timedeltas in microseconds
+        return int(sum(value['magnitude'] * _UNITS[value['unit']] for value in node['values']))
+    if kind == 'DateTimeLiteral':
+        # Absolute times (datetime params) as epoch milliseconds
+        return int(datetime.fromisoformat(node['value'].replace('Z', '+00:00')[:26] + '+00:00').timestamp() * 1000)
+    if kind == 'ArrayExpression':
+        return [_extern_value(element) for element in node.get('elements', [])]
+    return node.get('value')
+
+
+def _externs(extern):
+    # Query params arrive as option statements in the extern file
+    params = {}
+    for statement in (extern or {}).get('body', []):
+        assignment = statement.get('assignment') or {}
+        name = (assignment.get('id') or {}).get('name')
+        if name and 'init' in assignment:
+            params[name] = _extern_value(assignment['init'])
+    return params
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_POST(self):
+        if self.path.startswith('/api/v2/write'):
+            self._body()
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path.startswith('/api/v2/query'):
+            body = json.loads(self._body() or b'{}')
+            payload = self._csv(body.get('query', ''), _externs(body.get('extern')))
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv; charset=utf-8')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    def _csv(self, query, params):
+        start = re.search(r'range\(start:\s*(-?[0-9a-z]+)', query)
+        every = re.search(r'every:\s*([0-9a-z]+)', query)
+        range_ms = _duration_ms(start.group(1)) if start else 300000
+        every_ms = _duration_ms(every.group(1)) if every else 10000
+        stop_ms = int(time.time() * 1000)
+        if isinstance(params.get('_start'), int) and params['_start'] > 0:
+            # An absolute range
+            stop_ms = params.get('_stop', stop_ms)
+            range_ms = stop_ms - params['_start']
+        else:
+            range_ms = abs(params.get('_start', range_ms))
+        every_ms = params.get('_every', every_ms)
+        fields = [field.rsplit('_', 1)[0] if field.endswith(('_mean', '_sum')) else field
+                  for field in params.get('_fields', FIELDS)]
+        fields = [field for field in fields if field in FIELDS] or list(FIELDS)
+        first = stop_ms - range_ms
+        rows = max(1, range_ms // max(1, every_ms))
+
+        if 'pivot(' not in query:
+            return self._long_csv(fields, first, every_ms, rows)
+        lines = [
+            '#datatype,string,long,string,string,unsignedLong' + ',double' * len(fields),
+            '#group,false,false,true,true,false' + ',false' * len(fields),
+            '#default,_result,,,,' + ',' * len(fields),
+            ',result,table,_measurement,device,_time,' + ','.join(fields),
+        ]
+        for i in range(rows):
+            t = (first + (i + 1) * every_ms) * 1000000
+            lines.append(',,0,wattson_measurement,wattson01,{0},{1}'.format(
+                t, ','.join('{:.4f}'.format(1.0 + (i % 100) * 0.01 * (j + 1)) for j in range(len(fields)))))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+    def _long_csv(self, fields, first, every_ms, rows):
+        # One table per field with _field/_value columns, as an unpivoted
+        # query returns
+        lines = [
+            '#datatype,string,long,string,string,string,unsignedLong,double',
+            '#group,false,false,true,true,true,false,false',
+            '#default,_result,,,,,,',
+            ',result,table,_measurement,device,_field,_time,_value',
+        ]
+        for j, field in enumerate(fields):
+            for i in range(rows):
+                t = (first + (i + 1) * every_ms) * 1000000
+                lines.append(',,{0},wattson_measurement,wattson01,{1},{2},{3:.4f}'.format(
+                    j, field, t, 1.0 + (i % 100) * 0.01 * (j + 1)))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _serve(port):
+    ThreadingHTTPServer(('127.0.0.1', port), _Handler).serve_forever()
+
+
+def start():
+    """Start the stand-in in a child process; returns (process, url)."""
+    port = _free_port()
+    process = multiprocessing.Process(target=_serve, args=(port,), daemon=True)
+    process.start()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return process, f'http://127.0.0.1:{port}'
@@ -0,0 +1,87 @@
+import queue
+import threading
+
+
+# One subscriber's bounded mailbox. When the client falls behind, the oldest
+# pending frame is discarded so the publisher never blocks on a slow reader.
+class Subscription(object):
+    def __init__(self, broadcaster, maxsize):
+        self._broadcaster = broadcaster
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def offer(self, payload):
+        while True:
+            try:
+                self._queue.put_nowait(payload)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._broadcaster.unsubscribe(self)
+
+
+# Fan-out of serialized samples to live stream clients (Server-Sent Events).
+# Each sample is serialized once by the sampler and shared by all clients.
+class SampleBroadcaster(object):
+    def __init__(self, queue_size=8):
+        self._queue_size = queue_size
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._published = 0
+        self._dropped = 0
+
+    def subscribe(self):
+        subscription = Subscription(self, self._queue_size)
+        with self._lock:
+            self._subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscribers:
+                self._subscribers.remove(subscription)
+                self._dropped += subscription.dropped
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, payload):
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._published += 1
+        for subscription in subscribers:
+            subscription.offer(payload)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': len(self._subscribers),
+                'published': self._published,
+                'dropped': self._dropped + sum(s.dropped for s in self._subscribers),
+            }
+
+    def stream(self, subscription, heartbeat=15.0):
+        # Generator of text/event-stream frames for one client. A comment
+        # line is sent when idle so proxies keep the connection open.
+        try:
+            while True:
+                payload = subscription.get(timeout=heartbeat)
+                if payload is None:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield 'data: ' + payload + '\n\n'
+        finally:
+            subscription.close()
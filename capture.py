@@ -0,0 +1,161 @@
+import threading
+from array import array
+from collections import deque
+
+import UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521 as UpbeatLabs_MCP39F521
+
+from ring_buffer import FIELDS
+
+
+CAPTURE_MEASUREMENT = "wattson_capture"
+CAPTURE_EVENT_MEASUREMENT = "wattson_capture_event"
+# Waveform fields kept per captured sample; energy counters are left out
+CAPTURE_FIELDS = ("SystemStatus", "VoltageRMS", "CurrentRMS", "LineFrequency", "PowerFactor",
+                  "ActivePower", "ReactivePower", "ApparentPower")
+_CAPTURE_INDEXES = tuple(FIELDS.index(field) for field in CAPTURE_FIELDS)
+
+# System_status bits reported as event types, named as events() names them
+_System_status = UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status
+STATUS_EVENTS = ((_System_status.SYSTEM_VSAG.value, "Voltage Sag"),
+                 (_System_status.SYSTEM_VSURGE.value, "Voltage Surge"),
+                 (_System_status.SYSTEM_OVERCUR.value, "Over Current"),
+                 (_System_status.SYSTEM_OVERPOW.value, "Over Power"))
+
+
+# One captured window around an event pin trigger: sample times as
+# millisecond offsets from the trigger, one array per field, the pin edges
+# seen during the window and the event flag limits in force.
+class CaptureRecord(object):
+    __slots__ = ('device_id', 'trigger_ms', 'limits', 'edges', 'offsets', 'columns', 'status')
+
+    def __init__(self, device_id, trigger_ms, limits):
+        self.device_id = device_id
+        self.trigger_ms = trigger_ms
+        self.limits = dict(limits)
+        self.edges = []
+        self.offsets = array('q')
+        self.columns = {field: array('d') for field in CAPTURE_FIELDS}
+        self.status = 0
+
+    @property
+    def capture_id(self):
+        return str(self.trigger_ms)
+
+    def append(self, ts_ms, values):
+        self.offsets.append(ts_ms - self.trigger_ms)
+        for field, index in zip(CAPTURE_FIELDS, _CAPTURE_INDEXES):
+            self.columns[field].append(values[index])
+        self.status |= int(values[0])
+
+    def event_types(self):
+        return [name for bit, name in STATUS_EVENTS if (self.status >> bit) & 0x01]
+
+    def summary(self):
+        return {
+            'deviceId': self.device_id,
+            'captureId': self.capture_id,
+            'trigger': self.trigger_ms,
+            'events': self.event_types(),
+            'edges': list(self.edges),
+            'limits': self.limits,
+            'samples': len(self.offsets),
+            'start': self.trigger_ms + self.offsets[0] if self.offsets else self.trigger_ms,
+            'stop': self.trigger_ms + self.offsets[-1] if self.offsets else self.trigger_ms,
+        }
+
+    def to_dict(self):
+        result = self.summary()
+        result['offsets'] = self.offsets.tolist()
+        result['fields'] = {field: column.tolist() for field, column in self.columns.items()}
+        return result
+
+    def points(self):
+        # One summary point plus one point per sample, all tagged with the
+        # capture id so a window can be read back with a single filter.
+        from influxdb_client import Point
+        points = [Point(CAPTURE_EVENT_MEASUREMENT)
+                  .tag("device", self.device_id)
+                  .tag("capture", self.capture_id)
+                  .field("events", ",".join(self.event_types()))
+                  .field("edges", ",".join(f"{offset}:{level}" for offset, level in self.edges))
+                  .field("samples", len(self.offsets))
+                  .time(self.trigger_ms * 1000000)]
+        for name, value in self.limits.items():
+            points[0].field(name, value)
+        for i, offset in enumerate(self.offsets):
+            point = Point(CAPTURE_MEASUREMENT) \
+                .tag("device", self.device_id) \
+                .tag("capture", self.capture_id) \
+                .field("offset", offset) \
+                .time((self.trigger_ms + offset) * 1000000)
+            for field in CAPTURE_FIELDS:
+                point.field(field, self.columns[field][i])
+            points.append(point)
+        return points
+
+
+# Event-triggered capture for one device.
+#
+# Every sample passes through add(), which keeps the last pre_seconds in a
+# small pre-trigger buffer. An edge on the event pin calls trigger(): the
+# pre-trigger samples are copied into a new CaptureRecord and samples keep
+# being appended until post_seconds after the last edge (or max_seconds
+# after the first, for a pin that keeps toggling), when add() returns the
+# finished record. Acquisition is sped up for the burst by the caller,
+# so the post-trigger part is recorded at the burst rate while the
+# pre-trigger part has whatever rate was in effect before the event.
+class EventCapture(object):
+    def __init__(self, device_id, limits, pre_seconds=5.0, post_seconds=5.0, max_seconds=60.0, keep=20):
+        self.device_id = device_id
+        # Shared and updated in place when the limits are reprogrammed
+        self.limits = limits
+        self._pre_ms = int(pre_seconds * 1000)
+        self._post_ms = int(post_seconds * 1000)
+        self._max_ms = int(max_seconds * 1000)
+        self._history = deque()
+        self._active = None
+        self._until_ms = 0
+        self._completed = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def trigger(self, ts_ms, level):
+        with self._lock:
+            if self._active is None:
+                record = CaptureRecord(self.device_id, ts_ms, self.limits)
+                for sample_ms, values in self._history:
+                    record.append(sample_ms, values)
+                self._active = record
+            self._active.edges.append((ts_ms - self._active.trigger_ms, int(level)))
+            self._until_ms = ts_ms + self._post_ms
+
+    def active(self):
+        return self._active is not None
+
+    def add(self, ts_ms, values):
+        with self._lock:
+            history = self._history
+            history.append((ts_ms, values))
+            while history and history[0][0] < ts_ms - self._pre_ms:
+                history.popleft()
+
+            record = self._active
+            if record is None:
+                return None
+            # Includes a sample read just before the edge but handled after it
+            record.append(ts_ms, values)
+            if ts_ms < self._until_ms and ts_ms - record.trigger_ms < self._max_ms:
+                return None
+            self._active = None
+            self._completed.append(record)
+            return record
+
+    def captures(self):
+        with self._lock:
+            return list(self._completed)
+
+    def get(self, capture_id):
+        with self._lock:
+            for record in self._completed:
+                if record.capture_id == capture_id:
+                    return record
+        return None
@@ -0,0 +1,203 @@
+import threading
+
+import UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521 as UpbeatLabs_MCP39F521
+
+from ring_buffer import FIELDS
+
+
+# Write suppression for the measurement stream.
+#
+# Each field is either compared with the last written value (deadband) or
+# run through swinging-door compression (door): the stored series, read
+# with linear interpolation between written points, stays within the
+# field's tolerance of every sample. A point is written when any field
+# leaves its tolerance, when MAX_INTERVAL_S passed since the last write
+# (heartbeat) or when an event bit is set in SystemStatus. The last
+# suppressed sample before a change or event is written too, so steps keep
+# their shape instead of turning into ramps.
+#
+# Samples still reach the ring buffer, captures and rollups uncompressed;
+# only the wattson_measurement points sent to InfluxDB are thinned out.
+DEADBAND = "deadband"
+DOOR = "door"
+MODES = (DEADBAND, DOOR)
+
+# (mode, tolerance) per field, in the units the fields are written in
+DEFAULT_TOLERANCES = {
+    "SystemStatus": (DEADBAND, 0.0),
+    "PowerQuadrant": (DEADBAND, 0.0),
+    "VoltageRMS": (DOOR, 0.5),
+    "CurrentRMS": (DOOR, 0.01),
+    "LineFrequency": (DOOR, 0.02),
+    "PowerFactor": (DOOR, 0.01),
+    "ActivePower": (DOOR, 1.0),
+    "ReactivePower": (DOOR, 1.0),
+    "ApparentPower": (DOOR, 1.0),
+    "ActiveEnergyImport": (DOOR, 1.0),
+    "ReactiveEnergyImport": (DOOR, 1.0),
+    "ActiveEnergyExport": (DOOR, 1.0),
+    "ReactiveEnergyExport": (DOOR, 1.0),
+}
+
+# System_status bits that force a write: the conditions events() reports and
+# the EVENT flag, taken from the same driver constants
+_System_status = UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status
+EVENT_BITS = (_System_status.SYSTEM_VSAG, _System_status.SYSTEM_VSURGE, _System_status.SYSTEM_OVERCUR,
+              _System_status.SYSTEM_OVERPOW, _System_status.SYSTEM_EVENT)
+EVENT_MASK = sum(1 << bit.value for bit in EVENT_BITS)
+
+_STATUS = FIELDS.index("SystemStatus")
+
+
+def parse_tolerance(text):
+    # "door 0.5", "deadband 0" or just "0.5" (swinging door)
+    parts = str(text).split()
+    if len(parts) == 1:
+        parts = [DOOR, parts[0]]
+    if len(parts) != 2 or parts[0].lower() not in MODES:
+        raise ValueError(f"Invalid compression tolerance: {text}")
+    tolerance = float(parts[1])
+    if tolerance < 0:
+        raise ValueError(f"Invalid compression tolerance: {text}")
+    return parts[0].lower(), tolerance
+
+
+def tolerances_from_config(config, section='COMPRESSION'):
+    tolerances = dict(DEFAULT_TOLERANCES)
+    if config.has_section(section):
+        # configparser lower-cases option names
+        by_option = {field.lower(): field for field in FIELDS}
+        for option, value in config.items(section):
+            field = by_option.get(option)
+            if field is not None:
+                tolerances[field] = parse_tolerance(value)
+    return tolerances
+
+
+class _Held(object):
+    __slots__ = ('ts_ms', 'values', 'point')
+
+    def __init__(self, ts_ms, values, point):
+        self.ts_ms = ts_ms
+        self.values = values
+        self.point = point
+
+
+# Compression state for one device. add() is given every sample in time
+# order and returns the points to write now: none, the sample itself, or a
+# previously held sample followed by it.
+class StreamCompressor(object):
+    def __init__(self, tolerances=None, max_interval=60.0, fields=FIELDS):
+        tolerances = tolerances if tolerances is not None else DEFAULT_TOLERANCES
+        self._fields = tuple(fields)
+        self._max_interval_ms = int(max_interval * 1000)
+        self._deadband = []
+        self._door = []
+        for i, field in enumerate(self._fields):
+            mode, tolerance = tolerances.get(field, (DEADBAND, 0.0))
+            (self._door if mode == DOOR else self._deadband).append((i, tolerance))
+        self._anchor = None
+        self._held = None
+        self._upper = [float('inf')] * len(self._door)
+        self._lower = [float('-inf')] * len(self._door)
+        self._lock = threading.Lock()
+        self.samples = 0
+        self.written = 0
+        # Written points by why they were written; 'held' is the suppressed
+        # sample written just ahead of a change
+        self.reasons = {'first': 0, 'change': 0, 'door': 0, 'heartbeat': 0, 'event': 0, 'held': 0, 'flush': 0}
+
+    def add(self, ts_ms, values, point):
+        with self._lock:
+            self.samples += 1
+            out = []
+            anchor = self._anchor
+            if anchor is None:
+                reason = 'first'
+            else:
+                held = self._held
+                # Always narrows the doors; one sample past the anchor
+                # never opens them, so there is always a held sample here
+                if self._door_opens(ts_ms, values) and held is not None:
+                    # The held sample is the last one the door still covered
+                    out.append(held.point)
+                    self.reasons['door'] += 1
+                    self._archive(held)
+                    anchor = held
+                    self._door_opens(ts_ms, values)
+                reason = self._reason(anchor, ts_ms, values)
+
+            if reason is None:
+                self._held = _Held(ts_ms, values, point)
+            else:
+                # A heartbeat falls inside the doors, so the held sample
+                # adds nothing; ahead of a step it marks where the step was
+                if self._held is not None and reason != 'heartbeat':
+                    out.append(self._held.point)
+                    self.reasons['held'] += 1
+                out.append(point)
+                self.reasons[reason] += 1
+                self._archive(_Held(ts_ms, values, point))
+            self.written += len(out)
+            return out
+
+    def flush(self):
+        # The suppressed tail, written on shutdown so the series ends where
+        # the readings did
+        with self._lock:
+            held = self._held
+            if held is None:
+                return []
+            self._archive(held)
+            self.written += 1
+            self.reasons['flush'] += 1
+            return [held.point]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'samples': self.samples,
+                'written': self.written,
+                'suppressed': self.samples - self.written,
+                'ratio': round(self.samples / self.written, 3) if self.written else None,
+                'reasons': dict(self.reasons),
+            }
+
+    def _reason(self, anchor, ts_ms, values):
+        if int(values[_STATUS]) & EVENT_MASK:
+            return 'event'
+        if ts_ms - anchor.ts_ms >= self._max_interval_ms:
+            return 'heartbeat'
+        last = anchor.values
+        for i, tolerance in self._deadband:
+            if abs(values[i] - last[i]) > tolerance:
+                return 'change'
+        return None
+
+    def _door_opens(self, ts_ms, values):
+        # Narrows each field's door to the new sample; the door opens once
+        # no line from the anchor stays within tolerance of every sample
+        anchor = self._anchor
+        dt = ts_ms - anchor.ts_ms
+        if dt <= 0:
+            return False
+        opens = False
+        upper, lower = self._upper, self._lower
+        for j, (i, tolerance) in enumerate(self._door):
+            delta = values[i] - anchor.values[i]
+            high = (delta + tolerance) / dt
+            low = (delta - tolerance) / dt
+            if high < upper[j]:
+                upper[j] = high
+            if low > lower[j]:
+                lower[j] = low
+            if lower[j] > upper[j]:
+                opens = True
+        return opens
+
+    def _archive(self, sample):
+        self._anchor = sample
+        self._held = None
+        for j in range(len(self._door)):
+            self._upper[j] = float('inf')
+            self._lower[j] = float('-inf')
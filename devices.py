@@ -0,0 +1,110 @@
+import hashlib
+
+
+DEFAULT_DEVICE_ID = "wattson01"
+DEFAULT_ADDRESS = 0x74
+DEFAULT_BUSNUM = 1
+SECTION_PREFIX = "DEVICE "
+
+
+# One published sample: the processed result, its /wattson-data JSON body
+# and an ETag for conditional requests. Never modified once created, so
+# readers can use whatever snapshot they picked up without locking.
+class Snapshot(object):
+    __slots__ = ('body', 'timestamp', 'result', 'etag')
+
+    def __init__(self, body, timestamp, result=None):
+        self.body = body
+        self.timestamp = timestamp
+        # (energyData, energyAccumData, powerQuadrant, events, timestamp)
+        self.result = result
+        self.etag = hashlib.blake2b(body, digest_size=8).hexdigest()
+
+
+# One Wattson board on the I2C bus, and the latest sample taken from it.
+class Device(object):
+    def __init__(self, device_id, address=DEFAULT_ADDRESS, busnum=DEFAULT_BUSNUM,
+                 display=False, event_pin=None):
+        self.device_id = device_id
+        self.address = address
+        self.busnum = busnum
+        self.display = display
+        self.event_pin = event_pin
+        self.sensor = None
+        # Replaced, never changed, by the sampler after every tick
+        self.snapshot = None
+
+    def publish(self, result, body):
+        # A single reference assignment: readers see the old snapshot or the
+        # new one, never a mix
+        snapshot = Snapshot(body, result[4], result)
+        self.snapshot = snapshot
+        return snapshot
+
+    def __repr__(self):
+        return "Device({0}, {1:#04x})".format(self.device_id, self.address)
+
+
+# Boards sampled by this process, from [DEVICE <id>] sections in config.ini:
+#
+#   [DEVICE wattson01]
+#   ADDRESS = 0x74
+#   DISPLAY = true
+#   EVENT_PIN = 24
+#
+# Without any such section a single board "wattson01" at 0x74 is assumed,
+# which drives the OLED and the event pin, as before.
+class DeviceRegistry(object):
+    def __init__(self, devices):
+        if not devices:
+            raise ValueError("At least one device is required")
+        self._devices = list(devices)
+        self._by_id = {device.device_id: device for device in self._devices}
+        if len(self._by_id) != len(self._devices):
+            raise ValueError("Duplicate device id")
+
+    @classmethod
+    def from_config(cls, config, default_event_pin=None):
+        devices = []
+        for section in config.sections():
+            if not section.startswith(SECTION_PREFIX):
+                continue
+            device_id = section[len(SECTION_PREFIX):].strip()
+            event_pin = config.get(section, 'EVENT_PIN', fallback=None)
+            devices.append(Device(device_id,
+                                  address=int(config.get(section, 'ADDRESS', fallback=str(DEFAULT_ADDRESS)), 0),
+                                  busnum=config.getint(section, 'BUSNUM', fallback=DEFAULT_BUSNUM),
+                                  display=config.getboolean(section, 'DISPLAY', fallback=False),
+                                  event_pin=int(event_pin) if event_pin else None))
+        if not devices:
+            devices.append(Device(DEFAULT_DEVICE_ID, display=True, event_pin=default_event_pin))
+        elif not any(device.display for device in devices):
+            # The OLED shows the first board unless one is picked explicitly
+            devices[0].display = True
+        return cls(devices)
+
+    def __iter__(self):
+        return iter(self._devices)
+
+    def __len__(self):
+        return len(self._devices)
+
+    @property
+    def default(self):
+        return self._devices[0]
+
+    def get(self, device_id=None):
+        if device_id is None:
+            return self.default
+        return self._by_id.get(device_id)
+
+    def ids(self):
+        return [device.device_id for device in self._devices]
+
+    def event_pins(self):
+        return sorted({device.event_pin for device in self._devices if device.event_pin is not None})
+
+    def open(self, sensor_factory):
+        for device in self._devices:
+            if device.sensor is None:
+                device.sensor = sensor_factory(device.address, device.busnum, event_pin=device.event_pin)
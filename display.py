@@ -0,0 +1,193 @@
+import logging
+import threading
+import time
+
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageFont
+
+import metrics
+from register_reader import as_dict
+
+
+logger = logging.getLogger(__name__)
+
+render_seconds = metrics.histogram('wattson_display_render_seconds', 'Time to draw and push one OLED frame')
+frames = metrics.counter('wattson_display_frames_total', 'Display refreshes by outcome', ('result',))
+frames_drawn = frames.labels('drawn')
+frames_unchanged = frames.labels('unchanged')
+frames_superseded = metrics.counter('wattson_display_superseded_total',
+                                    'Samples replaced by a newer one before they were drawn')
+
+PADDING = 2
+LINE_HEIGHT = 10
+SEPARATOR = '--------------------'
+
+# SSD1306 memory is organised in pages of eight rows, one byte per column
+# with the top row in the low bit
+PAGE_HEIGHT = 8
+SET_COL_ADDR = 0x21
+SET_PAGE_ADDR = 0x22
+
+
+def pack_pages(image):
+    """Packs a 1-bit image whose height is a multiple of PAGE_HEIGHT into
+    SSD1306 page bytes."""
+    packed = bytearray()
+    for top in range(0, image.height, PAGE_HEIGHT):
+        page = image.crop((0, top, image.width, top + PAGE_HEIGHT))
+        # Each column becomes one row of eight pixels, bottom row first, so
+        # tobytes() yields one byte per column with the top row in bit 0
+        packed += page.transpose(Image.Transpose.FLIP_TOP_BOTTOM).transpose(Image.Transpose.TRANSPOSE).tobytes()
+    return packed
+
+
+def push_pages(disp, first, last):
+    """Sends pages first..last of the frame buffer to the controller; other
+    drivers than adafruit_ssd1306's SPI one get a full show()."""
+    spi_device = getattr(disp, 'spi_device', None)
+    if spi_device is None or not hasattr(disp, 'write_cmd'):
+        disp.show()
+        return
+    # Same column window as show(); narrower panels are centred
+    col = (128 - disp.width) // 2 if disp.width != 128 else 0
+    for cmd in (SET_COL_ADDR, col, col + disp.width - 1, SET_PAGE_ADDR, first, last):
+        disp.write_cmd(cmd)
+    disp.dc_pin.value = 1
+    with spi_device as spi:
+        spi.write(disp.buffer, start=first * disp.width, end=(last + 1) * disp.width)
+
+
+def format_lines(result):
+    return (
+        "{:.2f} V | {:.2f} Hz".format(result.voltageRMS, result.lineFrequency),
+        "{:.4f} A | PF: {:.2f}".format(result.currentRMS, result.powerFactor),
+        SEPARATOR,
+        "{:.2f} W".format(result.activePower),
+        "{:.2f} VAR".format(result.reactivePower),
+        "{:.2f} VA".format(result.apparentPower),
+    )
+
+
+# Draws the latest sample on the SSD1306 OLED from its own thread.
+#
+# The sampler only hands over its newest reading; a sample that is replaced
+# before the renderer gets to it is never drawn. Frames are limited to
+# refresh_hz, independent of the sampling rate. Only text lines whose
+# formatted value changed are rasterized; they are packed straight into the
+# controller's page layout and only the pages they cover are sent over SPI,
+# instead of setting pixels one at a time and pushing the whole frame. The
+# 180 degree mounting is applied once at setup (in the controller when it
+# supports it, otherwise by flipping the frame before it is packed).
+class DisplayRenderer(object):
+    def __init__(self, disp, refresh_hz=2.0, rotate_180=True):
+        if refresh_hz <= 0:
+            raise ValueError("refresh_hz must be positive")
+        self._disp = disp
+        self._interval = 1.0 / refresh_hz
+        self._rotate_180 = rotate_180
+        self._font = ImageFont.load_default()
+        self._strip = Image.new('1', (disp.width, LINE_HEIGHT))
+        self._strip_draw = ImageDraw.Draw(self._strip)
+        self._frame = Image.new('1', (disp.width, disp.height))
+        self._flip = False
+        self._lines = [None] * 6
+        self._latest = None
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, disp, config, section='DISPLAY'):
+        return cls(disp,
+                   refresh_hz=config.getfloat(section, 'REFRESH_HZ', fallback=2.0),
+                   rotate_180=config.getboolean(section, 'ROTATE_180', fallback=True))
+
+    def setup(self):
+        disp = self._disp
+        if self._rotate_180:
+            if hasattr(disp, 'rotate'):
+                # The controller's power-on scan direction is rotate(True)
+                disp.rotate(False)
+            else:
+                self._flip = True
+        self.clear()
+
+    def clear(self):
+        self._disp.fill(0)
+        self._disp.show()
+        self._frame.paste(0, (0, 0, self._frame.width, self._frame.height))
+        self._lines = [None] * len(self._lines)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.setup()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='display', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def update(self, result):
+        with self._cond:
+            if self._latest is not None:
+                frames_superseded.inc()
+            self._latest = result
+            self._cond.notify()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._cond:
+                while self._latest is None and not self._stop.is_set():
+                    self._cond.wait()
+                result, self._latest = self._latest, None
+            if result is None:
+                break
+            started = time.monotonic()
+            try:
+                self.render(result)
+            except Exception:
+                logger.exception("Display update failed for %s", as_dict(result))
+            # Samples arriving during this pause replace each other
+            self._stop.wait(max(0.0, self._interval - (time.monotonic() - started)))
+
+    def render(self, result):
+        start = time.perf_counter()
+        lines = format_lines(result)
+        changed = [i for i, text in enumerate(lines) if text != self._lines[i]]
+        if not changed:
+            frames_unchanged.inc()
+            return
+        for i in changed:
+            self._draw_line(i, lines[i])
+            self._lines[i] = lines[i]
+        self._push(PADDING + changed[0] * LINE_HEIGHT, PADDING + (changed[-1] + 1) * LINE_HEIGHT)
+        frames_drawn.inc()
+        render_seconds.observe(time.perf_counter() - start)
+
+    def _draw_line(self, index, text):
+        # Drawn on a strip first so tall glyphs cannot spill into the next line
+        self._strip_draw.rectangle((0, 0, self._strip.width, LINE_HEIGHT), outline=0, fill=0)
+        self._strip_draw.text((PADDING, 0), text, font=self._font, fill=255)
+        self._frame.paste(self._strip, (0, PADDING + index * LINE_HEIGHT))
+
+    def _push(self, top, bottom):
+        # Rows top..bottom changed; repack and send the pages covering them
+        disp = self._disp
+        frame = self._frame
+        if self._flip:
+            frame = frame.rotate(180)
+            top, bottom = frame.height - bottom, frame.height - top
+        first, last = top // PAGE_HEIGHT, (bottom - 1) // PAGE_HEIGHT
+        packed = pack_pages(frame.crop((0, first * PAGE_HEIGHT, frame.width, (last + 1) * PAGE_HEIGHT)))
+        # The I2C driver keeps a control byte in front of the frame buffer
+        offset = len(disp.buffer) - disp.pages * disp.width + first * disp.width
+        disp.buffer[offset:offset + len(packed)] = packed
+        push_pages(disp, first, last)
@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# UpbeatLabs_MCP39F521_AccumData attributes, in ledger order
+ACCUM_FIELDS = ("activeEnergyImport", "activeEnergyExport", "reactiveEnergyImport", "reactiveEnergyExport")
+TOTAL_FIELDS = ("ActiveEnergyImportTotal", "ActiveEnergyExportTotal", "ReactiveEnergyImportTotal", "ReactiveEnergyExportTotal")
+
+
+class _Account(object):
+    __slots__ = ('totals', 'last', 'updated_ms')
+
+    def __init__(self, totals=None, last=None, updated_ms=0):
+        self.totals = list(totals) if totals is not None else [0.0] * len(ACCUM_FIELDS)
+        self.last = list(last) if last is not None else None
+        self.updated_ms = updated_ms
+
+
+# Software energy counters that keep counting across the nightly
+# accumulator reset, service restarts and chip power loss.
+#
+# Every sample folds the increase of each chip accumulator since the
+# previous reading into a running total. A reading lower than the previous
+# one means the chip was reset, and counts from zero. The last chip reading
+# is persisted with the totals, so energy accumulated while the service was
+# down is picked up on the first reading after a restart.
+#
+# Checkpoints are appended to a JSON-lines file at most every
+# checkpoint_interval seconds per device; once compact_records have been
+# appended the file is rewritten with only the latest record per device.
+class EnergyLedger(object):
+    def __init__(self, path='ledger/energy.jsonl', checkpoint_interval=60.0, compact_records=1000):
+        self._path = path
+        self._checkpoint_interval = checkpoint_interval
+        self._compact_records = compact_records
+        self._accounts = {}
+        self._next_checkpoint = {}
+        self._records = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def from_config(cls, config, section='LEDGER'):
+        return cls(path=config.get(section, 'PATH', fallback='ledger/energy.jsonl'),
+                   checkpoint_interval=config.getfloat(section, 'CHECKPOINT_S', fallback=60.0),
+                   compact_records=config.getint(section, 'COMPACT_RECORDS', fallback=1000))
+
+    def fold(self, device_id, accumData, ts_ms):
+        readings = [getattr(accumData, field) for field in ACCUM_FIELDS]
+        with self._lock:
+            account = self._accounts.get(device_id)
+            if account is None:
+                account = self._accounts[device_id] = _Account()
+            if account.last is not None:
+                for i, (reading, last) in enumerate(zip(readings, account.last)):
+                    account.totals[i] += reading - last if reading >= last else reading
+            account.last = readings
+            account.updated_ms = ts_ms
+            totals = tuple(account.totals)
+            due = time.monotonic() >= self._next_checkpoint.get(device_id, 0.0)
+            if due:
+                self._next_checkpoint[device_id] = time.monotonic() + self._checkpoint_interval
+                record = self._record(device_id, account)
+        if due:
+            self._append([record])
+        return totals
+
+    def totals(self, device_id):
+        with self._lock:
+            account = self._accounts.get(device_id)
+            if account is None:
+                return None
+            return dict(zip(TOTAL_FIELDS, account.totals), updated=account.updated_ms)
+
+    def checkpoint(self):
+        with self._lock:
+            records = [self._record(device_id, account) for device_id, account in self._accounts.items()]
+        if records:
+            self._append(records)
+
+    @staticmethod
+    def _record(device_id, account):
+        return json.dumps({'device': device_id, 'time': account.updated_ms,
+                           'totals': account.totals, 'last': account.last}) + '\n'
+
+    def _append(self, records):
+        try:
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self._path, 'a') as f:
+                f.write(''.join(records))
+                f.flush()
+                os.fsync(f.fileno())
+            with self._lock:
+                self._records += len(records)
+                compact = self._records >= self._compact_records
+            if compact:
+                self._compact()
+        except OSError as e:
+            logger.error("Energy ledger checkpoint failed: %s", e)
+
+    def _compact(self):
+        with self._lock:
+            records = [self._record(device_id, account) for device_id, account in self._accounts.items()]
+            tmp = self._path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(''.join(records))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._path)
+            self._records = len(records)
+
+    def _load(self):
+        try:
+            with open(self._path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Torn last line from a crash mid-append
+                continue
+            self._accounts[record['device']] = _Account(record['totals'], record.get('last'), record.get('time', 0))
+        self._records = len(lines)
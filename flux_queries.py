@@ -0,0 +1,261 @@
+from datetime import datetime, timedelta, timezone
+
+from capture import CAPTURE_EVENT_MEASUREMENT, CAPTURE_MEASUREMENT
+from ring_buffer import FIELDS, parse_duration_ms
+from rollups import ROLLUP_MEASUREMENT
+
+
+# Validated, parameterized Flux for the queries the app sends to InfluxDB.
+#
+# Request values never reach the query text. The device id, range, window
+# and field list travel as query params, which the client sends as extern
+# Flux variables (_device, _start, _every, _fields), so the text only
+# depends on the shape of the query: raw or rollup measurement, pivoted or
+# not. Each shape is built once and reused. Ranges and windows must be one
+# of the allowed values and fields must be measurement fields, so a bad
+# request fails here in microseconds instead of after a round trip to
+# InfluxDB.
+DEFAULT_DURATIONS = "-5m,-15m,-30m,-1h,-3h,-6h,-12h,-24h,-2d,-7d,-30d"
+DEFAULT_WINDOWS = "10s,20s,30s,1m,2m,5m,10m,15m,30m,1h"
+DEFAULT_MAX_POINTS = 100000
+MAX_DEVICE_ID = 64
+
+
+class QueryError(ValueError):
+    pass
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def flux_time(ms):
+    # Epoch milliseconds as a datetime param (a Flux time literal)
+    return EPOCH + timedelta(milliseconds=ms)
+
+
+def flux_string(value):
+    # A Flux string literal, for the few values baked into templates
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('${', '\\${') + '"'
+
+
+def _parse_allowed(text, negative):
+    allowed = {}
+    for name in str(text).split(','):
+        name = name.strip()
+        if not name:
+            continue
+        ms = parse_duration_ms(name)
+        if ms is None:
+            raise ValueError(f"Invalid duration: {name}")
+        allowed[ms] = ('-' if negative else '') + name.lstrip('-')
+    return allowed
+
+
+class QueryBuilder(object):
+    def __init__(self, bucket, durations=DEFAULT_DURATIONS, windows=DEFAULT_WINDOWS, max_points=DEFAULT_MAX_POINTS,
+                 auth_bucket=None):
+        self._bucket = bucket
+        self._auth_bucket = auth_bucket
+        # {milliseconds: canonical literal}
+        self._durations = _parse_allowed(durations, negative=True)
+        self._windows = _parse_allowed(windows, negative=False)
+        self._max_points = max_points
+        self._templates = {}
+
+    @classmethod
+    def from_config(cls, config, section='QUERY'):
+        return cls(config.get('APP', 'INFLUX_BUCKET', fallback=''),
+                   durations=config.get(section, 'DURATIONS', fallback=DEFAULT_DURATIONS),
+                   windows=config.get(section, 'WINDOWS', fallback=DEFAULT_WINDOWS),
+                   max_points=config.getint(section, 'MAX_POINTS', fallback=DEFAULT_MAX_POINTS),
+                   auth_bucket=config.get('APP', 'INFLUX_BUCKET_AUTH', fallback=None))
+
+    def duration(self, value):
+        # "-1h", "1h" and "-60m" all normalize to "-1h"
+        ms = parse_duration_ms(value)
+        if ms is None or ms not in self._durations:
+            raise QueryError(f"duration must be one of {', '.join(self._durations.values())}")
+        return self._durations[ms]
+
+    def window(self, value):
+        ms = parse_duration_ms(value)
+        if ms is None or ms not in self._windows:
+            raise QueryError(f"aggregateWindow must be one of {', '.join(self._windows.values())}")
+        return self._windows[ms]
+
+    def fields(self, value, default=FIELDS):
+        # A comma-separated string or a sequence; duplicates are dropped
+        if value is None or value == '':
+            return tuple(default)
+        names = value.split(',') if isinstance(value, str) else value
+        result = []
+        for name in names:
+            name = name.strip()
+            if name not in FIELDS:
+                raise QueryError(f"Unknown field: {name}")
+            if name not in result:
+                result.append(name)
+        return tuple(result)
+
+    def field(self, value):
+        if value not in FIELDS:
+            raise QueryError(f"Unknown field: {value}")
+        return value
+
+    def device(self, value):
+        device_id = str(value)
+        if not device_id or len(device_id) > MAX_DEVICE_ID or not device_id.isprintable():
+            raise QueryError("Invalid device_id")
+        return device_id
+
+    def validate(self, duration, aggregateWindow, fields=None, default_fields=FIELDS):
+        duration = self.duration(duration)
+        aggregateWindow = self.window(aggregateWindow)
+        if parse_duration_ms(duration) // parse_duration_ms(aggregateWindow) > self._max_points:
+            raise QueryError(f"More than {self._max_points} windows; use a longer aggregateWindow")
+        return duration, aggregateWindow, self.fields(fields, default_fields)
+
+    def window_means(self, device_id, duration, aggregateWindow, fields, tier=None, pivot=True):
+        """(flux, params) for the mean of each field per aggregateWindow over
+        the last duration. With a rollup tier, the tier's <Field>_sum series
+        are summed and divided by the summed sample counts instead, so
+        buckets holding more samples weigh more, as in the raw mean."""
+        duration, aggregateWindow, fields = self.validate(duration, aggregateWindow, fields)
+        if tier is not None:
+            fields = [field + '_sum' for field in fields]
+        params = {
+            '_device': self.device(device_id),
+            '_start': timedelta(milliseconds=-parse_duration_ms(duration)),
+            '_every': timedelta(milliseconds=parse_duration_ms(aggregateWindow)),
+            '_fields': list(fields),
+        }
+        return self._template(tier, pivot), params
+
+    def device_auth(self, device_id):
+        # (flux, params) for the latest deviceauth fields of a device, less
+        # its token
+        return self._cached('device_auth', lambda: '\n'.join([
+            f'from(bucket: {flux_string(self._auth_bucket)})',
+            '  |> range(start: 0)',
+            '  |> filter(fn: (r) => r._measurement == "deviceauth" and r.deviceId == _device and r._field != "token")',
+            '  |> last()',
+        ])), {'_device': self.device(device_id)}
+
+    def latest_environment(self, device_id):
+        return self._cached('latest_environment', lambda: '\n'.join([
+            f'from(bucket: {flux_string(self._bucket)})',
+            '  |> range(start: 0)',
+            '  |> filter(fn: (r) => r._measurement == "environment" and r.device == _device)',
+            '  |> last()',
+        ])), {'_device': self.device(device_id)}
+
+    def capture_summaries(self, device_id, duration):
+        # Capture summaries of the last duration, newest first
+        return self._cached('capture_summaries', lambda: self._capture_summaries('start: _start', '')), {
+            '_device': self.device(device_id),
+            '_start': timedelta(milliseconds=-parse_duration_ms(self.duration(duration))),
+        }
+
+    def capture_summary(self, device_id, trigger_ms):
+        # The summary point is stamped with the trigger time
+        trigger_ms = self.trigger(trigger_ms)
+        return self._cached('capture_summary', lambda: self._capture_summaries(
+            'start: _start, stop: _stop', ' and r.capture == _capture')), {
+            '_device': self.device(device_id),
+            '_start': flux_time(trigger_ms),
+            '_stop': flux_time(trigger_ms + 1),
+            '_capture': str(trigger_ms),
+        }
+
+    def capture_samples(self, device_id, trigger_ms):
+        # Samples of one capture, oldest first; no capture spans an hour
+        trigger_ms = self.trigger(trigger_ms)
+        return self._cached('capture_samples', lambda: '\n'.join([
+            f'from(bucket: {flux_string(self._bucket)})',
+            '  |> range(start: _start)',
+            f'  |> filter(fn: (r) => r._measurement == {flux_string(CAPTURE_MEASUREMENT)} and r.device == _device and r.capture == _capture)',
+            '  |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")',
+            '  |> sort(columns: ["_time"])',
+        ])), {
+            '_device': self.device(device_id),
+            '_start': flux_time(trigger_ms - 3600000),
+            '_capture': str(trigger_ms),
+        }
+
+    def day_series(self, device_id, start_ms, stop_ms):
+        # One pivoted row per sample for analytics. The range starts a
+        # minute early so the first energy delta of the day is not lost.
+        return self._cached('day_series', lambda: '\n'.join([
+            f'from(bucket: {flux_string(self._bucket)})',
+            '  |> range(start: _start, stop: _stop)',
+            '  |> filter(fn: (r) => r._measurement == "wattson_measurement" and r.device == _device)',
+            '  |> filter(fn: (r) => r._field == "ActivePower" or r._field == "PowerFactor" or '
+            'r._field == "ActiveEnergyImport" or r._field == "PowerQuadrant")',
+            '  |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")',
+            '  |> group()',
+            '  |> sort(columns: ["_time"])',
+            '  |> map(fn: (r) => ({t: uint(v: r._time), p: r.ActivePower, pf: r.PowerFactor, '
+            'e: r.ActiveEnergyImport, q: r.PowerQuadrant}))',
+        ])), {
+            '_device': self.device(device_id),
+            '_start': flux_time(start_ms - 60000),
+            '_stop': flux_time(stop_ms),
+        }
+
+    def trigger(self, value):
+        # A capture id: the trigger time in epoch milliseconds
+        text = str(value)
+        if not text.isdigit() or len(text) > 16:
+            raise QueryError("id must be a capture id")
+        return int(text)
+
+    def _capture_summaries(self, flux_range, capture_filter):
+        return '\n'.join([
+            f'from(bucket: {flux_string(self._bucket)})',
+            f'  |> range({flux_range})',
+            f'  |> filter(fn: (r) => r._measurement == {flux_string(CAPTURE_EVENT_MEASUREMENT)} and r.device == _device{capture_filter})',
+            '  |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")',
+            '  |> sort(columns: ["_time"], desc: true)',
+        ])
+
+    def _cached(self, key, build):
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = build()
+        return template
+
+    def _template(self, tier, pivot):
+        return self._cached((tier, pivot), lambda: self._build(tier, pivot))
+
+    def _build(self, tier, pivot):
+        lines = []
+        if tier is None:
+            lines.append(f'from(bucket: {flux_string(self._bucket)})')
+            lines.append('  |> range(start: _start)')
+            lines.append('  |> filter(fn: (r) => r._measurement == "wattson_measurement" and r.device == _device)')
+            lines.append('  |> filter(fn: (r) => contains(value: r._field, set: _fields))')
+            lines.append('  |> aggregateWindow(every: _every, fn: mean)')
+        else:
+            # sum(<Field>_sum) / sum(count) per window; every bucket carries
+            # its sample count, so the windowed counts join one to one
+            measurement = ROLLUP_MEASUREMENT.format(tier)
+            lines.append('import "strings"')
+            lines.append(f'buckets = from(bucket: {flux_string(self._bucket)})')
+            lines.append('  |> range(start: _start)')
+            lines.append(f'  |> filter(fn: (r) => r._measurement == {flux_string(measurement)} and r.device == _device)')
+            lines.append('sums = buckets')
+            lines.append('  |> filter(fn: (r) => contains(value: r._field, set: _fields))')
+            lines.append('  |> aggregateWindow(every: _every, fn: sum)')
+            lines.append('counts = buckets')
+            lines.append('  |> filter(fn: (r) => r._field == "count")')
+            lines.append('  |> aggregateWindow(every: _every, fn: sum)')
+            lines.append('join(tables: {s: sums, c: counts}, on: ["_time", "_start", "_stop", "_measurement", "device"])')
+            lines.append('  |> map(fn: (r) => ({_time: r._time, _start: r._start, _stop: r._stop, '
+                         '_measurement: r._measurement, device: r.device, '
+                         '_field: strings.trimSuffix(v: r._field_s, suffix: "_sum"), '
+                         '_value: if exists r._value_c and r._value_c > 0 then r._value_s / float(v: r._value_c) else r._value_s}))')
+            lines.append('  |> group(columns: ["_measurement", "device", "_field"])')
+        lines.append('  |> map(fn: (r) => ({ r with _time: uint(v: r._time) }))')
+        if pivot:
+            lines.append('  |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")')
+        return '\n'.join(lines)
@@ -0,0 +1,92 @@
+import threading
+
+
+# A single long-lived InfluxDBClient shared by the sampler and the Flask
+# request threads. The underlying urllib3 PoolManager keeps HTTP connections
+# alive between calls, so the 1 Hz write loop and the dashboard queries no
+# longer pay TCP/TLS setup cost on every call.
+#
+# influxdb_client takes longer to import than anything else the sampler
+# uses, so it is imported when the first client is created rather than
+# when this module is.
+class InfluxClientManager(object):
+    def __init__(self, config, section='APP'):
+        self._config = config
+        self._section = section
+        self._lock = threading.Lock()
+        self._client = None
+        self._write_api = None
+        self._query_api = None
+        self._created = 0
+        self._reused = 0
+
+    def _create_client(self):
+        from influxdb_client import InfluxDBClient
+        pool_size = self._config.getint(self._section, 'INFLUX_POOL_SIZE', fallback=4)
+        timeout = self._config.getint(self._section, 'INFLUX_TIMEOUT_MS', fallback=10000)
+        client = InfluxDBClient(url=self._config.get(self._section, 'INFLUX_URL'),
+                                token=self._config.get(self._section, 'INFLUX_TOKEN'),
+                                org=self._config.get(self._section, 'INFLUX_ORG'),
+                                timeout=timeout,
+                                connection_pool_maxsize=pool_size)
+        self._created += 1
+        return client
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self._create_client()
+            else:
+                self._reused += 1
+            return self._client
+
+    def write_api(self):
+        client = self.client()
+        with self._lock:
+            if self._write_api is None:
+                from influxdb_client.client.write_api import SYNCHRONOUS
+                self._write_api = client.write_api(write_options=SYNCHRONOUS)
+            return self._write_api
+
+    def query_api(self):
+        client = self.client()
+        with self._lock:
+            if self._query_api is None:
+                from influxdb_client.client.query_api import QueryApi
+                self._query_api = QueryApi(client)
+            return self._query_api
+
+    def stats(self):
+        with self._lock:
+            result = {
+                'clients_created': self._created,
+                'reuse_count': self._reused,
+                'open_connections': 0,
+                'connections_created': 0,
+                'requests': 0,
+                'pools': 0,
+            }
+            if self._client is None:
+                return result
+            pool_manager = self._client.api_client.rest_client.pool_manager
+            for key in list(pool_manager.pools.keys()):
+                pool = pool_manager.pools.get(key)
+                if pool is None:
+                    continue
+                result['pools'] += 1
+                # Idle keep-alive connections parked in the pool, ready for reuse
+                if pool.pool is not None:
+                    result['open_connections'] += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+                result['connections_created'] += pool.num_connections
+                result['requests'] += pool.num_requests
+            return result
+
+    def close(self):
+        with self._lock:
+            if self._write_api is not None:
+                self._write_api.close()
+                self._write_api = None
+            self._query_api = None
+            if self._client is not None:
+                self._client.close()
+                self._client = None
@@ -0,0 +1,119 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+
+DEFAULT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+LEVELS_SECTION = 'LOG LEVELS'
+
+_listener = None
+
+
+# One JSON object per line, for journald/log shippers that parse fields.
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+# Lets the first occurrence of a warning or error through and suppresses
+# repeats of the same message (logger + format string) for `interval`
+# seconds. The next one let through reports how many were suppressed, so a
+# bus fault at 10 Hz produces one line a minute instead of 600.
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval=60.0, level=logging.WARNING):
+        super().__init__()
+        self._interval = interval
+        self._level = level
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self._level or self._interval <= 0:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is not None and now - entry[0] < self._interval:
+                entry[1] += 1
+                return False
+            suppressed = entry[1] if entry is not None else 0
+            self._seen[key] = [now, 0]
+        if suppressed:
+            record.msg = f"{record.msg} (suppressed {suppressed} similar messages)"
+        return True
+
+
+# Hands records to the background listener without ever blocking the
+# caller; when the queue is full the record is dropped and counted.
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Logging for the monitor, configured from config.ini:
+#
+#   [LOGGING]
+#   LEVEL = INFO
+#   FORMAT = text
+#   RATE_LIMIT_S = 60
+#   QUEUE_SIZE = 10000
+#
+#   [LOG LEVELS]
+#   wattson = DEBUG
+#
+# Formatting and output happen on a listener thread; the sampling and
+# request threads only pay for the level check and an enqueue.
+def configure(config, section='LOGGING'):
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler()
+    if config.get(section, 'FORMAT', fallback='text').lower() == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter(DEFAULT_FORMAT))
+
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=config.getint(section, 'QUEUE_SIZE', fallback=10000)))
+    handler.addFilter(RateLimitFilter(config.getfloat(section, 'RATE_LIMIT_S', fallback=60.0)))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(config.get(section, 'LEVEL', fallback='INFO').upper())
+    if config.has_section(LEVELS_SECTION):
+        for name, level in config.items(LEVELS_SECTION):
+            logging.getLogger(name).setLevel(level.upper())
+
+    _listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+    return _listener
+
+
+def shutdown():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Flight(object):
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+# Response cache for the dashboard query endpoints.
+#
+# Entries are serialized response bodies (bytes), so the memory cap is exact
+# and a hit costs no re-serialization. Eviction is LRU once the cap is
+# reached. Concurrent misses for the same key are coalesced: the first caller
+# runs the query, the others wait for its result (single flight).
+class QueryCache(object):
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0,
+            'errors': 0,
+        }
+
+    def get_or_compute(self, key, ttl, compute):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, body = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return body
+                self._remove(key)
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._stats['coalesced'] += 1
+                leader = False
+            else:
+                flight = _Flight()
+                self._flights[key] = flight
+                self._stats['misses'] += 1
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            body = compute()
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self._stats['errors'] += 1
+                del self._flights[key]
+            flight.done.set()
+            raise
+
+        with self._lock:
+            del self._flights[key]
+            self._store(key, ttl, body)
+        flight.value = body
+        flight.done.set()
+        return body
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key, ttl, body):
+        with self._lock:
+            self._store(key, ttl, body)
+
+    def _store(self, key, ttl, body):
+        if key in self._entries:
+            self._remove(key)
+        if len(body) > self._max_bytes:
+            return
+        self._entries[key] = (time.monotonic() + ttl, body)
+        self._bytes += len(body)
+        while self._bytes > self._max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._stats['evictions'] += 1
+
+    def _remove(self, key):
+        _, body = self._entries.pop(key)
+        self._bytes -= len(body)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['entries'] = len(self._entries)
+            result['bytes'] = self._bytes
+            result['max_bytes'] = self._max_bytes
+        lookups = result['hits'] + result['misses'] + result['coalesced']
+        result['hit_ratio'] = (result['hits'] + result['coalesced']) / lookups if lookups else 0.0
+        return result
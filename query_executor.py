@@ -0,0 +1,233 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+queue_seconds = metrics.histogram('wattson_query_queue_seconds', 'Time InfluxDB queries waited for a query slot')
+influx_seconds = metrics.histogram('wattson_query_influx_seconds', 'Time InfluxDB queries ran, including reading the response')
+outcomes = metrics.counter('wattson_query_outcomes_total', 'InfluxDB queries by outcome', ('outcome',))
+
+
+# Items a streaming query may run ahead of its consumer
+STREAM_BUFFER = 64
+_END = object()
+
+
+class QueryRejected(Exception):
+    # Every slot is taken; the caller should answer 503 at once
+    pass
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class QueryJob(object):
+    __slots__ = ('deadline', 'submitted', 'cancelled')
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.submitted = time.monotonic()
+        self.cancelled = threading.Event()
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self):
+        # Called by the query between records; stops reading a response
+        # nobody is waiting for
+        if self.cancelled.is_set() or time.monotonic() >= self.deadline:
+            raise QueryTimeout("Query cancelled after its deadline")
+
+
+# Bounded executor for the InfluxDB side of the dashboard queries.
+#
+# Request threads hand the query to one of MAX_CONCURRENT worker threads
+# and wait for it until the request's deadline. At most MAX_QUEUED more may
+# wait for a worker; past that a request is rejected immediately instead of
+# piling up behind a slow InfluxDB. When the deadline passes, a query that
+# has not started is dropped, and a running one is cancelled at its next
+# record (the HTTP read itself is bounded by INFLUX_TIMEOUT_MS). Its worker
+# stays taken until then, so the limit is honest. Time spent waiting for a
+# worker and time spent in InfluxDB are measured separately.
+#
+# Ranges the ring buffer covers never come here, so the live view keeps
+# working while a long historical query runs.
+class QueryExecutor(object):
+    def __init__(self, max_concurrent=2, max_queued=4, timeout=10.0):
+        self._max_concurrent = max_concurrent
+        self._max_queued = max_queued
+        self._timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_concurrent + max_queued)
+        self._pool = None
+        self._lock = threading.Lock()
+        self._running = 0
+        self._waiting = 0
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            # Deadline passed while waiting for a worker; never sent
+            'expired': 0,
+            # Deadline passed while running; cancelled at the next record
+            'timed_out': 0,
+            'max_queue_ms': 0.0,
+            'total_queue_ms': 0.0,
+            'max_influx_ms': 0.0,
+            'total_influx_ms': 0.0,
+        }
+
+    @classmethod
+    def from_config(cls, config, section='QUERY'):
+        return cls(max_concurrent=config.getint(section, 'MAX_CONCURRENT', fallback=2),
+                   max_queued=config.getint(section, 'MAX_QUEUED', fallback=4),
+                   timeout=config.getfloat(section, 'TIMEOUT_S', fallback=10.0))
+
+    def run(self, query, timeout=None):
+        """Runs query(job) on a worker and returns its result. Raises
+        QueryRejected when saturated and QueryTimeout after the deadline;
+        errors from the query itself are re-raised."""
+        job, future = self._submit(query, timeout)
+        try:
+            return future.result(timeout=job.remaining())
+        except FutureTimeout:
+            self._expire(job, future)
+            raise QueryTimeout("Query did not finish within its deadline")
+
+    def stream(self, query, timeout=None):
+        """Runs query(job, emit) on a worker and yields each item it emits
+        as soon as it is emitted. Admission, deadline and errors are as for
+        run(); closing the generator (a client that went away) cancels the
+        query."""
+        items = queue.Queue(maxsize=STREAM_BUFFER)
+
+        def emit(item):
+            # Waits for a slow consumer, but not past the deadline
+            while True:
+                job.check()
+                try:
+                    items.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce(job):
+            query(job, emit)
+            emit(_END)
+        job, future = self._submit(produce, timeout)
+        try:
+            while True:
+                try:
+                    item = items.get(timeout=min(0.1, job.remaining()))
+                except queue.Empty:
+                    if future.done():
+                        # Failed before emitting the end
+                        future.result()
+                    if job.remaining() <= 0:
+                        self._expire(job, future)
+                        raise QueryTimeout("Query did not finish within its deadline")
+                    continue
+                if item is _END:
+                    break
+                yield item
+        except BaseException:
+            # Includes GeneratorExit when the response is closed early
+            job.cancelled.set()
+            raise
+
+    def _submit(self, query, timeout):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            outcomes.labels('rejected').inc()
+            raise QueryRejected("Too many queries in flight; try again shortly")
+        job = QueryJob(time.monotonic() + (self._timeout if timeout is None else timeout))
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._waiting += 1
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self._max_concurrent, thread_name_prefix='influx-query')
+            future = self._pool.submit(self._call, job, query)
+        future.add_done_callback(self._release)
+        return job, future
+
+    def _expire(self, job, future):
+        job.cancelled.set()
+        if future.cancel():
+            waited = time.monotonic() - job.submitted
+            queue_seconds.observe(waited)
+            with self._lock:
+                self._waiting -= 1
+                self._stats['expired'] += 1
+                self._stats['total_queue_ms'] += waited * 1000
+                self._stats['max_queue_ms'] = max(self._stats['max_queue_ms'], waited * 1000)
+            outcomes.labels('expired').inc()
+
+    def _release(self, future):
+        self._slots.release()
+
+    def _call(self, job, query):
+        started = time.monotonic()
+        waited = started - job.submitted
+        queue_seconds.observe(waited)
+        with self._lock:
+            self._waiting -= 1
+            self._stats['total_queue_ms'] += waited * 1000
+            self._stats['max_queue_ms'] = max(self._stats['max_queue_ms'], waited * 1000)
+            expired = job.cancelled.is_set() or started >= job.deadline
+            if expired:
+                self._stats['expired'] += 1
+            else:
+                self._running += 1
+        if expired:
+            outcomes.labels('expired').inc()
+            raise QueryTimeout("Query expired while waiting for a worker")
+        outcome = 'failed'
+        try:
+            result = query(job)
+            outcome = 'completed'
+            return result
+        except QueryTimeout:
+            outcome = 'timed_out'
+            raise
+        finally:
+            ran = time.monotonic() - started
+            influx_seconds.observe(ran)
+            if job.cancelled.is_set():
+                # Finished or failed after the caller gave up
+                outcome = 'timed_out'
+            with self._lock:
+                self._running -= 1
+                self._stats[outcome] += 1
+                self._stats['total_influx_ms'] += ran * 1000
+                self._stats['max_influx_ms'] = max(self._stats['max_influx_ms'], ran * 1000)
+            outcomes.labels(outcome).inc()
+            if outcome == 'timed_out':
+                logger.warning("InfluxDB query abandoned after %.1f s (waited %.1f s)", ran, waited)
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['running'] = self._running
+            result['waiting'] = self._waiting
+        result['max_concurrent'] = self._max_concurrent
+        result['max_queued'] = self._max_queued
+        result['timeout_s'] = self._timeout
+        ran = result['completed'] + result['failed'] + result['timed_out']
+        started = ran + result['expired']
+        result['avg_queue_ms'] = result['total_queue_ms'] / started if started else 0.0
+        result['avg_influx_ms'] = result['total_influx_ms'] / ran if ran else 0.0
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,261 @@
+import logging
+import struct
+import threading
+import time
+
+from energy_ledger import ACCUM_FIELDS
+
+
+logger = logging.getLogger(__name__)
+
+# Coalesced MCP39F521 measurement reads.
+#
+# The library reads one sample in three Register Read N Bytes transactions:
+# 28 bytes of energy data at 0x0002, then the active and the reactive
+# accumulators (16 bytes each at 0x001e and 0x002e). Each transaction
+# sleeps 50 ms, plus another 50 ms between the two accumulator reads.
+# Failures are reported per call, and the first accumulator error is lost.
+#
+# The registers from 0x0002 to 0x003d are contiguous. Here they are read in
+# as few transactions as max_read_bytes allows, split on register
+# boundaries: two at 32 bytes (28 bytes of energy data, then all four
+# accumulators), one at 60. The frames are decoded with one struct unpack
+# into __slots__ records. A transaction that fails with a NAK, a checksum
+# error or a bus error is retried with exponential backoff, and only the
+# failed block is read again.
+REGISTER_START = 0x0002
+
+# (name, struct code) of each register from REGISTER_START, in address order
+REGISTERS = (
+    ('systemStatus', 'H'), ('systemVersion', 'H'), ('voltageRMS', 'H'), ('lineFrequency', 'H'),
+    ('analogInputVoltage', 'H'), ('powerFactor', 'h'), ('currentRMS', 'I'), ('activePower', 'I'),
+    ('reactivePower', 'I'), ('apparentPower', 'I'),
+    ('activeEnergyImport', 'Q'), ('activeEnergyExport', 'Q'),
+    ('reactiveEnergyImport', 'Q'), ('reactiveEnergyExport', 'Q'),
+)
+LAYOUT = struct.Struct('<' + ''.join(code for _, code in REGISTERS))
+ENERGY_FIELDS = tuple(name for name, _ in REGISTERS if name not in ACCUM_FIELDS)
+
+HEADER = 0xa5
+ACK = 0x06
+NAK = 0x15
+CSFAIL = 0x51
+COMMAND_SET_ADDRESS_POINTER = 0x41
+COMMAND_REGISTER_READ_N_BYTES = 0x4e
+
+DEFAULT_MAX_READ_BYTES = 32
+
+
+class EnergyData(object):
+    __slots__ = ENERGY_FIELDS
+
+    def __init__(self, systemStatus, systemVersion, voltageRMS, lineFrequency, analogInputVoltage,
+                 powerFactor, currentRMS, activePower, reactivePower, apparentPower):
+        self.systemStatus = systemStatus
+        self.systemVersion = systemVersion
+        self.voltageRMS = voltageRMS
+        self.lineFrequency = lineFrequency
+        self.analogInputVoltage = analogInputVoltage
+        self.powerFactor = powerFactor
+        self.currentRMS = currentRMS
+        self.activePower = activePower
+        self.reactivePower = reactivePower
+        self.apparentPower = apparentPower
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in ENERGY_FIELDS}
+
+
+class AccumData(object):
+    __slots__ = ACCUM_FIELDS
+
+    def __init__(self, activeEnergyImport, activeEnergyExport, reactiveEnergyImport, reactiveEnergyExport):
+        self.activeEnergyImport = activeEnergyImport
+        self.activeEnergyExport = activeEnergyExport
+        self.reactiveEnergyImport = reactiveEnergyImport
+        self.reactiveEnergyExport = reactiveEnergyExport
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in ACCUM_FIELDS}
+
+
+def as_dict(data):
+    # Attributes of a record above or of a library data object
+    if isinstance(data, (EnergyData, AccumData)):
+        return data.as_dict()
+    return vars(data)
+
+
+def plan_blocks(max_read_bytes=DEFAULT_MAX_READ_BYTES):
+    # [(address, count)] covering all registers, no read longer than
+    # max_read_bytes and no register split across two reads
+    largest = max(struct.calcsize(code) for _, code in REGISTERS)
+    if max_read_bytes < largest:
+        raise ValueError(f"max_read_bytes must be at least {largest}")
+    blocks = []
+    address, count = REGISTER_START, 0
+    for _, code in REGISTERS:
+        size = struct.calcsize(code)
+        if count + size > max_read_bytes:
+            blocks.append((address, count))
+            address, count = address + count, 0
+        count += size
+    blocks.append((address, count))
+    return blocks
+
+
+def accum_scale(sensor):
+    # The library's workaround for accumulation intervals other than 2
+    factor = getattr(sensor, '_energy_accum_correction_factor', 0)
+    return 0.5 / 1000.0 if factor == -1 else (1 << factor) / 1000.0
+
+
+def decode(image, scale):
+    (status, version, voltage, frequency, analog, pf, current, active, reactive, apparent,
+     active_import, active_export, reactive_import, reactive_export) = LAYOUT.unpack_from(image)
+    # Signed Q15; the library ignores the four low bits
+    energy = EnergyData(status, version, voltage / 10.0, frequency / 1000.0, analog / 1023.0 * 3.3,
+                        (pf & -16) / 32768.0, current / 10000.0, active / 100.0, reactive / 100.0, apparent / 100.0)
+    accum = AccumData(active_import * scale, active_export * scale, reactive_import * scale, reactive_export * scale)
+    return energy, accum
+
+
+def encode(energy, accum, scale=1 / 1000.0):
+    # The register image decode() reads, for simulated boards
+    return LAYOUT.pack(int(energy.systemStatus), int(energy.systemVersion),
+                       int(round(energy.voltageRMS * 10)), int(round(energy.lineFrequency * 1000)),
+                       int(round(energy.analogInputVoltage / 3.3 * 1023)),
+                       max(-32768, min(32767, int(round(energy.powerFactor * 32768)))),
+                       int(round(energy.currentRMS * 10000)), int(round(energy.activePower * 100)),
+                       int(round(energy.reactivePower * 100)), int(round(energy.apparentPower * 100)),
+                       *(int(round(getattr(accum, name) / scale)) for name in ACCUM_FIELDS))
+
+
+def frame(data):
+    # A Register Read N Bytes response: ACK, length, data, checksum
+    response = bytearray((ACK, len(data) + 3)) + data
+    response.append(sum(response) % 256)
+    return bytes(response)
+
+
+def _request(address, count):
+    request = [HEADER, 0x08, COMMAND_SET_ADDRESS_POINTER, address >> 8, address & 0xff,
+               COMMAND_REGISTER_READ_N_BYTES, count]
+    request.append(sum(request) % 256)
+    return request
+
+
+def _transfer(sensor, address, count, settle):
+    # One transaction; the raw response frame
+    read_frame = getattr(sensor, 'readRegisterFrame', None)
+    if read_frame is not None:
+        # Simulated boards
+        return read_frame(address, count)
+    from smbus2 import i2c_msg
+    sensor._bus.i2c_rdwr(i2c_msg.write(sensor._address, _request(address, count)))
+    time.sleep(settle)
+    read = i2c_msg.read(sensor._address, count + 3)
+    sensor._bus.i2c_rdwr(read)
+    return bytes(read)
+
+
+def check_frame(response, count):
+    # None if the frame is good, otherwise the error name
+    if len(response) != count + 3:
+        return 'length'
+    if response[0] == NAK:
+        return 'nak'
+    if response[0] == CSFAIL:
+        return 'csfail'
+    if response[0] != ACK:
+        return 'header'
+    if sum(response[:-1]) % 256 != response[-1]:
+        return 'checksum'
+    return None
+
+
+# Reads samples from one board. read() returns (EnergyData, AccumData), or
+# None when a block still failed after its retries.
+class RegisterReader(object):
+    def __init__(self, sensor, max_read_bytes=DEFAULT_MAX_READ_BYTES, retries=2, backoff=0.005, settle=0.05):
+        self._sensor = sensor
+        self._blocks = plan_blocks(max_read_bytes)
+        self._retries = retries
+        self._backoff = backoff
+        self._settle = settle
+        self._image = bytearray(LAYOUT.size)
+        self._lock = threading.Lock()
+        self._stats = {
+            'samples': 0,
+            'complete': 0,
+            # Some blocks read, others failed after all retries
+            'partial': 0,
+            'failed': 0,
+            'transactions': 0,
+            'retries': 0,
+            # Blocks that succeeded on a retry
+            'recovered': 0,
+            'errors': {},
+        }
+
+    @classmethod
+    def from_config(cls, sensor, config, section='SAMPLING'):
+        return cls(sensor,
+                   max_read_bytes=config.getint(section, 'MAX_READ_BYTES', fallback=DEFAULT_MAX_READ_BYTES),
+                   retries=config.getint(section, 'READ_RETRIES', fallback=2),
+                   backoff=config.getfloat(section, 'RETRY_BACKOFF_MS', fallback=5.0) / 1000.0,
+                   settle=config.getfloat(section, 'SETTLE_MS', fallback=50.0) / 1000.0)
+
+    @property
+    def blocks(self):
+        return list(self._blocks)
+
+    def read(self):
+        with self._lock:
+            image = self._image
+            ok = 0
+            for address, count in self._blocks:
+                data = self._read_block(address, count)
+                if data is None:
+                    continue
+                offset = address - REGISTER_START
+                image[offset:offset + count] = data
+                ok += 1
+            stats = self._stats
+            stats['samples'] += 1
+            if ok == len(self._blocks):
+                stats['complete'] += 1
+                # enableEnergyAccumulation() can change the correction
+                # factor (the nightly reset), so it is not cached
+                return decode(image, accum_scale(self._sensor))
+            stats['partial' if ok else 'failed'] += 1
+            return None
+
+    def _read_block(self, address, count):
+        stats = self._stats
+        for attempt in range(self._retries + 1):
+            if attempt:
+                stats['retries'] += 1
+                time.sleep(self._backoff * (1 << (attempt - 1)))
+            stats['transactions'] += 1
+            try:
+                response = _transfer(self._sensor, address, count, self._settle)
+                error = check_frame(response, count)
+            except OSError as e:
+                # NAK or arbitration loss on the bus itself
+                logger.debug("Register read at %#06x failed: %s", address, e)
+                error = 'bus'
+            if error is None:
+                if attempt:
+                    stats['recovered'] += 1
+                return response[2:-1]
+            stats['errors'][error] = stats['errors'].get(error, 0) + 1
+        logger.error("Register read at %#06x failed after %d attempts: %s", address, self._retries + 1, error)
+        return None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['errors'] = dict(stats['errors'])
+        stats['blocks'] = [f'{address:#06x}+{count}' for address, count in self._blocks]
+        return stats
@@ -0,0 +1,154 @@
+import re
+import threading
+from array import array
+from bisect import bisect_left
+
+
+# Fields written for every wattson_measurement point, in storage order.
+FIELDS = (
+    "SystemStatus",
+    "PowerQuadrant",
+    "VoltageRMS",
+    "CurrentRMS",
+    "LineFrequency",
+    "PowerFactor",
+    "ActivePower",
+    "ReactivePower",
+    "ApparentPower",
+    "ActiveEnergyImport",
+    "ReactiveEnergyImport",
+    "ActiveEnergyExport",
+    "ReactiveEnergyExport",
+)
+
+_DURATION_UNITS = {
+    'ms': 1,
+    's': 1000,
+    'm': 60 * 1000,
+    'h': 60 * 60 * 1000,
+    'd': 24 * 60 * 60 * 1000,
+    'w': 7 * 24 * 60 * 60 * 1000,
+}
+_DURATION_PART = re.compile(r'(\d+)(ms|s|m|h|d|w)')
+
+
+def parse_duration_ms(duration):
+    """Parse a Flux duration literal such as "-5m", "10s" or "1h30m" into
+    milliseconds. The sign is ignored. Returns None for anything else (e.g.
+    calendar units like "1mo" or absolute timestamps)."""
+    text = str(duration).strip().lstrip('-')
+    if not text:
+        return None
+    total = 0
+    pos = 0
+    for match in _DURATION_PART.finditer(text):
+        if match.start() != pos:
+            return None
+        total += int(match.group(1)) * _DURATION_UNITS[match.group(2)]
+        pos = match.end()
+    if pos != len(text) or total <= 0:
+        return None
+    return total
+
+
+# Fixed-size, array-backed ring buffer of recent samples for one device.
+# Each field is stored as its own array('d') column and the timestamps (ms
+# since epoch) as an array('q'), so an hour at 10 Hz is a few MB rather than
+# tens of thousands of dicts.
+class SampleRingBuffer(object):
+    def __init__(self, capacity, fields=FIELDS):
+        self._capacity = capacity
+        self._fields = tuple(fields)
+        self._times = array('q', bytes(8 * capacity))
+        self._columns = [array('d', bytes(8 * capacity)) for _ in self._fields]
+        self._head = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def fields(self):
+        return self._fields
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp_ms, values):
+        # values must be given in the same order as fields
+        with self._lock:
+            i = self._head
+            self._times[i] = timestamp_ms
+            for column, value in zip(self._columns, values):
+                column[i] = value
+            self._head = (i + 1) % self._capacity
+            if self._count < self._capacity:
+                self._count += 1
+
+    def oldest(self):
+        with self._lock:
+            if self._count == 0:
+                return None
+            return self._times[(self._head - self._count) % self._capacity]
+
+    def covers(self, start_ms, slack_ms=0):
+        oldest = self.oldest()
+        return oldest is not None and oldest <= start_ms + slack_ms
+
+    def _snapshot(self, start_ms, indexes):
+        # Copy out, in time order, the samples at or after start_ms.
+        with self._lock:
+            if self._count < self._capacity:
+                times = self._times[:self._count]
+                columns = [self._columns[i][:self._count] for i in indexes]
+            else:
+                h = self._head
+                times = self._times[h:] + self._times[:h]
+                columns = [self._columns[i][h:] + self._columns[i][:h] for i in indexes]
+        first = bisect_left(times, start_ms)
+        if first:
+            times = times[first:]
+            columns = [column[first:] for column in columns]
+        return times, columns
+
+    def window_means(self, start_ms, stop_ms, every_ms, fields=None):
+        """Mean of each field over windows aligned to the epoch, mirroring
+        Flux aggregateWindow(every: ..., fn: mean) on range(start, stop):
+        the first and last windows are truncated to the range, each window
+        is stamped with its stop time, and empty windows yield None.
+
+        Returns (stops, {field: [mean or None, ...]})."""
+        if fields is None:
+            fields = self._fields
+        indexes = [self._fields.index(f) for f in fields]
+        times, columns = self._snapshot(start_ms, indexes)
+
+        first_stop = (start_ms // every_ms + 1) * every_ms
+        stops = []
+        boundary = first_stop
+        while boundary < stop_ms:
+            stops.append(boundary)
+            boundary += every_ms
+        stops.append(stop_ms)
+
+        n = len(stops)
+        slots = []
+        for t in times:
+            if t >= stop_ms:
+                slots.append(-1)
+            elif t < first_stop:
+                slots.append(0)
+            else:
+                slots.append((t - first_stop) // every_ms + 1)
+
+        counts = [0] * n
+        for slot in slots:
+            if slot >= 0:
+                counts[slot] += 1
+
+        result = {}
+        for field, column in zip(fields, columns):
+            sums = [0.0] * n
+            for slot, value in zip(slots, column):
+                if slot >= 0:
+                    sums[slot] += value
+            result[field] = [sums[i] / counts[i] if counts[i] else None for i in range(n)]
+        return stops, result
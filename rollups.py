@@ -0,0 +1,156 @@
+from datetime import timedelta
+
+from ring_buffer import FIELDS, parse_duration_ms
+
+
+# Pre-aggregated (rollup) series for long-range dashboard views.
+#
+# Every sample is folded into the open bucket of each tier (e.g. 1m, 15m, 1h).
+# When a sample lands past a bucket's end, the finished bucket is emitted as
+# one point in the "wattson_rollup_<tier>" measurement, stamped with the
+# bucket start and carrying <Field>_mean, _sum, _min, _max and _last for
+# every measurement field plus the sample count. Coarser windows are
+# averaged as sum(<Field>_sum) / sum(count), so partial buckets (around
+# restarts, gaps or capture bursts) weigh what their samples weigh.
+ROLLUP_MEASUREMENT = "wattson_rollup_{}"
+ROLLUP_FUNCTIONS = ("mean", "sum", "min", "max", "last")
+DEFAULT_TIERS = "1m,15m,1h"
+
+
+def parse_tiers(text):
+    tiers = []
+    for name in str(text).split(','):
+        name = name.strip()
+        if not name:
+            continue
+        ms = parse_duration_ms(name)
+        if ms is None:
+            raise ValueError(f"Invalid rollup tier: {name}")
+        tiers.append((name, ms))
+    return sorted(tiers, key=lambda tier: tier[1])
+
+
+def pick_tier(every_ms, tiers):
+    """Coarsest tier whose bucket evenly divides the requested window, so
+    aggregating its buckets reproduces the window boundaries exactly."""
+    best = None
+    for name, ms in tiers:
+        if ms <= every_ms and every_ms % ms == 0:
+            best = (name, ms)
+    return best
+
+
+class _Bucket(object):
+    __slots__ = ('start', 'count', 'sums', 'mins', 'maxs', 'lasts')
+
+    def __init__(self, start, values):
+        self.start = start
+        self.count = 1
+        self.sums = list(values)
+        self.mins = list(values)
+        self.maxs = list(values)
+        self.lasts = list(values)
+
+    def add(self, values):
+        self.count += 1
+        sums, mins, maxs = self.sums, self.mins, self.maxs
+        for i, value in enumerate(values):
+            sums[i] += value
+            if value < mins[i]:
+                mins[i] = value
+            if value > maxs[i]:
+                maxs[i] = value
+        self.lasts = list(values)
+
+
+class RollupAggregator(object):
+    def __init__(self, device_id, tiers, fields=FIELDS):
+        self._device_id = device_id
+        self._tiers = tiers
+        self._fields = tuple(fields)
+        self._open = {name: None for name, _ in tiers}
+        self.emitted = 0
+
+    def add(self, timestamp_ms, values):
+        # values are given in the same order as fields. Returns the points
+        # for any buckets this sample closed.
+        points = []
+        for name, ms in self._tiers:
+            start = timestamp_ms - timestamp_ms % ms
+            bucket = self._open[name]
+            if bucket is not None and bucket.start == start:
+                bucket.add(values)
+                continue
+            if bucket is not None:
+                points.append(self._to_point(name, bucket))
+            self._open[name] = _Bucket(start, values)
+        self.emitted += len(points)
+        return points
+
+    def _to_point(self, name, bucket):
+        from influxdb_client import Point
+        point = Point(ROLLUP_MEASUREMENT.format(name)).tag("device", self._device_id)
+        for i, field in enumerate(self._fields):
+            point.field(field + "_mean", bucket.sums[i] / bucket.count)
+            # Always a float, also for the integer status fields, so the
+            # query can divide it by the count
+            point.field(field + "_sum", float(bucket.sums[i]))
+            point.field(field + "_min", bucket.mins[i])
+            point.field(field + "_max", bucket.maxs[i])
+            point.field(field + "_last", bucket.lasts[i])
+        point.field("count", bucket.count)
+        # Nanosecond timestamps, matching the write path's default precision
+        return point.time(bucket.start * 1000000)
+
+
+def backfill_queries(bucket, device_id, tier, start):
+    """(flux, params) statements that compute one rollup tier server-side
+    from the raw wattson_measurement series, for history recorded before
+    rollups were enabled. Returns one query per aggregate function and one
+    for the sample count; the device and start ("-30d") are passed as
+    params."""
+    start_ms = parse_duration_ms(start)
+    if start_ms is None or not str(start).startswith('-'):
+        raise ValueError(f"start must be a negative duration such as -30d, not {start}")
+    if parse_duration_ms(tier) is None:
+        raise ValueError(f"Invalid tier: {tier}")
+    params = {'_device': str(device_id), '_start': timedelta(milliseconds=-start_ms)}
+    bucket = str(bucket).replace('\\', '\\\\').replace('"', '\\"')
+    source = (f'from(bucket: "{bucket}") '
+              f'|> range(start: _start) '
+              f'|> filter(fn: (r) => r._measurement == "wattson_measurement" and r.device == _device) ')
+    measurement = ROLLUP_MEASUREMENT.format(tier)
+    queries = []
+    for fn in ROLLUP_FUNCTIONS:
+        # Sums are floats, as RollupAggregator writes them
+        value = ', _value: float(v: r._value)' if fn == 'sum' else ''
+        queries.append((
+            source +
+            f'|> aggregateWindow(every: {tier}, fn: {fn}, createEmpty: false, timeSrc: "_start") '
+            f'|> map(fn: (r) => ({{ r with _measurement: "{measurement}", _field: r._field + "_{fn}"{value} }})) '
+            f'|> to(bucket: "{bucket}")', params))
+    # Every point carries all fields, so one field's count is the sample count
+    queries.append((
+        source +
+        f'|> filter(fn: (r) => r._field == "ActivePower") '
+        f'|> aggregateWindow(every: {tier}, fn: count, createEmpty: false, timeSrc: "_start") '
+        f'|> map(fn: (r) => ({{ r with _measurement: "{measurement}", _field: "count" }})) '
+        f'|> to(bucket: "{bucket}")', params))
+    return queries
+
+
+if __name__ == '__main__':
+    # python rollups.py <device_id> <start>, e.g. python rollups.py wattson01 -30d
+    import configparser
+    import sys
+    from influx_pool import InfluxClientManager
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    influx = InfluxClientManager(config)
+    bucket = config.get('APP', 'INFLUX_BUCKET')
+    for tier, _ in parse_tiers(config.get('ROLLUP', 'TIERS', fallback=DEFAULT_TIERS)):
+        for query, params in backfill_queries(bucket, sys.argv[1], tier, sys.argv[2]):
+            print(f"Backfilling {tier}: {query}")
+            influx.query_api().query(query, params=params)
+    influx.close()
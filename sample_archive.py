@@ -0,0 +1,413 @@
+import logging
+import os
+import re
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+
+from ring_buffer import FIELDS, parse_duration_ms
+
+
+logger = logging.getLogger(__name__)
+
+# Local archive of every sample, for sites whose backhaul to InfluxDB comes
+# and goes.
+#
+# Samples are appended as fixed-width binary records to one file per board
+# and UTC day, archive/<device>/<YYYY-MM-DD>.bin: a 64-byte header, then
+# records of the sample time in ms and the thirteen measurement fields
+# (status and quadrant as integers, the instantaneous values as float32,
+# the energy accumulators as float64), 76 bytes in all, against ~400 bytes
+# of line protocol. A sidecar .idx file holds (time, record number) for
+# every INDEX_EVERY-th record, so a time range is found by a search in the
+# index and then in one block of records.
+#
+# Reading maps the files with numpy.memmap and returns slices of the
+# mapping, so scanning or re-aggregating a month of 1 Hz samples never
+# copies the records it does not use. numpy is imported only to read; the
+# sampler only packs and appends.
+MAGIC = b'WATTARC1'
+VERSION = 1
+HEADER = struct.Struct('<8sHHHHq')
+HEADER_SIZE = 64
+DAY_MS = 86400000
+
+# Record layout; the order matches FIELDS
+INT_FIELDS = FIELDS[:2]
+FLOAT32_FIELDS = FIELDS[2:9]
+FLOAT64_FIELDS = FIELDS[9:]
+RECORD = struct.Struct('<q' + 'I' * len(INT_FIELDS) + 'f' * len(FLOAT32_FIELDS) + 'd' * len(FLOAT64_FIELDS))
+INDEX_ENTRY = struct.Struct('<qq')
+
+DEFAULT_INDEX_EVERY = 1024
+
+
+def record_dtype():
+    import numpy as np
+    return np.dtype([('time', '<i8')] + [(field, '<u4') for field in INT_FIELDS] +
+                    [(field, '<f4') for field in FLOAT32_FIELDS] + [(field, '<f8') for field in FLOAT64_FIELDS])
+
+
+def index_dtype():
+    import numpy as np
+    return np.dtype([('time', '<i8'), ('record', '<i8')])
+
+
+def day_name(day):
+    # UTC day number to file stem
+    return datetime.fromtimestamp(day * DAY_MS / 1000, timezone.utc).date().isoformat()
+
+
+def device_directory(device_id):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(device_id))
+
+
+def parse_time(text, now_ms=None):
+    """Milliseconds since the epoch from "-7d" (before now), a number of
+    milliseconds, or an ISO date or time (UTC unless it says otherwise)."""
+    text = str(text).strip()
+    if now_ms is None:
+        now_ms = int(time.time() * 1000)
+    if text == 'now':
+        return now_ms
+    if text.startswith('-'):
+        ms = parse_duration_ms(text)
+        if ms is None:
+            raise ValueError(f"Invalid duration: {text}")
+        return now_ms - ms
+    if text.isdigit():
+        return int(text)
+    moment = datetime.fromisoformat(text)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+class _DayFile(object):
+    __slots__ = ('day', 'data', 'index', 'index_every', 'count', 'last_ms')
+
+    def __init__(self, day, data, index, index_every, count, last_ms):
+        self.day = day
+        self.data = data
+        self.index = index
+        self.index_every = index_every
+        self.count = count
+        self.last_ms = last_ms
+
+
+class SampleArchive(object):
+    def __init__(self, path='archive', index_every=DEFAULT_INDEX_EVERY, flush_interval=5.0, keep_days=0):
+        self._path = path
+        self._index_every = index_every
+        self._flush_interval = flush_interval
+        # Day files older than this are deleted at each day change; 0 keeps all
+        self._keep_days = keep_days
+        self._open = {}
+        self._next_flush = 0.0
+        self._lock = threading.Lock()
+        self._stats = {'records': 0, 'out_of_order': 0, 'files_opened': 0, 'files_pruned': 0, 'errors': 0}
+
+    @classmethod
+    def from_config(cls, config, section='ARCHIVE'):
+        return cls(path=config.get(section, 'PATH', fallback='archive'),
+                   index_every=config.getint(section, 'INDEX_EVERY', fallback=DEFAULT_INDEX_EVERY),
+                   flush_interval=config.getfloat(section, 'FLUSH_INTERVAL_S', fallback=5.0),
+                   keep_days=config.getint(section, 'KEEP_DAYS', fallback=0))
+
+    # Writing ---
+
+    def append(self, device_id, ts_ms, values):
+        with self._lock:
+            try:
+                day_file = self._day_file(device_id, ts_ms // DAY_MS)
+                if ts_ms < day_file.last_ms:
+                    # The clock stepped back; keep the file sorted
+                    self._stats['out_of_order'] += 1
+                    return
+                if day_file.count % day_file.index_every == 0:
+                    day_file.index.write(INDEX_ENTRY.pack(ts_ms, day_file.count))
+                day_file.data.write(RECORD.pack(ts_ms, *values))
+                day_file.count += 1
+                day_file.last_ms = ts_ms
+                self._stats['records'] += 1
+                now = time.monotonic()
+                if now >= self._next_flush:
+                    self._next_flush = now + self._flush_interval
+                    self._flush()
+            except (OSError, struct.error) as e:
+                self._stats['errors'] += 1
+                logger.error("Archive append failed for %s: %s", device_id, e)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            for day_file in self._open.values():
+                day_file.data.close()
+                day_file.index.close()
+            self._open.clear()
+
+    def _flush(self):
+        for day_file in self._open.values():
+            day_file.data.flush()
+            day_file.index.flush()
+
+    def _day_file(self, device_id, day):
+        day_file = self._open.get(device_id)
+        if day_file is not None and day_file.day == day:
+            return day_file
+        if day_file is not None:
+            day_file.data.close()
+            day_file.index.close()
+            self._prune(device_id, day)
+        day_file = self._open[device_id] = self._open_day(device_id, day)
+        self._stats['files_opened'] += 1
+        return day_file
+
+    def _open_day(self, device_id, day):
+        directory = os.path.join(self._path, device_directory(device_id))
+        os.makedirs(directory, exist_ok=True)
+        data_path = os.path.join(directory, day_name(day) + '.bin')
+        index_path = os.path.join(directory, day_name(day) + '.idx')
+        try:
+            size = os.path.getsize(data_path)
+        except FileNotFoundError:
+            size = 0
+        if size < HEADER_SIZE:
+            with open(data_path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, len(FIELDS), self._index_every,
+                                    day * DAY_MS).ljust(HEADER_SIZE, b'\0'))
+            with open(index_path, 'wb'):
+                pass
+            return _DayFile(day, open(data_path, 'ab'), open(index_path, 'ab'), self._index_every, 0, 0)
+
+        header = read_header(data_path)
+        count = (size - HEADER_SIZE) // RECORD.size
+        if size != HEADER_SIZE + count * RECORD.size:
+            # A record torn by a crash mid-write
+            os.truncate(data_path, HEADER_SIZE + count * RECORD.size)
+        # A file keeps the index spacing it was created with
+        index_every = header['index_every']
+        times = _record_times(data_path, count, index_every)
+        last_ms = _record_times(data_path, count, 1, first=count - 1)[0][0] if count else 0
+        # Rewritten from the records, which are the truth after a crash
+        with open(index_path, 'wb') as f:
+            f.write(b''.join(INDEX_ENTRY.pack(t, record) for t, record in times))
+        return _DayFile(day, open(data_path, 'ab'), open(index_path, 'ab'), index_every, count, last_ms)
+
+    def _prune(self, device_id, today):
+        if self._keep_days <= 0:
+            return
+        directory = os.path.join(self._path, device_directory(device_id))
+        oldest = day_name(today - self._keep_days + 1)
+        for name in sorted(os.listdir(directory)):
+            stem, _, extension = name.partition('.')
+            if extension in ('bin', 'idx') and stem < oldest:
+                os.remove(os.path.join(directory, name))
+                if extension == 'bin':
+                    self._stats['files_pruned'] += 1
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['open'] = {device_id: {'day': day_name(day_file.day), 'records': day_file.count}
+                              for device_id, day_file in self._open.items()}
+        return result
+
+    # Reading ---
+
+    def days(self, device_id):
+        directory = os.path.join(self._path, device_directory(device_id))
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-4] for name in names if name.endswith('.bin'))
+
+    def read(self, device_id, start_ms, stop_ms):
+        """Records with start_ms <= time < stop_ms, as one numpy record array
+        per day file. Each is a slice of a read-only memory mapping, not a
+        copy."""
+        directory = os.path.join(self._path, device_directory(device_id))
+        for day in range(start_ms // DAY_MS, (stop_ms - 1) // DAY_MS + 1):
+            path = os.path.join(directory, day_name(day) + '.bin')
+            records = map_day(path)
+            if records is None or not len(records):
+                continue
+            index = load_index(path[:-4] + '.idx', len(records))
+            times = records['time']
+            first = seek(times, index, start_ms)
+            last = seek(times, index, stop_ms)
+            if last > first:
+                yield records[first:last]
+
+    def aggregate(self, device_id, start_ms, stop_ms, every_ms, fields=FIELDS):
+        """Mean of each field per window, with the window semantics of
+        SampleRingBuffer.window_means. Returns (stops, {field: array}), NaN
+        for empty windows."""
+        import numpy as np
+        first_stop = (start_ms // every_ms + 1) * every_ms
+        stops = np.arange(first_stop, stop_ms, every_ms, dtype=np.int64)
+        stops = np.append(stops, stop_ms)
+        counts = np.zeros(len(stops))
+        sums = {field: np.zeros(len(stops)) for field in fields}
+        for records in self.read(device_id, start_ms, stop_ms):
+            slots = np.maximum(0, (records['time'] - first_stop) // every_ms + 1)
+            counts += np.bincount(slots, minlength=len(stops))
+            for field in fields:
+                sums[field] += np.bincount(slots, weights=records[field], minlength=len(stops))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return stops, {field: sums[field] / counts for field in fields}
+
+    def count(self, device_id, start_ms, stop_ms):
+        return sum(len(records) for records in self.read(device_id, start_ms, stop_ms))
+
+    # Export ---
+
+    def csv_chunks(self, device_id, start_ms, stop_ms, chunk=10000):
+        yield 'time,' + ','.join(FIELDS) + '\n'
+        for rows in self._formatted(device_id, start_ms, stop_ms, chunk):
+            yield ''.join(str(values[0]) + ',' + ','.join(values[1:]) + '\n' for values in rows)
+
+    def line_protocol_chunks(self, device_id, start_ms, stop_ms, chunk=5000, measurement='wattson_measurement'):
+        # Lists of lines, written like the sampler writes its points
+        prefix = measurement + ',device=' + _escape_tag(device_id) + ' '
+        # Integer fields carry the i suffix, as the sampler writes them
+        keys = [field + '=' for field in FIELDS]
+        suffixes = ['i' if field in INT_FIELDS else '' for field in FIELDS]
+        for rows in self._formatted(device_id, start_ms, stop_ms, chunk):
+            lines = []
+            for values in rows:
+                lines.append(prefix + ','.join(key + value + suffix for key, value, suffix in zip(keys, values[1:], suffixes)) +
+                             ' ' + str(values[0] * 1000000))
+            yield lines
+
+    def upload(self, device_id, start_ms, stop_ms, influx, bucket, chunk=5000):
+        """Writes the range to InfluxDB in chunks of line protocol. Returns
+        the number of points written; a failed chunk raises, and a retry
+        rewrites the same points, which InfluxDB deduplicates."""
+        written = 0
+        write_api = influx.write_api()
+        for lines in self.line_protocol_chunks(device_id, start_ms, stop_ms, chunk):
+            write_api.write(bucket=bucket, record=lines)
+            written += len(lines)
+            logger.info("Uploaded %d archived points of %s", written, device_id)
+        return written
+
+    def _formatted(self, device_id, start_ms, stop_ms, chunk):
+        # Per chunk, rows of [time, text of each field]
+        for records in self.read(device_id, start_ms, stop_ms):
+            for offset in range(0, len(records), chunk):
+                part = records[offset:offset + chunk]
+                columns = [part['time'].tolist()]
+                for field in INT_FIELDS:
+                    columns.append([str(value) for value in part[field].tolist()])
+                for field in FLOAT32_FIELDS:
+                    # float32 holds ~7 significant digits; print no more
+                    columns.append(['%.7g' % value for value in part[field].tolist()])
+                for field in FLOAT64_FIELDS:
+                    columns.append([repr(value) for value in part[field].tolist()])
+                yield list(zip(*columns))
+
+
+
+def _escape_tag(value):
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    magic, version, record_size, field_count, index_every, day_start_ms = HEADER.unpack_from(raw)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size or field_count != len(FIELDS):
+        raise ValueError(f"{path} is not a version {VERSION} sample archive")
+    return {'index_every': index_every, 'day_start_ms': day_start_ms}
+
+
+def _record_times(path, count, every, first=0):
+    # [(time, record)] of every `every`-th record from `first`
+    result = []
+    with open(path, 'rb') as f:
+        for record in range(first, count, every):
+            f.seek(HEADER_SIZE + record * RECORD.size)
+            result.append((struct.unpack('<q', f.read(8))[0], record))
+    return result
+
+
+def map_day(path):
+    import numpy as np
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        return None
+    read_header(path)
+    count = (size - HEADER_SIZE) // RECORD.size
+    if count <= 0:
+        return np.empty(0, dtype=record_dtype())
+    return np.memmap(path, dtype=record_dtype(), mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+def load_index(path, count):
+    import numpy as np
+    try:
+        index = np.fromfile(path, dtype=index_dtype())
+    except (FileNotFoundError, ValueError):
+        return np.empty(0, dtype=index_dtype())
+    # Entries past the records a reader mapped are ignored
+    return index[index['record'] < count]
+
+
+def seek(times, index, ts_ms):
+    # Position of the first record at or after ts_ms
+    import numpy as np
+    lo, hi = 0, len(times)
+    if len(index):
+        # The last entry before ts_ms and the one after bound the block
+        i = int(np.searchsorted(index['time'], ts_ms, 'left')) - 1
+        if i >= 0:
+            lo = int(index['record'][i])
+        if i + 1 < len(index):
+            hi = min(hi, int(index['record'][i + 1]) + 1)
+    return lo + int(np.searchsorted(times[lo:hi], ts_ms, 'left'))
+
+
+if __name__ == '__main__':
+    # python sample_archive.py export wattson01 -7d now csv > week.csv
+    # python sample_archive.py export wattson01 2026-10-01 2026-10-02 lp > day.lp
+    # python sample_archive.py upload wattson01 -2d now
+    # python sample_archive.py summary wattson01 -30d now 1h
+    import configparser
+    import sys
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    archive = SampleArchive.from_config(config)
+    command, device_id = sys.argv[1], sys.argv[2]
+    start, stop = parse_time(sys.argv[3]), parse_time(sys.argv[4] if len(sys.argv) > 4 else 'now')
+    if command == 'export':
+        if (sys.argv[5] if len(sys.argv) > 5 else 'csv') == 'csv':
+            for text in archive.csv_chunks(device_id, start, stop):
+                sys.stdout.write(text)
+        else:
+            for lines in archive.line_protocol_chunks(device_id, start, stop):
+                sys.stdout.write('\n'.join(lines) + '\n')
+    elif command == 'upload':
+        from influx_pool import InfluxClientManager
+        influx = InfluxClientManager(config)
+        written = archive.upload(device_id, start, stop, influx, config.get('APP', 'INFLUX_BUCKET'),
+                                 chunk=config.getint('ARCHIVE', 'UPLOAD_CHUNK', fallback=5000))
+        influx.close()
+        print(f"Uploaded {written} points")
+    elif command == 'summary':
+        started = time.perf_counter()
+        every_ms = parse_duration_ms(sys.argv[5] if len(sys.argv) > 5 else '1h')
+        stops, means = archive.aggregate(device_id, start, stop, every_ms, ('ActivePower', 'VoltageRMS'))
+        for i, stop_ms in enumerate(stops.tolist()):
+            print(datetime.fromtimestamp(stop_ms / 1000, timezone.utc).isoformat(),
+                  '%.2f W' % means['ActivePower'][i], '%.1f V' % means['VoltageRMS'][i])
+        print(f"{archive.count(device_id, start, stop)} samples in {time.perf_counter() - started:.2f} s", file=sys.stderr)
+    else:
+        sys.exit(f"Unknown command: {command}")
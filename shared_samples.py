@@ -0,0 +1,393 @@
+import atexit
+import contextlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from multiprocessing import resource_tracker, shared_memory
+
+import _posixshmem
+
+from ring_buffer import FIELDS, SampleRingBuffer
+
+
+logger = logging.getLogger(__name__)
+
+# Samples and stats shared between the sampler process and API workers.
+#
+# The sampler is the only process that opens the I2C bus. It publishes into
+# named POSIX shared memory segments, one per board holding the latest
+# sample (as the JSON body served by /wattson-data) and the recent history
+# ring, plus one status segment with its stats and metrics. API workers
+# attach read-only and never block the sampler: every segment is guarded by
+# a sequence lock, so writers never wait and readers simply retry a copy
+# that raced with a write.
+
+# Segment header, one unsigned 64-bit word each
+_SEQ, _INSTANCE, _CLOSED, _VERSION, _LENGTH, _TIMESTAMP, _DATA_SIZE, _CAPACITY, _HEAD, _COUNT, _FIELD_COUNT = range(11)
+_HEADER_WORDS = 16
+_HEADER_BYTES = 8 * _HEADER_WORDS
+
+DEFAULT_PAYLOAD_BYTES = 4096
+# A write holds the sequence odd for microseconds; one that stays odd this
+# long was left by a sampler that died inside it
+WRITE_TIMEOUT_S = 0.1
+
+
+def segment_name(prefix, key):
+    # POSIX shared memory names allow no slashes; keep them short and plain
+    return prefix + '_' + re.sub(r'[^A-Za-z0-9_.-]', '_', str(key))
+
+
+def _align(size):
+    return (size + 7) // 8 * 8
+
+
+# One named segment: the header and a variable-length data area, written by
+# one process and read by any number of others.
+class SharedBlob(object):
+    def __init__(self, shm, owner):
+        self._shm = shm
+        self._owner = owner
+        self._raw = shm.buf
+        self._header = shm.buf[:_HEADER_BYTES].cast('Q')
+        self._data = shm.buf[_HEADER_BYTES:_HEADER_BYTES + self._header[_DATA_SIZE]]
+        self._lock = threading.Lock()
+        # Set once a read found a write that never finished
+        self.torn = False
+
+    @classmethod
+    def create(cls, name, data_size):
+        shm = _create(name, _HEADER_BYTES + _align(data_size))
+        header = shm.buf[:_HEADER_BYTES].cast('Q')
+        header[_INSTANCE] = int.from_bytes(os.urandom(8), 'little')
+        header[_DATA_SIZE] = _align(data_size)
+        header.release()
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        shm = _attach(name)
+        return cls(shm, owner=False) if shm is not None else None
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def instance(self):
+        return self._header[_INSTANCE]
+
+    @property
+    def closed(self):
+        return self._header[_CLOSED] != 0
+
+    @property
+    def updated_ms(self):
+        return self._header[_TIMESTAMP]
+
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._lock:
+            header = self._header
+            header[_SEQ] += 1
+            try:
+                yield header
+            finally:
+                header[_SEQ] += 1
+
+    def _read(self, copy):
+        # Retries until a copy was made without a write in between. Returns
+        # None for a segment whose writer died mid-write, so the link
+        # re-attaches instead of the request spinning on it.
+        header = self._header
+        deadline = None
+        while True:
+            seq = header[_SEQ]
+            if seq & 1:
+                if deadline is None:
+                    deadline = time.monotonic() + (0.0 if self.torn else WRITE_TIMEOUT_S)
+                elif header[_CLOSED] or time.monotonic() >= deadline:
+                    if not self.torn:
+                        logger.warning("Shared segment %s was left mid-write", self.name)
+                    self.torn = True
+                    return None
+                time.sleep(0)
+                continue
+            result = copy(header)
+            if header[_SEQ] == seq:
+                return result
+
+    def write(self, data, timestamp_ms=None):
+        if len(data) > len(self._data):
+            logger.warning("%d bytes do not fit shared segment %s", len(data), self.name)
+            return False
+        with self._writing() as header:
+            self._data[:len(data)] = data
+            header[_LENGTH] = len(data)
+            header[_TIMESTAMP] = int(time.time() * 1000) if timestamp_ms is None else timestamp_ms
+            header[_VERSION] += 1
+        return True
+
+    def version(self):
+        return self._header[_VERSION]
+
+    def read(self):
+        # (version, timestamp_ms, bytes), or None before the first write
+        def copy(header):
+            version = header[_VERSION]
+            return version, header[_TIMESTAMP], bytes(self._data[:header[_LENGTH]])
+        result = self._read(copy)
+        return result if result is not None and result[0] else None
+
+    def close(self):
+        if self._owner:
+            self._header[_CLOSED] = 1
+        self._release()
+        try:
+            self._shm.close()
+        except BufferError:
+            # A reader thread still holds a view; the mapping goes with it
+            return
+        if self._owner:
+            try:
+                # SharedMemory.unlink() would unregister it a second time
+                _posixshmem.shm_unlink(self._shm._name)
+            except FileNotFoundError:
+                pass
+
+    def _release(self):
+        self._data.release()
+        self._header.release()
+
+
+# The recent-history ring of one board in shared memory, with the same
+# interface as SampleRingBuffer so query_recent() works on it unchanged in
+# an API worker. The latest sample's JSON body travels in the data area.
+class SharedSampleBuffer(SharedBlob, SampleRingBuffer):
+    def __init__(self, shm, owner, fields=FIELDS):
+        SharedBlob.__init__(self, shm, owner)
+        header = self._header
+        if owner:
+            header[_FIELD_COUNT] = len(fields)
+        elif header[_FIELD_COUNT] != len(fields):
+            raise ValueError(f"Shared segment {shm.name} has {header[_FIELD_COUNT]} fields, expected {len(fields)}")
+        self._fields = tuple(fields)
+        self._capacity = capacity = header[_CAPACITY]
+        self._times_offset = _HEADER_BYTES + header[_DATA_SIZE]
+        self._times = shm.buf[self._times_offset:self._times_offset + 8 * capacity].cast('q')
+        self._columns = []
+        for i in range(len(fields)):
+            offset = self._column_offset(i)
+            self._columns.append(shm.buf[offset:offset + 8 * capacity].cast('d'))
+
+    @classmethod
+    def create(cls, name, capacity, payload_size=DEFAULT_PAYLOAD_BYTES, fields=FIELDS):
+        shm = _create(name, _HEADER_BYTES + _align(payload_size) + 8 * capacity * (1 + len(fields)))
+        header = shm.buf[:_HEADER_BYTES].cast('Q')
+        header[_INSTANCE] = int.from_bytes(os.urandom(8), 'little')
+        header[_DATA_SIZE] = _align(payload_size)
+        header[_CAPACITY] = capacity
+        header.release()
+        return cls(shm, owner=True, fields=fields)
+
+    @classmethod
+    def attach(cls, name, fields=FIELDS):
+        shm = _attach(name)
+        return cls(shm, owner=False, fields=fields) if shm is not None else None
+
+    def _column_offset(self, index):
+        return self._times_offset + 8 * self._capacity * (index + 1)
+
+    def __len__(self):
+        return self._header[_COUNT]
+
+    def append(self, timestamp_ms, values):
+        with self._writing() as header:
+            i = header[_HEAD]
+            self._times[i] = timestamp_ms
+            for column, value in zip(self._columns, values):
+                column[i] = value
+            header[_HEAD] = (i + 1) % self._capacity
+            if header[_COUNT] < self._capacity:
+                header[_COUNT] += 1
+
+    def oldest(self):
+        def copy(header):
+            count = header[_COUNT]
+            if count == 0:
+                return None
+            return self._times[(header[_HEAD] - count) % self._capacity]
+        return self._read(copy)
+
+    def _snapshot(self, start_ms, indexes):
+        raw = self._raw
+        capacity = self._capacity
+
+        def span(offset, first, last):
+            column = array('q' if offset == self._times_offset else 'd')
+            column.frombytes(raw[offset + 8 * first:offset + 8 * last])
+            return column
+
+        def copy(header):
+            count, head = header[_COUNT], header[_HEAD]
+            offsets = [self._times_offset] + [self._column_offset(i) for i in indexes]
+            if count < capacity:
+                return [span(offset, 0, count) for offset in offsets]
+            return [span(offset, head, capacity) + span(offset, 0, head) for offset in offsets]
+
+        result = self._read(copy)
+        if result is None:
+            return array('q'), [array('d') for _ in indexes]
+        times, *columns = result
+        first = bisect_left(times, start_ms)
+        if first:
+            times = times[first:]
+            columns = [column[first:] for column in columns]
+        return times, columns
+
+    def set_latest(self, timestamp_ms, payload):
+        return self.write(payload, timestamp_ms)
+
+    def latest(self):
+        return self.read()
+
+    def _release(self):
+        for column in self._columns:
+            column.release()
+        self._times.release()
+        SharedBlob._release(self)
+
+
+def _create(name, size):
+    try:
+        stale = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        pass
+    else:
+        # Left behind by a sampler that did not shut down cleanly
+        logger.warning("Replacing stale shared segment %s", name)
+        resource_tracker.unregister(stale._name, 'shared_memory')
+        stale.close()
+        _posixshmem.shm_unlink(stale._name)
+    shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+    # close() unlinks the segment on a clean exit, and the next sampler
+    # replaces it after a crash. Left registered, the resource tracker of a
+    # crashed sampler would unlink the name after its successor created it.
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _attach(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return None
+    # Before Python 3.13 attaching registers the segment with the resource
+    # tracker too, which would unlink it when this worker exits
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+# The API worker's view of a sampler process. Segments are attached on
+# first use and re-attached when the sampler restarts: on a clean exit the
+# old segment is marked closed, after a crash it stops being updated and a
+# new one appears under the same name.
+class SamplerLink(object):
+    def __init__(self, prefix, device_ids, retry_interval=5.0, stale_after=10.0):
+        self._prefix = prefix
+        self._device_ids = list(device_ids)
+        self._retry_interval = retry_interval
+        self._stale_after_ms = int(stale_after * 1000)
+        self._segments = {}
+        # Replaced segments, closed once no request can still be reading them
+        self._retired = []
+        self._next_attempt = {}
+        self._status = (0, None)
+        self._watcher = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _segment(self, name, cls):
+        segment = self._segments.get(name)
+        if segment is not None and not segment.closed and not segment.torn and \
+                (segment.updated_ms == 0 or time.time() * 1000 - segment.updated_ms < self._stale_after_ms):
+            return segment
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_attempt.get(name, 0.0):
+                return segment
+            self._next_attempt[name] = now + self._retry_interval
+            try:
+                fresh = cls.attach(name)
+            except ValueError as e:
+                logger.error("Cannot attach %s: %s", name, e)
+                fresh = None
+            if fresh is None:
+                return segment
+            if segment is not None and fresh.instance == segment.instance:
+                fresh.close()
+                return segment
+            self._segments[name] = fresh
+            if segment is not None:
+                self._retired.append((now + 60.0, segment))
+            while self._retired and self._retired[0][0] <= now:
+                self._retired.pop(0)[1].close()
+        logger.info("Attached to sampler segment %s", name)
+        return fresh
+
+    def close(self):
+        with self._lock:
+            segments = list(self._segments.values()) + [segment for _, segment in self._retired]
+            self._segments.clear()
+            self._retired = []
+        for segment in segments:
+            segment.close()
+
+    def buffer(self, device_id):
+        return self._segment(segment_name(self._prefix, device_id), SharedSampleBuffer)
+
+    def latest(self, device_id):
+        # (version, timestamp_ms, JSON bytes) of the newest sample, or None
+        buffer = self.buffer(device_id)
+        return buffer.latest() if buffer is not None else None
+
+    def status(self):
+        blob = self._segment(segment_name(self._prefix, 'status'), SharedBlob)
+        if blob is None:
+            return None
+        version = blob.version()
+        if version != self._status[0]:
+            result = blob.read()
+            if result is not None:
+                self._status = (result[0], json.loads(result[2]))
+        return self._status[1]
+
+    def watch(self, publish, interval):
+        # Calls publish(device_id, payload_bytes) from a background thread
+        # for every new sample; started once per worker process
+        with self._lock:
+            if self._watcher is not None and self._watcher[0] == os.getpid():
+                return
+            thread = threading.Thread(target=self._watch, args=(publish, interval), name='sampler-watch', daemon=True)
+            self._watcher = (os.getpid(), thread)
+        thread.start()
+
+    def _watch(self, publish, interval):
+        seen = {}
+        while True:
+            for device_id in self._device_ids:
+                buffer = self.buffer(device_id)
+                if buffer is None:
+                    continue
+                key = (buffer.instance, buffer.version())
+                if seen.get(device_id) != key:
+                    seen[device_id] = key
+                    latest = buffer.latest()
+                    if latest is not None:
+                        publish(device_id, latest[2])
+            time.sleep(interval)
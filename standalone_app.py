@@ -1,33 +1,73 @@
+import logging
 import time
 import wattson
+from acquisition import AcquisitionLoop
 import signal
-from datetime import date
+from datetime import date, datetime, timezone
 import shelve
 import schedule
 
+logger = logging.getLogger('standalone_app')
+
 def resetEnergyAccumulation():
     today = date.today()
     with shelve.open('my_db') as db:
         if 'last_run' not in db or db['last_run'] != today:
-            print("Resetting Energy Accumulation for the day")
-            wattson.energyAccumulationInitialize()
+            logger.info("Resetting Energy Accumulation for the day")
+            wattson.energyAccumulationReset([device.sensor for device in wattson.registry])
             db['last_run'] = today
         else:
-            print("Energy Accumulation has already been reset today.")
+            logger.info("Energy Accumulation has already been reset today.")
+
+def make_sample_handler(device):
+    def handle_sample(timestamp, sample):
+        result = wattson.process_measurements(device.device_id, sample[0], sample[1],
+                                              datetime.fromtimestamp(timestamp, timezone.utc),
+                                              display=device.display)
+        if result is not None and wattson.share_samples:
+            # For the API workers in [SERVER] MODE = split
+            wattson.publish_sample(device.device_id, wattson.sample_payload(device.device_id, result).encode(), result[4])
+    return handle_sample
+
+def create_acquisitions():
+    rate = wattson.acquisition_rate()
+    count = len(wattson.registry)
+    wattson.check_bus_budget(count, rate)
+    return [AcquisitionLoop(lambda device=device: wattson.read_measurements(device.sensor),
+                            make_sample_handler(device), rate_hz=rate,
+                            name='acquisition-' + device.device_id, phase=index / (rate * count))
+            for index, device in enumerate(wattson.registry)]
+
+acquisitions = create_acquisitions()
+
+def boost_on_event(pin, state):
+    rate, seconds = wattson.capture_burst()
+    for device, loop in zip(wattson.registry, acquisitions):
+        if device.event_pin == pin:
+            loop.boost(rate, seconds)
+
+wattson.event_listeners.append(boost_on_event)
 
 def main():
     wattson.initialize()
+    for loop in acquisitions:
+        loop.start()
+    # The only sampler in split mode, so it programs the event limits
+    with wattson.startup.phase('event_config'):
+        for device in wattson.registry:
+            wattson.setSystemConfig(sensor=device.sensor)
     resetEnergyAccumulation()
     schedule.every().day.at("00:00").do(resetEnergyAccumulation)
-
     while(True):
         schedule.run_pending()
-        wattson.write_measurements("wattson01")
+        wattson.publish_status({device.device_id: loop.stats() for device, loop in zip(wattson.registry, acquisitions)})
         time.sleep(1)
 
 # gracefully exit without a big exception message if possible
 def ctrl_c_handler(signal, frame):
-    print('Goodbye!')
+    logger.info('Goodbye!')
+    for loop in acquisitions:
+        loop.stop()
     wattson.cleanup()
     exit(0)
 
@@ -0,0 +1,77 @@
+import contextlib
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def process_start_time():
+    # Wall-clock time this process was started, so the interpreter and the
+    # imports before any of our code runs are counted too. Linux only.
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after the parenthesized command name; starttime is the
+            # 22nd field of the line, in clock ticks after boot
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Startup-time breakdown of one process.
+#
+# Phases are timed sections of startup (opening the boards, starting the
+# threads); milestones are points in time counted from process start (the
+# first sample read, the web server starting). Each is recorded once and
+# logged as it happens.
+class StartupTimer(object):
+    def __init__(self):
+        self._started = process_start_time() or time.time()
+        self._phases = {}
+        self._milestones = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._phases[name] = seconds
+            logger.info("Startup phase %s took %.3f s", name, seconds)
+
+    def mark(self, name):
+        if name in self._milestones:
+            return
+        seconds = max(0.0, time.time() - self._started)
+        with self._lock:
+            if name in self._milestones:
+                return
+            self._milestones[name] = seconds
+        logger.info("Startup milestone %s at %.3f s", name, seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'started': int(self._started * 1000),
+                'phases': {name: round(seconds * 1000, 1) for name, seconds in self._phases.items()},
+                'milestones': {name: round(seconds * 1000, 1) for name, seconds in self._milestones.items()},
+            }
+
+    def collect_metrics(self):
+        with self._lock:
+            phases = list(self._phases.items())
+            milestones = list(self._milestones.items())
+        return [
+            ('wattson_startup_phase_seconds', 'gauge', 'Duration of each startup phase',
+             [({'phase': name}, seconds) for name, seconds in phases]),
+            ('wattson_startup_milestone_seconds', 'gauge', 'Seconds from process start to each startup milestone',
+             [({'milestone': name}, seconds) for name, seconds in milestones]),
+        ]
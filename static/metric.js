@@ -65,15 +65,46 @@ class PeriodicRunner {
     }
 }
 
+// Series shown on the chart: [field in the /query-all-data response, label]
+const SERIES = [
+    ['CurrentRMS', 'Current RMS'],
+    ['VoltageRMS', 'Voltage RMS'],
+    ['LineFrequency', 'Line Frequency'],
+    ['PowerFactor', 'Power Factor'],
+    ['ActivePower', 'Active Power'],
+    ['ReactivePower', 'Reactive Power'],
+    ['ApparentPower', 'Apparent Power'],
+    ['ActiveEnergyImport', 'Active Energy Import'],
+    ['ActiveEnergyExport', 'Active Energy Export'],
+    ['ReactiveEnergyImport', 'Reactive Energy Import'],
+    ['ReactiveEnergyExport', 'Reactive Energy Export'],
+];
+
 async function fetchChartData(duration, aggregateWindow) {
     const urlParams = new URLSearchParams({
         duration: duration,
         aggregateWindow: aggregateWindow,
+        format: 'columnar',
     });
+    const deviceId = new URLSearchParams(window.location.search).get('device_id');
+    if (deviceId) {
+        urlParams.set('device_id', deviceId);
+    }
 
     const response = await fetch('/query-all-data?' + urlParams.toString())
     if (!response.ok) throw new Error('Network response was not ok');
-    return await response.json();
+    return toSeries(await response.json());
+}
+
+// Convert the columnar response ({time: [...], CurrentRMS: [...], ...}) into
+// one {x, y} point array per series, the pre-parsed form Chart.js decimation needs.
+function toSeries(data) {
+    const series = {};
+    for (const [field] of SERIES) {
+        const values = data[field];
+        series[field] = data.time.map((t, i) => ({x: t, y: values[i]}));
+    }
+    return series;
 }
 
 async function renderChart() {
@@ -102,116 +133,23 @@ function createChart(ctx, val, decimalPlaces = 4) {
     let chart = new Chart(ctx, {
         type: 'line',
         data: {
-            datasets: [{
-                label: 'Current RMS',
-                data: val,
-                parsing: {
-                    yAxisKey: 'CurrentRMS'
-                },
-                tension: 0.4,
-
-            }, {
-                label: 'Voltage RMS',
-                data: val,
-                parsing: {
-                    yAxisKey: 'VoltageRMS'
-                },
-                hidden: true,
-                tension: 0.4,                
-
-            }, {
-                label: 'Line Frequency',
-                data: val,
-                parsing: {
-                    yAxisKey: 'LineFrequency'
-                },
-                hidden: true,
-                tension: 0.4,
-            }, {
-                label: 'Power Factor',
-                data: val,
-                parsing: {
-                    yAxisKey: 'PowerFactor'
-                },
-                hidden: true,
+            datasets: SERIES.map(([field, label], index) => ({
+                label: label,
+                data: val[field],
+                hidden: index !== 0,
                 tension: 0.4,
-            }, {
-                label: 'Active Power',
-                data: val,
-                parsing: {
-                    yAxisKey: 'ActivePower'
-                },
-                hidden: true,
-                tension: 0.4,                
-
-            }, {
-                label: 'Reactive Power',
-                data: val,
-                parsing: {
-                    yAxisKey: 'ReactivePower'
-                },
-                hidden: true,
-                tension: 0.4,                
-
-            }, {
-                label: 'Apparent Power',
-                data: val,
-                parsing: {
-                    yAxisKey: 'ApparentPower'
-                },
-                hidden: true,
-                tension: 0.4,                
- 
-            }, {
-                label: 'Active Energy Import',
-                data: val,
-                parsing: {
-                    yAxisKey: 'ActiveEnergyImport'
-                },
-                hidden: true,
-                tension: 0.4,                
-
-            }, {
-                label: 'Active Energy Export',
-                data: val,
-                parsing: {
-                    yAxisKey: 'ActiveEnergyExport'
-                },
-                hidden: true,
-                tension: 0.4,                
-
-            }, {
-                label: 'Reactive Energy Import',
-                data: val,
-                parsing: {
-                    yAxisKey: 'ReactiveEnergyImport'
-                },
-                hidden: true,
-                tension: 0.4,                
-   
-            }, {
-                label: 'Reactive Energy Export',
-                data: val,
-                parsing: {
-                    yAxisKey: 'ReactiveEnergyExport'
-                },
-                hidden: true,
-                tension: 0.4,                
-
-            }]
+            }))
         },
         options: {
             responsive: true,
             maintainAspectRatio: false, // Prevent the chart from resizing based on the aspect ratio of the canvas
+            parsing: false,
             plugins: {
                 decimation: {
                     enabled: true,
                     algorithm: 'min-max',
                   },
               },
-            parsing: {
-                xAxisKey: 'time',
-            },
             scales: {
                 x: {
                     type: 'time',                     
@@ -228,17 +166,9 @@ function createChart(ctx, val, decimalPlaces = 4) {
 
 function updateChart(chart, val, decimalPlaces = 4) {
     // Update chart data
-    chart.data.datasets[0].data =  val;
-    chart.data.datasets[1].data =  val;    
-    chart.data.datasets[2].data =  val;    
-    chart.data.datasets[3].data =  val;    
-    chart.data.datasets[4].data =  val;    
-    chart.data.datasets[5].data =  val;    
-    chart.data.datasets[6].data =  val;    
-    chart.data.datasets[7].data =  val;    
-    chart.data.datasets[8].data =  val;    
-    chart.data.datasets[9].data =  val;    
-    chart.data.datasets[10].data =  val;    
+    SERIES.forEach(([field], index) => {
+        chart.data.datasets[index].data = val[field];
+    });
 
     chart.update('none');
 }
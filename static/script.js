@@ -11,107 +11,151 @@ let eventsChart;
 // import { valueOrDefault } from './chart.js/helpers';
 
 
-function fetchChartData() {
-    fetch('/wattson-data')
-        .then(response => response.json())
-        .then(data => {
-            if (!currentChart) {
-                // First time: create the chart
-                const ctx = document.getElementById('currentChart').getContext('2d');
-                currentChart = createChart(ctx, data.energyData.currentRMS, 0.0, 15.0, 'A', 'Current RMS');
-            } else {
-                // Update chart data
-                updateChart(currentChart, data.energyData.currentRMS, 0.0, 15.0, 'A', 'Current RMS');
-            }
+function renderData(data) {
+    if (!currentChart) {
+        // First time: create the chart
+        const ctx = document.getElementById('currentChart').getContext('2d');
+        currentChart = createChart(ctx, data.energyData.currentRMS, 0.0, 15.0, 'A', 'Current RMS');
+    } else {
+        // Update chart data
+        updateChart(currentChart, data.energyData.currentRMS, 0.0, 15.0, 'A', 'Current RMS');
+    }
 
-            if (!voltageChart) {
-                // First time: create the chart
-                const ctx = document.getElementById('voltageChart').getContext('2d');
-                voltageChart = createChart(ctx, data.energyData.voltageRMS, 0.0, 150.0, 'V', 'Voltage RMS', 2);
-            } else {
-                // Update chart data
-                updateChart(voltageChart, data.energyData.voltageRMS, 0.0, 150.0, 'V', 'Voltage RMS', 2);
-            }            
-
-            if (!lineFrequencyChart) {
-                // First time: create the chart
-                const ctx = document.getElementById('lineFrequencyChart').getContext('2d');
-                lineFrequencyChart = createChart(ctx, data.energyData.lineFrequency, 0.0, 120.0, 'Hz', 'Line Frequency', 2);
-            } else {
-                // Update chart data
-                updateChart(lineFrequencyChart, data.energyData.lineFrequency, 0.0, 120.0, 'Hz', 'Line Frequency', 2);
-            }
+    if (!voltageChart) {
+        // First time: create the chart
+        const ctx = document.getElementById('voltageChart').getContext('2d');
+        voltageChart = createChart(ctx, data.energyData.voltageRMS, 0.0, 150.0, 'V', 'Voltage RMS', 2);
+    } else {
+        // Update chart data
+        updateChart(voltageChart, data.energyData.voltageRMS, 0.0, 150.0, 'V', 'Voltage RMS', 2);
+    }            
+
+    if (!lineFrequencyChart) {
+        // First time: create the chart
+        const ctx = document.getElementById('lineFrequencyChart').getContext('2d');
+        lineFrequencyChart = createChart(ctx, data.energyData.lineFrequency, 0.0, 120.0, 'Hz', 'Line Frequency', 2);
+    } else {
+        // Update chart data
+        updateChart(lineFrequencyChart, data.energyData.lineFrequency, 0.0, 120.0, 'Hz', 'Line Frequency', 2);
+    }
 
-            if (!powerFactorChart) {
-                // First time: create the chart
-                const ctx = document.getElementById('powerFactorChart').getContext('2d');
-                powerFactorChart = createChart(ctx, data.energyData.powerFactor, 0.0, 1.0, '', 'Power Factor', 3);
-            } else {
-                // Update chart data
-                updateChart(powerFactorChart, data.energyData.powerFactor, 0.0, 1.0, '', 'Power Factor', 3);
-            }
+    if (!powerFactorChart) {
+        // First time: create the chart
+        const ctx = document.getElementById('powerFactorChart').getContext('2d');
+        powerFactorChart = createChart(ctx, data.energyData.powerFactor, 0.0, 1.0, '', 'Power Factor', 3);
+    } else {
+        // Update chart data
+        updateChart(powerFactorChart, data.energyData.powerFactor, 0.0, 1.0, '', 'Power Factor', 3);
+    }
 
-            if (!activePowerChart) {
-                // First time: create the chart
-                const ctx = document.getElementById('activePowerChart').getContext('2d');
-                activePowerChart = createChart(ctx, data.energyData.activePower, 0.0, 2000.0, 'W', 'Active Power', 3);
-            } else {
-                // Update chart data
-                updateChart(activePowerChart, data.energyData.activePower, 0.0, 2000.0, 'W', 'Active Power', 3);
-            }
+    if (!activePowerChart) {
+        // First time: create the chart
+        const ctx = document.getElementById('activePowerChart').getContext('2d');
+        activePowerChart = createChart(ctx, data.energyData.activePower, 0.0, 2000.0, 'W', 'Active Power', 3);
+    } else {
+        // Update chart data
+        updateChart(activePowerChart, data.energyData.activePower, 0.0, 2000.0, 'W', 'Active Power', 3);
+    }
 
 
-            if (!powerQuadrantChart) {
-                // First time: create the chart
-                const ctx = document.getElementById('powerQuadrantChart').getContext('2d');
-                powerQuadrantChart = createPQChart(ctx, data.powerQuadrant);
-            } else {
-                // Update chart data
-                updatePQChart(powerQuadrantChart, data.powerQuadrant);
-            }
+    if (!powerQuadrantChart) {
+        // First time: create the chart
+        const ctx = document.getElementById('powerQuadrantChart').getContext('2d');
+        powerQuadrantChart = createPQChart(ctx, data.powerQuadrant);
+    } else {
+        // Update chart data
+        updatePQChart(powerQuadrantChart, data.powerQuadrant);
+    }
+
+    if (!eventsChart) {
+        // First time: create the chart
+        const ctx = document.getElementById('eventsChart').getContext('2d');
+        eventsChart = createEventsChart(ctx, data.events);
+    } else {
+       // Update chart data
+        updateEventsChart(eventsChart, data.events);
+    }
 
-            if (!eventsChart) {
-                // First time: create the chart
-                const ctx = document.getElementById('eventsChart').getContext('2d');
-                eventsChart = createEventsChart(ctx, data.events);
-            } else {
-               // Update chart data
-                updateEventsChart(eventsChart, data.events);
-            }
 
+    //const apspan = document.getElementById('activePower');
+    //apspan.textContent = data.energyData.activePower + ' W';
 
-            //const apspan = document.getElementById('activePower');
-            //apspan.textContent = data.energyData.activePower + ' W';
+    const rpspan = document.getElementById('reactivePower');
+    rpspan.textContent = data.energyData.reactivePower + ' VAR';
 
-            const rpspan = document.getElementById('reactivePower');
-            rpspan.textContent = data.energyData.reactivePower + ' VAR';
+    const appspan = document.getElementById('apparentPower');
+    appspan.textContent = data.energyData.apparentPower + ' VA';
 
-            const appspan = document.getElementById('apparentPower');
-            appspan.textContent = data.energyData.apparentPower + ' VA';
+    const aeispan = document.getElementById('activeEnergyImport');
+    aeispan.textContent = data.energyAccumData.activeEnergyImport + ' Wh';
 
-            const aeispan = document.getElementById('activeEnergyImport');
-            aeispan.textContent = data.energyAccumData.activeEnergyImport + ' Wh';
+    const aeespan = document.getElementById('activeEnergyExport');
+    aeespan.textContent = data.energyAccumData.activeEnergyExport + ' Wh';
 
-            const aeespan = document.getElementById('activeEnergyExport');
-            aeespan.textContent = data.energyAccumData.activeEnergyExport + ' Wh';
+    const reispan = document.getElementById('reactiveEnergyImport');
+    reispan.textContent = data.energyAccumData.reactiveEnergyImport + ' VARh';
 
-            const reispan = document.getElementById('reactiveEnergyImport');
-            reispan.textContent = data.energyAccumData.reactiveEnergyImport + ' VARh';
+    const reespan = document.getElementById('reactiveEnergyExport');
+    reespan.textContent = data.energyAccumData.reactiveEnergyExport + ' VARh';
 
-            const reespan = document.getElementById('reactiveEnergyExport');
-            reespan.textContent = data.energyAccumData.reactiveEnergyExport + ' VARh';
+    const observationTime = document.getElementById('observationTime');
+    observationTime.textContent = 'Last observed: ' + Date(data.timestamp);
+}
 
-            const observationTime = document.getElementById('observationTime');
-            observationTime.textContent = 'Last observed: ' + Date(data.timestamp);
+// Board to show, from ?device_id= on the page URL (defaults to the first board)
+const pageParams = new URLSearchParams(window.location.search);
+const deviceQuery = pageParams.has('device_id') ? '?device_id=' + encodeURIComponent(pageParams.get('device_id')) : '';
 
-            
-        });
+function fetchChartData() {
+    fetch('/wattson-data' + deviceQuery)
+        .then(response => response.json())
+        .then(renderData);
+}
+
+// Live updates are pushed over Server-Sent Events. Frames are coalesced to one
+// render per animation frame; if the stream is unavailable we fall back to
+// polling /wattson-data every 2 seconds.
+let pollTimer = null;
+let latestFrame = null;
+
+function startPolling() {
+    if (pollTimer) return;
+    pollTimer = setInterval(fetchChartData, 2000);
+    fetchChartData();
+}
+
+function stopPolling() {
+    clearInterval(pollTimer);
+    pollTimer = null;
+}
+
+function startStream() {
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+    const source = new EventSource('/wattson-stream' + deviceQuery);
+    source.onopen = () => stopPolling();
+    source.onmessage = (event) => {
+        const pending = latestFrame !== null;
+        latestFrame = event.data;
+        if (!pending) {
+            requestAnimationFrame(() => {
+                const frame = latestFrame;
+                latestFrame = null;
+                renderData(JSON.parse(frame));
+            });
+        }
+    };
+    source.onerror = () => {
+        // EventSource reconnects by itself; poll in the meantime
+        startPolling();
+    };
 }
 
-// Fetch data every 2 seconds
-setInterval(fetchChartData, 2000);
-// Initial fetch
+// Initial fetch, then live updates
 fetchChartData();
+startStream();
 
 function createChart(ctx, val, minVal, maxVal, units, description, decimalPlaces = 4) {
     let chart = new Chart(ctx, {
@@ -1,47 +1,82 @@
 import configparser
+import json
+import logging
+import os
 from datetime import datetime, timezone
 from uuid import uuid4
-from influxdb_client import Authorization, InfluxDBClient, Permission, PermissionResource, Point, WriteOptions
-from influxdb_client.client.authorizations_api import AuthorizationsApi
-from influxdb_client.client.bucket_api import BucketsApi
-from influxdb_client.client.query_api import QueryApi
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influx_pool import InfluxClientManager
+from write_pipeline import WritePipeline
+from ring_buffer import SampleRingBuffer, parse_duration_ms
+from devices import DeviceRegistry
+from rollups import DEFAULT_TIERS, RollupAggregator, parse_tiers, pick_tier
+import metrics
+import log_config
 
 import UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521 as UpbeatLabs_MCP39F521
 import subprocess as sp
 import time
 import signal
+import threading
+from array import array
 
-import board
-import busio
-import digitalio 
-import adafruit_ssd1306
-
-from PIL import Image
-from PIL import ImageDraw
-from PIL import ImageFont
-
-import RPi.GPIO as GPIO
+from backends import load_backend
+from capture import CAPTURE_FIELDS, EventCapture
+from energy_ledger import TOTAL_FIELDS, EnergyLedger
+from compression import StreamCompressor, tolerances_from_config
+from flux_queries import QueryBuilder
+from query_executor import QueryExecutor
+from shared_samples import SamplerLink, SharedBlob, SharedSampleBuffer, segment_name
+from startup import StartupTimer
+from register_reader import DEFAULT_MAX_READ_BYTES, RegisterReader, as_dict, plan_blocks
+from sample_archive import SampleArchive
 
 
 WIDTH = 128
 HEIGHT = 64
 
-# Raspberry Pi pin configuration:
-RST = digitalio.DigitalInOut(board.D12)
-# Note the following are only used with SPI:
-DC = digitalio.DigitalInOut(board.D18)
-CS = digitalio.DigitalInOut(board.D8)
-
-spi = busio.SPI(board.SCK, MOSI=board.MOSI)
-disp = adafruit_ssd1306.SSD1306_SPI(WIDTH, HEIGHT, spi, DC, RST, CS)
-
-wattson = UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521(0x74)
-
 LED_PIN = 4
 ZCD_PIN = 23
 EVENT_PIN = 24
 
+config = configparser.ConfigParser()
+config.read('config.ini')
+log_config.configure(config)
+logger = logging.getLogger(__name__)
+
+# Importing this module only reads the configuration. The hardware backend,
+# the boards, the OLED, the GPIO pins, the write pipeline and the energy
+# ledger are set up by initialize(), in the process that samples; the
+# InfluxDB client, PIL and numpy are imported on first use. A restarted
+# sampler reads its first sample without waiting for the query side to
+# load, and API workers never load the hardware libraries at all.
+startup = StartupTimer()
+metrics.register_collector(startup.collect_metrics)
+
+# Real Raspberry Pi hardware, or simulated stand-ins ([HARDWARE] BACKEND);
+# loaded by init_hardware()
+backend = None
+GPIO = None
+
+# [SERVER] MODE = split runs the API under a multi-worker WSGI server
+# (wsgi.py), separate from the one process that samples the boards. API
+# workers set WATTSON_ROLE=api: they never open the I2C bus, the GPIO pins
+# or the OLED, and read samples and stats from shared memory instead.
+server_mode = config.get('SERVER', 'MODE', fallback='single')
+api_worker = os.environ.get('WATTSON_ROLE') == 'api'
+owns_hardware = not api_worker
+shared_prefix = config.get('SERVER', 'SHARED_NAME', fallback='wattson')
+share_samples = server_mode == 'split' and owns_hardware
+
+# Set by init_hardware() in the process that owns the hardware
+disp = None
+wattson = None
+renderer = None
+hardware_lock = threading.RLock()
+initialized = False
+
+# Serializes access to the I2C bus between the sampler and configuration calls
+bus_lock = threading.RLock()
+
 OVER_CURRENT_LIMIT  = 1800  # 0.18a
 OVER_POWER_LIMIT    = 1600  # 16w
 VOLTAGE_SAG_LIMIT   =  800   # 80v
@@ -49,57 +84,96 @@ VOLTAGE_SURGE_LIMIT = 1300  # 130v
 
 eventTriggered = False
 
-config = configparser.ConfigParser()
-config.read('config.ini')
-
-# First define some constants to allow easy resizing of shapes.
-width = disp.width
-height = disp.height
-padding = 2
-shape_width = 20
-top = padding
-bottom = height-padding
-# Move left to right keeping track of the current x position for drawing shapes.
-x = padding
-
-# Load default font.
-font = ImageFont.load_default()
-image = Image.new('1', (width, height))
-draw = ImageDraw.Draw(image)
+# Event flag limits in engineering units, kept current by setSystemConfig
+event_limits = {}
+
+# Boards sampled by this process; the default board reuses the sensor above
+registry = DeviceRegistry.from_config(config, default_event_pin=EVENT_PIN)
+
+def open_sensor(address, busnum=1, event_pin=None):
+    if address == 0x74 and busnum == 1:
+        return wattson
+    return backend.create_sensor(address, busnum, event_pin=event_pin)
+
+def init_hardware():
+    # Opens the display and the boards; later calls do nothing
+    global backend, GPIO, disp, wattson, renderer
+    with hardware_lock:
+        if wattson is not None:
+            return
+        with startup.phase('hardware'):
+            backend = load_backend(config)
+            GPIO = backend.gpio
+            disp = backend.create_display(WIDTH, HEIGHT)
+            wattson = backend.create_sensor(0x74, 1, event_pin=EVENT_PIN)
+            registry.open(open_sensor)
+        with startup.phase('display'):
+            from display import DisplayRenderer
+            # OLED updates run on their own thread at [DISPLAY] REFRESH_HZ
+            renderer = DisplayRenderer.from_config(disp, config)
+
+# The client itself is created on first use
+influx = InfluxClientManager(config)
+# Set by init_pipeline() in the process that samples
+writer = None
+# Validates dashboard query arguments and holds the Flux templates
+query_builder = QueryBuilder.from_config(config)
+# Runs the InfluxDB side of dashboard queries with deadlines and a
+# concurrency cap
+query_executor = QueryExecutor.from_config(config)
+
+# Recent samples per device, used to answer short-range dashboard queries
+buffers = {}
+buffers_lock = threading.Lock()
+
+# Event-triggered high-rate captures per device, and callbacks run on each
+# event pin edge (the app uses one to speed up acquisition for the burst)
+captures = {}
+event_listeners = []
+
+# Pre-aggregated series for long-range views, maintained per device
+rollup_tiers = parse_tiers(config.get('ROLLUP', 'TIERS', fallback=DEFAULT_TIERS)) \
+    if config.getboolean('ROLLUP', 'ENABLED', fallback=True) else []
+aggregators = {}
+
+# Deadband / swinging-door suppression of wattson_measurement writes
+compression_enabled = config.getboolean('COMPRESSION', 'ENABLED', fallback=False)
+compression_tolerances = tolerances_from_config(config)
+compressors = {}
+
+# Monotonic energy totals per device, across chip resets and restarts; set
+# by init_pipeline()
+ledger = None
+
+# Local binary archive of every sample for offline export ([ARCHIVE]). The
+# process that samples writes it; any process may read it (open_archive())
+archive_enabled = config.getboolean('ARCHIVE', 'ENABLED', fallback=False)
+archive = None
+
+# Per-day analytics summaries of completed days, opened on first use
+analytics_cache = None
+
+# [SAMPLING] COALESCED_READS reads each sample through a RegisterReader:
+# fewer bus transactions, retries and partial-failure stats. Otherwise the
+# library's readEnergyData() and readEnergyAccumData() are used.
+coalesced_reads = config.getboolean('SAMPLING', 'COALESCED_READS', fallback=True)
+readers = {}
+
+# Sampler side: the status segment read by API workers. Worker side: the
+# link to the sampler's segments.
+status_blob = None
+sampler_link = SamplerLink(shared_prefix, registry.ids()) if api_worker else None
 
 
 def clear_display():
-    # Clear display
-    disp.fill(0)
-    disp.show()
-
-    # Draw a black filled box to clear the image.
-    draw.rectangle((0,0,width,height), outline=0, fill=0)
+    renderer.clear()
 
+# Hands the sample to the display thread; never waits for SPI.
 def write_display(result):
-    try: 
-        draw.rectangle((0,0,width,height), outline=0, fill=0)
-        # Write two lines of text.
-        draw.text((x, top),    str("{:.2f}".format(result.voltageRMS)) + ' V | ' + str("{:.2f}".format(result.lineFrequency)) + ' Hz',  font=font, fill=255)
-        draw.text((x, top+10), str("{:.4f}".format(result.currentRMS)) + ' A | PF: ' + str("{:.2f}".format(result.powerFactor)), font=font, fill=255)
-        draw.text((x, top+20), '--------------------', font=font, fill=255)
-        draw.text((x, top+30), str("{:.2f} W".format(result.activePower)), font=font, fill=255)
-        draw.text((x, top+40), str("{:.2f} VAR".format(result.reactivePower)), font=font, fill=255)
-        draw.text((x, top+50), str("{:.2f} VA".format(result.apparentPower)), font=font, fill=255)
-
-        # Display image.
-        imageRot = image.transpose(Image.ROTATE_180)
-        disp.image(imageRot)
-        disp.show()
-    except Exception as err:
-        print(result)
-        print(f"Unexpected {err=}, {type(err)=}")
-        raise
+    renderer.update(result)
 
 def get_buckets():
-    influxdb_client = InfluxDBClient(url=config.get('APP', 'INFLUX_URL'),
-                                     token=config.get('APP', 'INFLUX_TOKEN'),
-                                     org=config.get('APP', 'INFLUX_ORG'))
+    influxdb_client = influx.client()
 
     buckets_api = influxdb_client.buckets_api()
     buckets = buckets_api.find_buckets()
@@ -107,19 +181,10 @@ def get_buckets():
 
 
 def get_device(device_id) -> {}:
-    influxdb_client = InfluxDBClient(url=config.get('APP', 'INFLUX_URL'),
-                                     token=config.get('APP', 'INFLUX_TOKEN'),
-                                     org=config.get('APP', 'INFLUX_ORG'))
-    # Queries must be formatted with single and double quotes correctly
-    query_api = QueryApi(influxdb_client)
-    device_id = str(device_id)
-    device_filter = f'r.deviceId == "{device_id}" and r._field != "token"'
-    flux_query = f'from(bucket: "{config.get("APP", "INFLUX_BUCKET_AUTH")}") ' \
-                 f'|> range(start: 0) ' \
-                 f'|> filter(fn: (r) => r._measurement == "deviceauth" and {device_filter}) ' \
-                 f'|> last()'
-
-    response = query_api.query(flux_query)
+    query_api = influx.query_api()
+    flux_query, params = query_builder.device_auth(device_id)
+
+    response = query_api.query(flux_query, params=params)
     results = []
     for table in response:
         for record in table.records:
@@ -128,14 +193,11 @@ def get_device(device_id) -> {}:
 
 
 def create_device(device_id=None):
-    influxdb_client = InfluxDBClient(url=config.get('APP', 'INFLUX_URL'),
-                                     token=config.get('APP', 'INFLUX_TOKEN'),
-                                     org=config.get('APP', 'INFLUX_ORG'))
-
+    Point = point_class()
     if device_id is None:
         device_id = str(uuid4())
 
-    write_api = influxdb_client.write_api(write_options=SYNCHRONOUS)
+    write_api = influx.write_api()
 
     point = Point('deviceauth') \
         .tag("deviceId", device_id) \
@@ -151,90 +213,499 @@ def create_device(device_id=None):
     # Return None on failure
     return None
 
-def query_all_data(device_id, duration, aggregateWindow) -> {}:
-    influxdb_client = InfluxDBClient(url=config.get('APP', 'INFLUX_URL'),
-                                     token=config.get('APP', 'INFLUX_TOKEN'),
-                                     org=config.get('APP', 'INFLUX_ORG'))
-    # Queries must be formatted with single and double quotes correctly
-    query_api = QueryApi(influxdb_client)
-    device_id = str(device_id)
-    device_filter = f'r.device == "{device_id}" and r._field != "token"'
-
-    flux_query = f'from(bucket: "{config.get("APP", "INFLUX_BUCKET")}") ' \
-                 f'|> range(start: {duration} ) ' \
-                 f'|> filter(fn: (r) => r._measurement == "wattson_measurement" and {device_filter})' \
-                 f'|> aggregateWindow(every: {aggregateWindow}, fn: mean) ' \
-                 f'|> map(fn: (r) => ( {{ r with _time: uint(v: r._time) }} ))' \
-                 f'|> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")'
-
-
-    print(flux_query)
-    response = query_api.query(flux_query)
-    results = []
-    for table in response:
-        for record in table.records:
-            results.append({
-                "time": record.get_time() // 1000000,                
-                "CurrentRMS": str(record.values['CurrentRMS']),
-                "VoltageRMS": str(record.values['VoltageRMS']),
-                "LineFrequency": str(record.values['LineFrequency']),
-                "PowerFactor": str(record.values['PowerFactor']),
-                "ActivePower": str(record.values['ActivePower']),
-                "ReactivePower": str(record.values['ReactivePower']),
-                "ApparentPower": str(record.values['ApparentPower']),
-                "ActiveEnergyImport": str(record.values['ActiveEnergyImport']),
-                "ActiveEnergyExport": str(record.values['ActiveEnergyExport']),
-                "ReactiveEnergyImport": str(record.values['ReactiveEnergyImport']),
-                "ReactiveEnergyExport": str(record.values['ReactiveEnergyExport']),                
-                })
-    return results
+# Fields returned by query_all_data, in the order the dashboard expects them
+QUERY_ALL_FIELDS = ("CurrentRMS", "VoltageRMS", "LineFrequency", "PowerFactor",
+                    "ActivePower", "ReactivePower", "ApparentPower",
+                    "ActiveEnergyImport", "ActiveEnergyExport",
+                    "ReactiveEnergyImport", "ReactiveEnergyExport")
+
+def recent_buffer(device_id, create=False):
+    if sampler_link is not None:
+        return sampler_link.buffer(device_id)
+    with buffers_lock:
+        buffer = buffers.get(device_id)
+        if buffer is None and create:
+            seconds = config.getint('BUFFER', 'SECONDS', fallback=3600)
+            capacity = int(seconds * acquisition_rate()) + 1
+            if share_samples:
+                buffer = SharedSampleBuffer.create(segment_name(shared_prefix, device_id), capacity)
+            else:
+                buffer = SampleRingBuffer(capacity)
+            buffers[device_id] = buffer
+        return buffer
+
+# The /wattson-data and /wattson-stream body for one processed sample
+def sample_payload(device_id, result):
+    return json.dumps({'deviceId': device_id, 'energyData': result[0], 'energyAccumData': result[1],
+                       'powerQuadrant': result[2], 'events': result[3], 'timestamp': result[4]},
+                      default=as_dict)
+
+def publish_sample(device_id, body, timestamp_ms):
+    # Latest sample body for the API workers
+    if not share_samples:
+        return
+    buffer = recent_buffer(device_id)
+    if buffer is not None:
+        buffer.set_latest(timestamp_ms, body)
+
+def sampler_status(acquisition):
+    # What an API worker cannot see from its own process
+    return {
+        'acquisition': acquisition,
+        'write': writer.stats(),
+        'compression': compression_stats(),
+        'reads': read_stats(),
+        'archive': archive_stats(),
+        'energyTotals': {device_id: ledger.totals(device_id) for device_id in registry.ids()},
+        'captures': {device_id: query_captures(device_id) for device_id in registry.ids()},
+        'metrics': metrics.REGISTRY.render(),
+        'startup': startup.stats(),
+    }
+
+def publish_status(acquisition):
+    global status_blob
+    if not share_samples:
+        return
+    if status_blob is None:
+        status_blob = SharedBlob.create(segment_name(shared_prefix, 'status'),
+                                        config.getint('SERVER', 'STATUS_BYTES', fallback=1024 * 1024))
+    status_blob.write(json.dumps(sampler_status(acquisition)).encode())
+
+def rollup_aggregator(device_id):
+    if not rollup_tiers:
+        return None
+    with buffers_lock:
+        aggregator = aggregators.get(device_id)
+        if aggregator is None:
+            aggregator = RollupAggregator(device_id, rollup_tiers)
+            aggregators[device_id] = aggregator
+        return aggregator
+
+def event_capture(device_id):
+    if not config.getboolean('CAPTURE', 'ENABLED', fallback=True):
+        return None
+    with buffers_lock:
+        capture = captures.get(device_id)
+        if capture is None:
+            capture = EventCapture(device_id, event_limits,
+                                   pre_seconds=config.getfloat('CAPTURE', 'PRE_SECONDS', fallback=5.0),
+                                   post_seconds=config.getfloat('CAPTURE', 'POST_SECONDS', fallback=5.0),
+                                   max_seconds=config.getfloat('CAPTURE', 'MAX_SECONDS', fallback=60.0),
+                                   keep=config.getint('CAPTURE', 'KEEP', fallback=20))
+            captures[device_id] = capture
+        return capture
+
+def stream_compressor(device_id):
+    if not compression_enabled:
+        return None
+    with buffers_lock:
+        compressor = compressors.get(device_id)
+        if compressor is None:
+            compressor = StreamCompressor(compression_tolerances,
+                                          max_interval=config.getfloat('COMPRESSION', 'MAX_INTERVAL_S', fallback=60.0))
+            compressors[device_id] = compressor
+        return compressor
+
+def compression_stats():
+    if sampler_link is not None:
+        return published_status('compression', {})
+    with buffers_lock:
+        items = list(compressors.items())
+    return {device_id: compressor.stats() for device_id, compressor in items}
+
+def register_reader(sensor):
+    reader = readers.get(sensor)
+    if reader is None:
+        with buffers_lock:
+            reader = readers.get(sensor)
+            if reader is None:
+                reader = readers[sensor] = RegisterReader.from_config(sensor, config)
+    return reader
+
+def read_stats():
+    if sampler_link is not None:
+        return published_status('reads', {})
+    return {device.device_id: readers[device.sensor].stats() for device in registry if device.sensor in readers}
+
+def archive_stats():
+    if sampler_link is not None:
+        return published_status('archive', {})
+    return archive.stats() if archive is not None else {}
+
+def open_archive():
+    # The archive for reading, or None if it is not enabled
+    global archive
+    if not archive_enabled:
+        return None
+    with buffers_lock:
+        if archive is None:
+            archive = SampleArchive.from_config(config)
+        return archive
+
+def capture_burst():
+    # (rate_hz, seconds) of fast sampling after each event pin edge
+    return (config.getfloat('CAPTURE', 'BURST_RATE_HZ', fallback=8.0),
+            config.getfloat('CAPTURE', 'POST_SECONDS', fallback=5.0))
+
+def rollup_tier(aggregateWindow):
+    every_ms = parse_duration_ms(aggregateWindow)
+    if every_ms is None or not rollup_tiers:
+        return None
+    tier = pick_tier(every_ms, rollup_tiers)
+    return tier[0] if tier is not None else None
+
+# Answer a range/aggregateWindow query from the in-process ring buffer.
+# Returns None when the range reaches further back than what is buffered.
+def query_recent(device_id, duration, aggregateWindow, fields):
+    buffer = recent_buffer(str(device_id))
+    range_ms = parse_duration_ms(duration)
+    every_ms = parse_duration_ms(aggregateWindow)
+    if buffer is None or range_ms is None or every_ms is None or not str(duration).startswith('-'):
+        return None
+    stop_ms = int(time.time() * 1000)
+    start_ms = stop_ms - range_ms
+    if not buffer.covers(start_ms, slack_ms=int(2000 / acquisition_rate())):
+        return None
+    return buffer.window_means(start_ms, stop_ms, every_ms, fields)
+
+def query_all_flux(device_id, duration, aggregateWindow, fields=QUERY_ALL_FIELDS):
+    # Aggregates the pre-computed bucket means of the coarsest usable rollup
+    # tier, if there is one, instead of scanning the raw series
+    return query_builder.window_means(device_id, duration, aggregateWindow, fields,
+                                      tier=rollup_tier(aggregateWindow))
+
+def query_all_data(device_id, duration, aggregateWindow, fields=None) -> {}:
+    duration, aggregateWindow, fields = query_builder.validate(duration, aggregateWindow, fields, QUERY_ALL_FIELDS)
+    recent = query_recent(device_id, duration, aggregateWindow, fields)
+    if recent is not None:
+        stops, columns = recent
+        results = []
+        for i, stop in enumerate(stops):
+            row = {"time": stop}
+            for field in fields:
+                row[field] = str(columns[field][i])
+            results.append(row)
+        return results
+
+    flux_query, params = query_all_flux(device_id, duration, aggregateWindow, fields)
+    logger.debug("Flux query: %s %s", flux_query, params)
+
+    def run(job):
+        results = []
+        for record in influx.query_api().query_stream(flux_query, params=params):
+            job.check()
+            row = {"time": record.get_time() // 1000000}
+            values = record.values
+            for field in fields:
+                row[field] = str(values.get(field))
+            results.append(row)
+        return results
+    return query_executor.run(run)
+
+def _json_number(value):
+    if value is None or value != value:
+        return 'null'
+    return repr(value)
+
+def _columnar_chunks(times, columns, chunk_size=2048):
+    yield '{"time":['
+    for i in range(0, len(times), chunk_size):
+        yield (',' if i else '') + ','.join(str(t) for t in times[i:i + chunk_size])
+    yield ']'
+    for field, column in columns:
+        yield ',"' + field + '":['
+        for i in range(0, len(column), chunk_size):
+            yield (',' if i else '') + ','.join(_json_number(v) for v in column[i:i + chunk_size])
+        yield ']'
+    yield '}'
+
+# Same data as query_all_data, as a generator of JSON text chunks in a
+# columnar layout: {"time": [ms, ...], "CurrentRMS": [..], ...}; empty
+# windows are encoded as null. From InfluxDB, the time array is sent as
+# records arrive, while the field columns are collected in compact arrays
+# (no per-row dicts or strings) and sent once the last record is read, since
+# each of them follows the whole time array.
+def query_all_data_columnar(device_id, duration, aggregateWindow, fields=None, chunk_size=2048):
+    duration, aggregateWindow, fields = query_builder.validate(duration, aggregateWindow, fields, QUERY_ALL_FIELDS)
+    recent = query_recent(device_id, duration, aggregateWindow, fields)
+    if recent is not None:
+        stops, columns = recent
+        yield from _columnar_chunks(stops, [(field, columns[field]) for field in fields])
+        return
+
+    flux_query, params = query_all_flux(device_id, duration, aggregateWindow, fields)
+    logger.debug("Flux query: %s %s", flux_query, params)
+
+    def run(job, emit):
+        nan = float('nan')
+        columns = [(field, array('d')) for field in fields]
+        # Raises on an InfluxDB error before anything is sent
+        records = influx.query_api().query_stream(flux_query, params=params)
+        emit('{"time":[')
+        times = []
+        separator = ''
+        for record in records:
+            job.check()
+            times.append(record.get_time() // 1000000)
+            values = record.values
+            for field, column in columns:
+                value = values.get(field)
+                column.append(nan if value is None else value)
+            if len(times) >= chunk_size:
+                emit(separator + ','.join(str(t) for t in times))
+                separator = ','
+                times = []
+        emit((separator if times else '') + ','.join(str(t) for t in times) + ']')
+        for field, column in columns:
+            emit(',"' + field + '":[')
+            for i in range(0, len(column), chunk_size):
+                emit((',' if i else '') + ','.join(_json_number(v) for v in column[i:i + chunk_size]))
+            emit(']')
+        emit('}')
+    yield from query_executor.stream(run)
 
 def query_data(device_id, metric) -> {}:
-    influxdb_client = InfluxDBClient(url=config.get('APP', 'INFLUX_URL'),
-                                     token=config.get('APP', 'INFLUX_TOKEN'),
-                                     org=config.get('APP', 'INFLUX_ORG'))
-    # Queries must be formatted with single and double quotes correctly
-    query_api = QueryApi(influxdb_client)
-    device_id = str(device_id)
-    device_filter = f'r.device == "{device_id}" and r._field != "token"'
-
-    flux_query = f'from(bucket: "{config.get("APP", "INFLUX_BUCKET")}") ' \
-                 f'|> range(start: -5m ) ' \
-                 f'|> filter(fn: (r) => r._measurement == "wattson_measurement" and {device_filter})' \
-                 f'|> filter(fn: (r) => r._field == "{metric}" ) ' \
-                 f'|> aggregateWindow(every: 10s, fn: mean) ' \
-                 f'|> map(fn: (r) => ( {{ r with _time: uint(v: r._time) }} ))'
-                 
-                 # f'|> aggregateWindow(every: 60s, fn: mean) '
-
-    print(flux_query)
-    response = query_api.query(flux_query)
-    results = []
-    for table in response:
-        for record in table.records:
+    metric = query_builder.field(metric)
+    recent = query_recent(device_id, '-5m', '10s', (metric,))
+    if recent is not None:
+        stops, columns = recent
+        return [{"metric": metric, "value": value, "time": stop}
+                for stop, value in zip(stops, columns[metric])]
+
+    flux_query, params = query_builder.window_means(device_id, '-5m', '10s', (metric,), pivot=False)
+    logger.debug("Flux query: %s %s", flux_query, params)
+
+    def run(job):
+        results = []
+        for record in influx.query_api().query_stream(flux_query, params=params):
+            job.check()
             results.append({
                 "metric": record.get_field(),
                 "value": record.get_value(),
                 "time": record.get_time() // 1000000
                 })
-    return results
-            
-
+        return results
+    return query_executor.run(run)
+
+def analytics_series(device_id, start_ms, stop_ms):
+    import analytics
+    from influxdb_client import Dialect
+    flux_query, params = query_builder.day_series(device_id, start_ms, stop_ms)
+    logger.debug("Flux query: %s %s", flux_query, params)
+
+    def run(job):
+        rows = influx.query_api().query_csv(flux_query, params=params, dialect=Dialect(header=True, annotations=[]))
+
+        def checked():
+            for row in rows:
+                job.check()
+                yield row
+        return analytics.parse_series(checked())
+    return query_executor.run(run)
+
+def analytics_report(device_id, first_day, last_day):
+    # analytics pulls in numpy, which the sampler never needs
+    global analytics_cache
+    import analytics
+    with buffers_lock:
+        if analytics_cache is None:
+            analytics_cache = analytics.DayCache(config.get('ANALYTICS', 'CACHE_PATH', fallback='analytics_db'))
+    return analytics.report(device_id, first_day, last_day,
+                            lambda start_ms, stop_ms: analytics_series(device_id, start_ms, stop_ms),
+                            analytics_cache, int(time.time() * 1000))
+
+def _capture_summaries(device_id, flux_query, params):
+    logger.debug("Flux query: %s %s", flux_query, params)
+
+    def run(job):
+        results = []
+        for record in influx.query_api().query_stream(flux_query, params=params):
+            job.check()
+            values = record.values
+            results.append({
+                'deviceId': device_id,
+                'captureId': values.get('capture'),
+                'trigger': int(values.get('capture')),
+                'events': [name for name in (values.get('events') or '').split(',') if name],
+                'edges': [tuple(int(part) for part in edge.split(':')) for edge in (values.get('edges') or '').split(',') if edge],
+                'limits': {name: values[name] for name in ('VoltageSagLimit', 'VoltageSurgeLimit',
+                                                           'OverCurrentLimit', 'OverPowerLimit') if name in values},
+                'samples': values.get('samples'),
+            })
+        return results
+    return query_executor.run(run)
+
+def query_captures(device_id, duration=None):
+    # Recent captures are answered from memory; older ones from InfluxDB
+    if duration is None:
+        if sampler_link is not None:
+            return published_status('captures', {}).get(device_id, [])
+        capture = event_capture(device_id)
+        if capture is None:
+            return []
+        return [record.summary() for record in reversed(capture.captures())]
+    return _capture_summaries(device_id, *query_builder.capture_summaries(device_id, duration))
+
+def query_capture(device_id, capture_id):
+    trigger_ms = query_builder.trigger(capture_id)
+    capture = event_capture(device_id)
+    record = capture.get(str(trigger_ms)) if capture is not None else None
+    if record is not None:
+        return record.to_dict()
+
+    summaries = _capture_summaries(device_id, *query_builder.capture_summary(device_id, trigger_ms))
+    if not summaries:
+        return None
+    result = summaries[0]
+
+    flux_query, params = query_builder.capture_samples(device_id, trigger_ms)
+    logger.debug("Flux query: %s %s", flux_query, params)
+
+    def run(job):
+        offsets = []
+        fields = {field: [] for field in CAPTURE_FIELDS}
+        for record in influx.query_api().query_stream(flux_query, params=params):
+            job.check()
+            values = record.values
+            offsets.append(int(values.get('offset')))
+            for field in CAPTURE_FIELDS:
+                fields[field].append(values.get(field))
+        return offsets, fields
+    offsets, fields = query_executor.run(run)
+    result['offsets'] = offsets
+    result['fields'] = fields
+    if offsets:
+        result['start'] = trigger_ms + offsets[0]
+        result['stop'] = trigger_ms + offsets[-1]
+    return result
+
+
+def init_pipeline():
+    # Everything a sample goes through after it is read
+    global writer, ledger
+    with startup.phase('pipeline'):
+        writer = WritePipeline.from_config(influx, config)
+        ledger = EnergyLedger.from_config(config)
+        open_archive()
+
+# Opens the hardware and starts the writer and display threads. Only the
+# process that owns the hardware calls it; later calls do nothing.
 def initialize():
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
-    GPIO.setup(LED_PIN,GPIO.OUT)
-
-    GPIO.setup(ZCD_PIN, GPIO.IN)
-    GPIO.setup(EVENT_PIN, GPIO.IN)
-
-    GPIO.add_event_detect(EVENT_PIN, GPIO.BOTH, event_handler)
-    print("wattson initialized")
+    global initialized
+    with hardware_lock:
+        if initialized:
+            return
+        init_pipeline()
+        init_hardware()
+        with startup.phase('gpio'):
+            GPIO.setmode(GPIO.BCM)
+            GPIO.setwarnings(False)
+            GPIO.setup(LED_PIN,GPIO.OUT)
+
+            GPIO.setup(ZCD_PIN, GPIO.IN)
+            for pin in registry.event_pins():
+                GPIO.setup(pin, GPIO.IN)
+                GPIO.add_event_detect(pin, GPIO.BOTH, event_handler)
+        writer.start()
+        renderer.start()
+        initialized = True
+    logger.info("wattson initialized")
 
 def cleanup():
-    GPIO.remove_event_detect(EVENT_PIN)
-    GPIO.output(LED_PIN, 0)
-    GPIO.cleanup()
+    if initialized:
+        for pin in registry.event_pins():
+            GPIO.remove_event_detect(pin)
+        GPIO.output(LED_PIN, 0)
+        GPIO.cleanup()
+        renderer.stop()
+    query_executor.shutdown()
+    if writer is not None:
+        with buffers_lock:
+            held = [point for compressor in compressors.values() for point in compressor.flush()]
+        if held:
+            writer.submit_many(held)
+        ledger.checkpoint()
+        writer.stop()
+    if archive is not None:
+        archive.close()
+    influx.close()
+    if share_samples:
+        # Marks the segments closed so API workers re-attach to the next sampler
+        with buffers_lock:
+            shared = [buffer for buffer in buffers.values() if isinstance(buffer, SharedSampleBuffer)]
+        for segment in shared + ([status_blob] if status_blob is not None else []):
+            segment.close()
+
+def influx_stats():
+    return influx.stats()
+
+def write_stats():
+    if sampler_link is not None:
+        return published_status('write', {})
+    return writer.stats() if writer is not None else {}
+
+def energy_totals(device_id):
+    if sampler_link is not None:
+        return published_status('energyTotals', {}).get(device_id)
+    return ledger.totals(device_id) if ledger is not None else None
+
+def startup_stats():
+    if sampler_link is not None:
+        return published_status('startup', {})
+    return startup.stats()
+
+def published_status(key, default=None):
+    # A section of the status the sampler process last published
+    status = sampler_link.status() if sampler_link is not None else None
+    if status is None:
+        return default
+    return status.get(key, default)
+
+def collect_write_metrics():
+    if writer is None:
+        return []
+    stats = writer.stats()
+    pool = influx.stats()
+    return [
+        ('wattson_write_points_total', 'counter', 'Points by outcome in the write pipeline',
+         [({'outcome': outcome}, stats[outcome]) for outcome in ('submitted', 'written', 'spooled', 'replayed', 'dropped')]),
+        ('wattson_write_queue_depth', 'gauge', 'Points queued in memory for the writer', [({}, stats['queue_depth'])]),
+        ('wattson_write_spool_bytes', 'gauge', 'Size of the on-disk write spool', [({}, stats['spool_bytes'])]),
+        ('wattson_influx_idle_connections', 'gauge', 'Idle keep-alive connections to InfluxDB', [({}, pool['open_connections'])]),
+    ]
+
+def collect_compression_metrics():
+    stats = compression_stats()
+    if not stats:
+        return []
+    return [
+        ('wattson_compression_samples_total', 'counter', 'Samples offered to write compression',
+         [({'device': device_id}, s['samples']) for device_id, s in stats.items()]),
+        ('wattson_compression_written_total', 'counter', 'Measurement points written after compression, by reason',
+         [({'device': device_id, 'reason': reason}, count)
+          for device_id, s in stats.items() for reason, count in s['reasons'].items()]),
+        ('wattson_compression_ratio', 'gauge', 'Samples per written measurement point',
+         [({'device': device_id}, s['ratio'] or 0.0) for device_id, s in stats.items()]),
+    ]
+
+def collect_read_metrics():
+    stats = read_stats()
+    if not stats:
+        return []
+    return [
+        ('wattson_sample_reads_total', 'counter', 'Coalesced sample reads by outcome',
+         [({'device': device_id, 'outcome': outcome}, s[outcome])
+          for device_id, s in stats.items() for outcome in ('complete', 'partial', 'failed')]),
+        ('wattson_i2c_read_retries_total', 'counter', 'Register read transactions retried after an error',
+         [({'device': device_id}, s['retries']) for device_id, s in stats.items()]),
+        ('wattson_i2c_transaction_errors_total', 'counter', 'Failed register read transactions by error',
+         [({'device': device_id, 'error': error}, count)
+          for device_id, s in stats.items() for error, count in s['errors'].items()]),
+    ]
+
+metrics.register_collector(collect_write_metrics)
+metrics.register_collector(collect_read_metrics)
+metrics.register_collector(collect_compression_metrics)
 
 
 def event_handler(pin):
@@ -243,37 +714,53 @@ def event_handler(pin):
     GPIO.output(LED_PIN, state)
     eventTriggered = state;
 
-def setSystemConfig(voltageSagLimit = VOLTAGE_SAG_LIMIT, voltageSurgeLimit = VOLTAGE_SURGE_LIMIT, 
-                    overCurrentLimit = OVER_CURRENT_LIMIT, overPowerLimit = OVER_POWER_LIMIT):
-      (retVal, eventData) = wattson.readEventConfigRegister()
-
-      print("eventConfigRegister is {}".format(eventData))
-
-      (retVal, eventFlagLimits)  = wattson.readEventFlagLimitRegisters()
-
-      print("voltageSagLimit = {0}, voltageSurgeLimit = {1}, overCurrentLimit = {2}, overPowerLimit = {3}".format(
-            eventFlagLimits.voltageSagLimit, eventFlagLimits.voltageSurgeLimit, eventFlagLimits.overCurrentLimit, eventFlagLimits.overPowerLimit))
+    ts_ms = int(time.time() * 1000)
+    for device in registry:
+        if device.event_pin == pin:
+            capture = event_capture(device.device_id)
+            if capture is not None:
+                capture.trigger(ts_ms, state)
+    for listener in event_listeners:
+        listener(pin, state)
 
-      eventFlagLimits.voltageSagLimit = voltageSagLimit
-      eventFlagLimits.voltageSurgeLimit = voltageSurgeLimit      
-      eventFlagLimits.overCurrentLimit = overCurrentLimit
-      eventFlagLimits.overPowerLimit = overPowerLimit
-      retVal = wattson.writeEventFlagLimitRegisters(eventFlagLimits);
-
-      eventData = 0
-
-      ## Map Voltage Sag Event to event pin
-      eventData = bitSet(eventData, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Event_config.EVENT_VSAG_PIN.value)
-      ## Map Voltage Surge Event to event pin
-      eventData = bitSet(eventData, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Event_config.EVENT_VSURGE_PIN.value)
-      ## Map Over Current Event to event pin
-      eventData = bitSet(eventData, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Event_config.EVENT_OVERCUR_PIN.value)
-      ## Map Over Power Event to event pin
-      eventData = bitSet(eventData, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Event_config.EVENT_OVERPOW_PIN.value)
+def setSystemConfig(voltageSagLimit = VOLTAGE_SAG_LIMIT, voltageSurgeLimit = VOLTAGE_SURGE_LIMIT, 
+                    overCurrentLimit = OVER_CURRENT_LIMIT, overPowerLimit = OVER_POWER_LIMIT, sensor = None):
+      if sensor is None:
+          sensor = wattson
+      # The acquisition loops are already sampling; keep them off the bus
+      with bus_lock:
+
+          (retVal, eventData) = sensor.readEventConfigRegister()
+
+          logger.info("eventConfigRegister is %s", eventData)
+
+          (retVal, eventFlagLimits)  = sensor.readEventFlagLimitRegisters()
+
+          logger.info("voltageSagLimit = %s, voltageSurgeLimit = %s, overCurrentLimit = %s, overPowerLimit = %s",
+                eventFlagLimits.voltageSagLimit, eventFlagLimits.voltageSurgeLimit, eventFlagLimits.overCurrentLimit, eventFlagLimits.overPowerLimit)
+
+          eventFlagLimits.voltageSagLimit = voltageSagLimit
+          eventFlagLimits.voltageSurgeLimit = voltageSurgeLimit      
+          eventFlagLimits.overCurrentLimit = overCurrentLimit
+          eventFlagLimits.overPowerLimit = overPowerLimit
+          retVal = sensor.writeEventFlagLimitRegisters(eventFlagLimits);
+          event_limits.update({'VoltageSagLimit': voltageSagLimit / 10.0, 'VoltageSurgeLimit': voltageSurgeLimit / 10.0,
+                               'OverCurrentLimit': overCurrentLimit / 10000.0, 'OverPowerLimit': overPowerLimit / 100.0})
+
+          eventData = 0
+
+          ## Map Voltage Sag Event to event pin
+          eventData = bitSet(eventData, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Event_config.EVENT_VSAG_PIN.value)
+          ## Map Voltage Surge Event to event pin
+          eventData = bitSet(eventData, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Event_config.EVENT_VSURGE_PIN.value)
+          ## Map Over Current Event to event pin
+          eventData = bitSet(eventData, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Event_config.EVENT_OVERCUR_PIN.value)
+          ## Map Over Power Event to event pin
+          eventData = bitSet(eventData, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Event_config.EVENT_OVERPOW_PIN.value)
   
-      print("Event Config Register set to {}".format(eventData));
+          logger.info("Event Config Register set to %s", eventData)
       
-      retVal = wattson.setEventConfigurationRegister(eventData);
+          retVal = sensor.setEventConfigurationRegister(eventData);
 
 def bitSet(value, bit):
     value |= (1 << (bit))
@@ -325,152 +812,268 @@ def events(energyData):
 
 def checkSystemStatus(systemStatus):    
     if (bitRead(systemStatus, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_EVENT.value) == 1):
-        print("EVENT has occurred!") 
+        logger.warning("EVENT has occurred!")
   
     if (bitRead(systemStatus, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_VSAG.value) == 1):
-        print("Voltage Sag condition") 
+        logger.warning("Voltage Sag condition")
   
     if (bitRead(systemStatus, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_VSURGE.value) == 1):
-        print("Voltage Surge condition") 
+        logger.warning("Voltage Surge condition")
   
 
     if (bitRead(systemStatus, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_OVERCUR.value) == 1):
-        print("Over Current condition") 
+        logger.warning("Over Current condition")
   
 
     if (bitRead(systemStatus, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_OVERPOW.value) == 1):
-        print("Over Power condition") 
+        logger.warning("Over Power condition")
   
     # The sign of the active/reaction power is also indicated in the system
     # status register. This can tell us in which quadrant our power is.
     # We only want to do this when we have power - i.e when there is a
     # voltage sag, let's ignore this
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
     if (bitRead(systemStatus, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_VSAG.value) == 0):
     
         if (bitRead(systemStatus, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_SIGN_PA.value) == 1):
-            print("Active Power is positive (import)")
+            logger.debug("Active Power is positive (import)")
         else:
-            print("Active Power is negative (export)")
+            logger.debug("Active Power is negative (export)")
   
 
         if (bitRead(systemStatus, UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_SIGN_PR.value) == 1):
-            print("Reactive power is positive, inductive")
+            logger.debug("Reactive power is positive, inductive")
         else:
-            print("Reactive power is negative, capacitive")
+            logger.debug("Reactive power is negative, capacitive")
 
 
 def checkSystemStatusOld(energyData):
     if (energyData.systemStatus >> UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_SIGN_PA.value ) & 0x01:
-        print("SIGN_PA bit is set")
+        logger.debug("SIGN_PA bit is set")
 
     if (energyData.systemStatus >> UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_SIGN_PR.value ) & 0x01:
-        print("SIGN_PR bit is set")
+        logger.debug("SIGN_PR bit is set")
 
     if (energyData.systemStatus >> UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_EVENT.value ) & 0x01:
-        print("SYSTEM_EVENT bit is set")
+        logger.debug("SYSTEM_EVENT bit is set")
 
     if (energyData.systemStatus >> UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_VSAG.value ) & 0x01:
-        print("VSAG bit is set")
+        logger.debug("VSAG bit is set")
 
     if (energyData.systemStatus >> UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_VSURGE.value ) & 0x01:
-        print("VSURGE bit is set")
+        logger.debug("VSURGE bit is set")
 
     if (energyData.systemStatus >> UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_OVERCUR.value ) & 0x01:
-        print("OVERCUR bit is set")
+        logger.debug("OVERCUR bit is set")
 
     if (energyData.systemStatus >> UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.System_status.SYSTEM_OVERPOW.value ) & 0x01:
-        print("OVERPOW bit is set")
+        logger.debug("OVERPOW bit is set")
+
+
+i2c_read_seconds = metrics.histogram('wattson_i2c_read_seconds', 'Duration of MCP39F521 register block reads', ('block',))
+i2c_read_seconds_energy = i2c_read_seconds.labels('energy')
+i2c_read_seconds_accum = i2c_read_seconds.labels('accum')
+i2c_read_seconds_coalesced = i2c_read_seconds.labels('coalesced')
+i2c_read_errors = metrics.counter('wattson_i2c_read_errors_total', 'Failed MCP39F521 register block reads by error code', ('block', 'code'))
+I2C_ERROR_NAMES = {code.value: code.name for code in UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Error_code}
+
+# Tight acquisition path: only the register reads, serialized on the bus.
+def read_measurements(sensor=None):
+    if sensor is None:
+        sensor = wattson
+    if coalesced_reads:
+        reader = register_reader(sensor)
+        with bus_lock:
+            start = time.perf_counter()
+            result = reader.read()
+        i2c_read_seconds_coalesced.observe(time.perf_counter() - start)
+        if result is not None:
+            startup.mark('first_read')
+        return result
+
+    with bus_lock:
+        start = time.perf_counter()
+        (ret, energyData) = sensor.readEnergyData()
+        middle = time.perf_counter()
+        (retA, energyAccumData) = sensor.readEnergyAccumData()
+        end = time.perf_counter()
+    i2c_read_seconds_energy.observe(middle - start)
+    i2c_read_seconds_accum.observe(end - middle)
 
+    if (ret != UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Error_code.SUCCESS.value):
+        i2c_read_errors.labels('energy', I2C_ERROR_NAMES.get(ret, str(ret))).inc()
+        logger.error("Error reading energy data: %s", ret)
 
-def write_measurements(device_id):
-    influxdb_client = InfluxDBClient(url=config.get('APP', 'INFLUX_URL'),
-                                     token=config.get('APP', 'INFLUX_TOKEN'),
-                                     org=config.get('APP', 'INFLUX_ORG'))
-    write_api = influxdb_client.write_api(write_options=SYNCHRONOUS)
+    if (retA != UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Error_code.SUCCESS.value):
+        i2c_read_errors.labels('accum', I2C_ERROR_NAMES.get(retA, str(retA))).inc()
+        logger.error("Error reading energy accum data: %s", retA)
 
-    (ret, energyData) = wattson.readEnergyData()
+    if (ret == UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Error_code.SUCCESS.value and retA == UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Error_code.SUCCESS.value):
+        startup.mark('first_read')
+        return (energyData, energyAccumData)
 
-    if (ret != UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Error_code.SUCCESS.value):
-        print("Error reading energy data: {}".format(ret))
+    # Return None on failure
+    return None
 
-    (retA, energyAccumData) = wattson.readEnergyAccumData()
 
-    if (retA != UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Error_code.SUCCESS.value):
-        print("Error reading energy accum data: {}".format(retA))
+_Point = None
 
-    if (ret == UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Error_code.SUCCESS.value and retA == UpbeatLabs_MCP39F521.UpbeatLabs_MCP39F521.Error_code.SUCCESS.value):
+def point_class():
+    # influxdb_client.Point, imported on the first sample rather than at
+    # startup, and looked up once rather than on every sample
+    global _Point
+    if _Point is None:
+        from influxdb_client import Point
+        _Point = Point
+    return _Point
 
-        pq = powerQuadrant(energyData) 
-        now = datetime.now(timezone.utc)
 
-        point = Point("wattson_measurement") \
-            .tag("device", device_id) \
-            .field("SystemStatus", energyData.systemStatus) \
-            .field("PowerQuadrant", pq ) \
-            .field("VoltageRMS", energyData.voltageRMS) \
-            .field("CurrentRMS", energyData.currentRMS) \
-            .field("LineFrequency", energyData.lineFrequency) \
-            .field("PowerFactor", energyData.powerFactor) \
-            .field("ActivePower", energyData.activePower) \
-            .field("ReactivePower", energyData.reactivePower) \
-            .field("ApparentPower", energyData.apparentPower) \
-            .field("ActiveEnergyImport", energyAccumData.activeEnergyImport) \
-            .field("ReactiveEnergyImport", energyAccumData.reactiveEnergyImport) \
-            .field("ActiveEnergyExport", energyAccumData.activeEnergyExport) \
-            .field("ReactiveEnergyExport", energyAccumData.reactiveEnergyExport) \
-            .time(now)
-
-        print(f"Writing: {point.to_line_protocol()}")
-        try: 
-            client_response = write_api.write(bucket=config.get('APP', 'INFLUX_BUCKET'), record=point)
-        except Exception as e:
-            print(f"Write operation failed: {e}")
+# Everything that happens to a sample after it is read: persistence,
+# display and status reporting. Runs off the acquisition thread.
+def process_measurements(device_id, energyData, energyAccumData, now=None, display=True):
+    Point = point_class()
+    if now is None:
+        now = datetime.now(timezone.utc)
 
+    pq = powerQuadrant(energyData) 
+
+    point = Point("wattson_measurement") \
+        .tag("device", device_id) \
+        .field("SystemStatus", energyData.systemStatus) \
+        .field("PowerQuadrant", pq ) \
+        .field("VoltageRMS", energyData.voltageRMS) \
+        .field("CurrentRMS", energyData.currentRMS) \
+        .field("LineFrequency", energyData.lineFrequency) \
+        .field("PowerFactor", energyData.powerFactor) \
+        .field("ActivePower", energyData.activePower) \
+        .field("ReactivePower", energyData.reactivePower) \
+        .field("ApparentPower", energyData.apparentPower) \
+        .field("ActiveEnergyImport", energyAccumData.activeEnergyImport) \
+        .field("ReactiveEnergyImport", energyAccumData.reactiveEnergyImport) \
+        .field("ActiveEnergyExport", energyAccumData.activeEnergyExport) \
+        .field("ReactiveEnergyExport", energyAccumData.reactiveEnergyExport) \
+        .time(now)
+
+    unix_timestamp = int(now.timestamp()*1000)
+    for field, total in zip(TOTAL_FIELDS, ledger.fold(device_id, energyAccumData, unix_timestamp)):
+        point.field(field, total)
+
+    values = (energyData.systemStatus, pq, energyData.voltageRMS, energyData.currentRMS,
+              energyData.lineFrequency, energyData.powerFactor, energyData.activePower,
+              energyData.reactivePower, energyData.apparentPower,
+              energyAccumData.activeEnergyImport, energyAccumData.reactiveEnergyImport,
+              energyAccumData.activeEnergyExport, energyAccumData.reactiveEnergyExport)
+
+    compressor = stream_compressor(device_id)
+    points = compressor.add(unix_timestamp, values, point) if compressor is not None else [point]
+    for point in points:
+        # Serializing the point for the log costs more than building it
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Writing: %s", point.to_line_protocol())
+        # Queued for the background writer; never blocks on InfluxDB
+        writer.submit(point)
+
+    recent_buffer(device_id, create=True).append(unix_timestamp, values)
+    if archive is not None:
+        archive.append(device_id, unix_timestamp, values)
+
+    capture = event_capture(device_id)
+    if capture is not None:
+        record = capture.add(unix_timestamp, values)
+        if record is not None:
+            logger.info("Captured %s on %s: %d samples", record.event_types() or "event", device_id, len(record.offsets))
+            writer.submit_many(record.points())
+
+    aggregator = rollup_aggregator(device_id)
+    if aggregator is not None:
+        for rollup in aggregator.add(unix_timestamp, values):
+            writer.submit(rollup)
+
+    if display:
         write_display(energyData)
 
-        checkSystemStatus(energyData.systemStatus)
-        myEvents = events(energyData)
-        unix_timestamp = int(now.timestamp()*1000)
+    checkSystemStatus(energyData.systemStatus)
+    myEvents = events(energyData)
 
-        return (energyData, energyAccumData, pq, myEvents, unix_timestamp) 
-
-    # Return None on failure
-    return None
+    startup.mark('first_sample')
+    return (energyData, energyAccumData, pq, myEvents, unix_timestamp) 
 
 
-def energyAccumulationInitialize():
-    retVal, accumIntervalReg = wattson.readAccumulationIntervalRegister()
-    print("Accumulation interval is {}".format(accumIntervalReg))
+def write_measurements(device_id):
+    result = read_measurements()
+    if result is None:
+        return None
+    return process_measurements(device_id, result[0], result[1])
+
+
+def acquisition_rate():
+    return config.getfloat('SAMPLING', 'RATE_HZ', fallback=1.0)
+
+# Bus time of one sample: each coalesced block read waits SETTLE_MS, the
+# library's reads wait ~50 ms four times
+LIBRARY_SAMPLE_SECONDS = 0.2
+
+def sample_bus_seconds():
+    if not coalesced_reads:
+        return LIBRARY_SAMPLE_SECONDS
+    blocks = plan_blocks(config.getint('SAMPLING', 'MAX_READ_BYTES', fallback=DEFAULT_MAX_READ_BYTES))
+    return len(blocks) * config.getfloat('SAMPLING', 'SETTLE_MS', fallback=50.0) / 1000.0
+
+def check_bus_budget(boards, rate):
+    # Boards take turns on one bus; past one period of bus time per round
+    # the staggered loops overrun and skip ticks
+    needed = boards * sample_bus_seconds()
+    if needed > 1.0 / rate:
+        logger.warning("%d boards need ~%.2f s of bus time per round, more than the %.2f s period at "
+                       "[SAMPLING] RATE_HZ = %s; samples will be skipped. This read path delivers at "
+                       "most ~%.1f Hz", boards, needed, 1.0 / rate, rate, 1.0 / needed)
+        return False
+    return True
+
+
+def energyAccumulationInitialize(sensor=None):
+    if sensor is None:
+        sensor = wattson
+    # The bus is only held for each register access, so sampling carries on
+    # during the waits; the energy ledger absorbs the drop to zero.
+    with bus_lock:
+        retVal, accumIntervalReg = sensor.readAccumulationIntervalRegister()
+    logger.info("Accumulation interval is %s", accumIntervalReg)
 
     time.sleep(1);
 
     ## Turn off any previous energy accumulation
-    print("Turn off any previous accumulation")
-    wattson.enableEnergyAccumulation(False)
+    logger.info("Turn off any previous accumulation")
+    with bus_lock:
+        sensor.enableEnergyAccumulation(False)
 
     ## Wait for sometime for registers to reset before re-enabling them
     time.sleep(1);
-  
+
     ## Turn on energy accumulation
-    print("Re-enable accumulation");
-    wattson.enableEnergyAccumulation(True)  
+    logger.info("Re-enable accumulation")
+    with bus_lock:
+        sensor.enableEnergyAccumulation(True)
 
 
-def get_measurements(device_id):
-    influxdb_client = InfluxDBClient(url=config.get('APP', 'INFLUX_URL'),
-                                     token=config.get('APP', 'INFLUX_TOKEN'),
-                                     org=config.get('APP', 'INFLUX_ORG'))
+# Resets the boards one after the other on a worker thread, so the caller
+# (the scheduler) is not held up by the waits.
+def energyAccumulationReset(sensors):
+    def reset_all():
+        for sensor in sensors:
+            energyAccumulationInitialize(sensor)
+    thread = threading.Thread(target=reset_all, name='accumulation-reset', daemon=True)
+    thread.start()
+    return thread
 
-    # Queries must be formatted with single and double quotes correctly
-    query_api = QueryApi(influxdb_client)
-    device_id = str(device_id)
-    device_filter = f'r.device == "{device_id}"'
-    flux_query = f'from(bucket: "{config.get("APP", "INFLUX_BUCKET")}") ' \
-                 f'|> range(start: 0) ' \
-                 f'|> filter(fn: (r) => r._measurement == "environment" and {device_filter}) ' \
-                 f'|> last()'
 
-    response = query_api.query(flux_query)
+def get_measurements(device_id):
+    query_api = influx.query_api()
+    flux_query, params = query_builder.latest_environment(device_id)
+
+    response = query_api.query(flux_query, params=params)
 
     # iterate through the result(s)
     results = []
@@ -482,10 +1085,11 @@ def get_measurements(device_id):
 # TODO
 # Function should return a response code
 # Creates an authorization for a supplied deviceId
-def create_authorization(device_id) -> Authorization:
-    influxdb_client = InfluxDBClient(url=config.get('APP', 'INFLUX_URL'),
-                                     token=config.get('APP', 'INFLUX_TOKEN'),
-                                     org=config.get('APP', 'INFLUX_ORG'))
+def create_authorization(device_id) -> 'Authorization':
+    from influxdb_client import Authorization, Permission, PermissionResource
+    from influxdb_client.client.authorizations_api import AuthorizationsApi
+    from influxdb_client.client.bucket_api import BucketsApi
+    influxdb_client = influx.client()
 
     authorization_api = AuthorizationsApi(influxdb_client)
 
@@ -507,4 +1111,4 @@ def create_authorization(device_id) -> Authorization:
     request = authorization_api.create_authorization(org_id=org_id, permissions=permissions)
     return request
 
-
+startup.mark('wattson_imported')
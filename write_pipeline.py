@@ -0,0 +1,323 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+write_seconds = metrics.histogram('wattson_influx_write_seconds', 'Duration of successful InfluxDB batch writes')
+write_failures = metrics.counter('wattson_influx_write_failures_total', 'InfluxDB batch writes that failed and were spooled')
+
+
+# Batched, asynchronous writer for measurement points.
+#
+# Samples are queued in memory by the sampler and flushed to InfluxDB by a
+# background thread once BATCH_SIZE points are queued or the oldest queued
+# point is FLUSH_INTERVAL_S old. If a write fails the batch is appended to an
+# on-disk spool file (line protocol, one point per line) and replayed in order
+# once InfluxDB is reachable again, so a WAN outage does not lose data.
+class WritePipeline(object):
+    def __init__(self, influx, bucket, batch_size=50, flush_interval=5.0,
+                 spool_path='spool/wattson.lp', spool_max_bytes=64 * 1024 * 1024,
+                 retry_interval=10.0, replay_chunk=5000, max_queue=10000):
+        self._influx = influx
+        self._bucket = bucket
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._spool_path = spool_path
+        self._offset_path = spool_path + '.offset'
+        self._spool_max_bytes = spool_max_bytes
+        self._retry_interval = retry_interval
+        self._replay_chunk = replay_chunk
+        self._max_queue = max_queue
+
+        self._queue = deque()
+        # Points pushed out of a full queue, waiting to be spooled
+        self._overflow = deque()
+        self._overflow_full = False
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._spool_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._next_retry = 0.0
+
+        self._stats = {
+            'submitted': 0,
+            'written': 0,
+            'flushes': 0,
+            'failures': 0,
+            'spooled': 0,
+            'replayed': 0,
+            'dropped': 0,
+            'last_flush_latency_ms': 0.0,
+            'max_flush_latency_ms': 0.0,
+            'total_flush_latency_ms': 0.0,
+        }
+
+    @classmethod
+    def from_config(cls, influx, config, section='WRITE'):
+        return cls(influx, config.get('APP', 'INFLUX_BUCKET', fallback=None),
+                   batch_size=config.getint(section, 'BATCH_SIZE', fallback=50),
+                   flush_interval=config.getfloat(section, 'FLUSH_INTERVAL_S', fallback=5.0),
+                   spool_path=config.get(section, 'SPOOL_PATH', fallback='spool/wattson.lp'),
+                   spool_max_bytes=config.getint(section, 'SPOOL_MAX_BYTES', fallback=64 * 1024 * 1024),
+                   retry_interval=config.getfloat(section, 'RETRY_INTERVAL_S', fallback=10.0),
+                   max_queue=config.getint(section, 'MAX_QUEUE', fallback=10000))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._repair_spool()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='write-pipeline', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        if self._thread is None:
+            return
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, point):
+        # Called on the sampling path: must never block on the network or
+        # the disk. Points past MAX_QUEUE are handed to the writer thread,
+        # which spools them.
+        with self._cond:
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._queue.append(point)
+            self._stats['submitted'] += 1
+            if len(self._queue) > self._max_queue:
+                self._overflow_locked()
+            if len(self._queue) >= self._batch_size:
+                self._cond.notify()
+
+    def submit_many(self, points):
+        # Bulk variant of submit(), e.g. for an event capture: one lock
+        # round trip and one wake-up for the whole batch.
+        with self._cond:
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._queue.extend(points)
+            self._stats['submitted'] += len(points)
+            if len(self._queue) > self._max_queue:
+                self._overflow_locked()
+            if len(self._queue) >= self._batch_size:
+                self._cond.notify()
+
+    def _overflow_locked(self):
+        # Moves the oldest points past MAX_QUEUE to the overflow for the
+        # writer thread to spool. If the writer is stuck too and the
+        # overflow reaches MAX_QUEUE, the oldest overflow points are dropped.
+        self._overflow.extend(self._take(len(self._queue) - self._max_queue))
+        excess = len(self._overflow) - self._max_queue
+        if excess > 0:
+            for _ in range(excess):
+                self._overflow.popleft()
+            self._stats['dropped'] += excess
+            if not self._overflow_full:
+                # Logged once per episode; the count is in the stats
+                logger.error("Write queue and overflow full, dropping the oldest points")
+                self._overflow_full = True
+        self._cond.notify()
+
+    def _spool_overflow(self):
+        # Writer thread only
+        with self._cond:
+            overflow = list(self._overflow)
+            self._overflow.clear()
+            self._overflow_full = False
+        if overflow:
+            self._spool(self._serialize(overflow))
+
+    def stats(self):
+        with self._cond:
+            result = dict(self._stats)
+            result['queue_depth'] = len(self._queue)
+            result['overflow_depth'] = len(self._overflow)
+        flushes = result.pop('total_flush_latency_ms')
+        result['avg_flush_latency_ms'] = flushes / result['flushes'] if result['flushes'] else 0.0
+        result['spool_bytes'] = self._spool_size() - self._read_offset()
+        return result
+
+    def _take(self, count):
+        batch = [self._queue.popleft() for _ in range(min(count, len(self._queue)))]
+        self._oldest = time.monotonic() if self._queue else None
+        return batch
+
+    def _serialize(self, batch):
+        lines = []
+        for point in batch:
+            lines.append(point if isinstance(point, str) else point.to_line_protocol())
+        return lines
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._due():
+                    self._cond.wait(self._wait_time())
+                batch = self._take(self._batch_size)
+                running = self._running
+            # Older than anything queued; the batch below follows it into
+            # the spool
+            self._spool_overflow()
+            if batch:
+                self._flush(self._serialize(batch))
+            self._maybe_replay()
+            if not running:
+                # Drain whatever is left, spooling anything InfluxDB won't take.
+                self._spool_overflow()
+                with self._cond:
+                    rest = self._take(len(self._queue))
+                if rest:
+                    self._flush(self._serialize(rest))
+                return
+
+    def _due(self):
+        if self._overflow or len(self._queue) >= self._batch_size:
+            return True
+        if self._oldest is not None and time.monotonic() - self._oldest >= self._flush_interval:
+            return True
+        return self._has_spool() and time.monotonic() >= self._next_retry
+
+    def _wait_time(self):
+        if self._oldest is None:
+            return self._flush_interval
+        return max(0.05, self._flush_interval - (time.monotonic() - self._oldest))
+
+    def _flush(self, lines):
+        # Preserve ordering: while older data sits in the spool, new batches
+        # queue up behind it instead of overtaking it.
+        if self._has_spool() or time.monotonic() < self._next_retry:
+            self._spool(lines)
+            return
+        if not self._write(lines):
+            self._spool(lines)
+
+    def _write(self, lines):
+        start = time.monotonic()
+        try:
+            self._influx.write_api().write(bucket=self._bucket, record=lines)
+        except Exception as e:
+            logger.error("Write operation failed: %s", e)
+            write_failures.inc()
+            with self._cond:
+                self._stats['failures'] += 1
+            self._next_retry = time.monotonic() + self._retry_interval
+            return False
+        elapsed = time.monotonic() - start
+        write_seconds.observe(elapsed)
+        latency = elapsed * 1000.0
+        with self._cond:
+            self._stats['flushes'] += 1
+            self._stats['written'] += len(lines)
+            self._stats['last_flush_latency_ms'] = latency
+            self._stats['max_flush_latency_ms'] = max(self._stats['max_flush_latency_ms'], latency)
+            self._stats['total_flush_latency_ms'] += latency
+        return True
+
+    # Spool handling ---
+
+    def _spool_size(self):
+        try:
+            return os.path.getsize(self._spool_path)
+        except OSError:
+            return 0
+
+    def _read_offset(self):
+        try:
+            with open(self._offset_path) as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_offset(self, offset):
+        tmp = self._offset_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp, self._offset_path)
+
+    def _repair_spool(self):
+        # Drop a torn trailing line left behind by a crash mid-append.
+        size = self._spool_size()
+        if size == 0:
+            return
+        with open(self._spool_path, 'rb+') as f:
+            f.seek(max(0, size - 4096))
+            tail = f.read()
+            if tail.endswith(b'\n'):
+                return
+            cut = tail.rfind(b'\n')
+            f.truncate(size - len(tail) + cut + 1 if cut >= 0 else max(0, size - len(tail)))
+
+    def _has_spool(self):
+        return self._spool_size() > self._read_offset()
+
+    def _spool(self, lines):
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        with self._spool_lock:
+            if self._spool_size() - self._read_offset() + len(data) > self._spool_max_bytes:
+                with self._cond:
+                    self._stats['dropped'] += len(lines)
+                logger.error("Spool full, dropping %d points", len(lines))
+                return
+            directory = os.path.dirname(self._spool_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self._spool_path, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        with self._cond:
+            self._stats['spooled'] += len(lines)
+
+    def _maybe_replay(self):
+        # Chunks are read and the offset committed under the spool lock; the
+        # network write in between runs without it.
+        if time.monotonic() < self._next_retry:
+            return
+        while True:
+            with self._spool_lock:
+                offset = self._read_offset()
+                lines, end = self._read_chunk(offset)
+                if not lines:
+                    if offset and offset >= self._spool_size():
+                        # Fully replayed: compact by dropping the spool and its offset.
+                        for path in (self._spool_path, self._offset_path):
+                            if os.path.exists(path):
+                                os.remove(path)
+                    return
+            if not self._write(lines):
+                return
+            with self._spool_lock:
+                self._write_offset(end)
+            with self._cond:
+                self._stats['replayed'] += len(lines)
+            # A long replay must not leave overflow waiting in memory
+            self._spool_overflow()
+
+    def _read_chunk(self, offset):
+        # Up to replay_chunk complete lines from offset, and the offset after them
+        lines = []
+        end = offset
+        if self._spool_size() <= offset:
+            return lines, end
+        with open(self._spool_path, 'rb') as f:
+            f.seek(offset)
+            while len(lines) < self._replay_chunk:
+                raw = f.readline()
+                # A torn trailing line (power loss mid-append) is left
+                # for the next pass rather than sent half-written.
+                if not raw.endswith(b'\n'):
+                    break
+                lines.append(raw.decode('utf-8').rstrip('\n'))
+                end += len(raw)
+        return lines, end
@@ -0,0 +1,13 @@
+# Entry point for the API under a multi-worker WSGI server, with
+# [SERVER] MODE = split in config.ini:
+#
+#   python standalone_app.py
+#   gunicorn --workers 4 --worker-class gthread --threads 8 --bind 0.0.0.0:5000 wsgi:app
+#
+# Workers never open the I2C bus, the GPIO pins or the OLED; they serve the
+# samples and stats standalone_app.py publishes to shared memory.
+import os
+
+os.environ['WATTSON_ROLE'] = 'api'
+
+from app import app